@@ -19,6 +19,7 @@ from django.utils import translation
 from batch.incwo import utils
 
 from crm.models import Subsidiary
+from core.utils import flush_after_commit
 
 
 sub_dirs_strings = ', '.join(['"' + x + '"' for x in utils.SUB_DIRS])
@@ -113,6 +114,7 @@ Options specific to the import step:
 --missions
 --ignore-errors"""
 
+    @flush_after_commit
     def handle(self, *args, **options):
         translation.activate(settings.LANGUAGE_CODE)
         if len(args) == 0:
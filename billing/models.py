@@ -15,11 +15,13 @@ from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import ugettext
 from django.core.files.storage import FileSystemStorage
 from django.core.urlresolvers import reverse
+from django.db.models.signals import post_save, post_delete
 
 from leads.models import Lead
 from expense.models import Expense
 from crm.models import Supplier
-from core.utils import sanitizeName
+from core.utils import sanitizeName, modelVersionSignalHandler
+from core.search import searchIndexSignalHandler, searchIndexDeleteSignalHandler
 import pydici.settings
 
 
@@ -169,3 +171,10 @@ class SupplierBill(AbstractBill):
     class Meta:
         verbose_name = _("Supplier Bill")
         unique_together = (("supplier", "supplier_bill_id"),)
+
+
+# Signal connection to maintain search index
+post_save.connect(searchIndexSignalHandler, sender=ClientBill)
+post_delete.connect(searchIndexDeleteSignalHandler, sender=ClientBill)
+post_save.connect(modelVersionSignalHandler, sender=ClientBill)
+post_delete.connect(modelVersionSignalHandler, sender=ClientBill)
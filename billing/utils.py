@@ -7,36 +7,167 @@ appropriate to live in Billing models or view
 @license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
 """
 
-from staffing.models import Mission
+from datetime import date, timedelta
+from collections import defaultdict
+import math
+import json
+
+from django.db.models import Sum, Q, Avg, Case, When, Value, Func, DateField, FloatField
+from django.db.models.functions import Coalesce
+
+from staffing.models import Mission, Staffing, Timesheet, TimesheetRollup, rateResolver
+from billing.models import ClientBill
 from people.models import Consultant
-from core.utils import to_int_or_round
+from crm.models import Company
+from core.utils import to_int_or_round, nextMonth, sortedValues
 
 
-def get_billing_info(timesheet_data):
+def get_billing_info(timesheet_data, missions=None, consultants=None):
     """compute billing information from this timesheet data
     @:param timesheet_data: value queryset with mission, consultant and charge in days
+    @:param missions: dict of missions (with lead) by id. Loaded from timesheet data if not given
+    @:param consultants: dict of consultants by id. Loaded from timesheet data if not given
     @:return billing information as a tuple (lead, (lead total, (mission total, billing data)) """
     billing_data = {}
+    timesheet_data = list(timesheet_data)
+    if missions is None:
+        missions = Mission.objects.select_related("lead").in_bulk(set(i[0] for i in timesheet_data))
+    if consultants is None:
+        consultants = Consultant.objects.in_bulk(set(i[1] for i in timesheet_data))
+    rates = rateResolver.get_many((i[0], i[1]) for i in timesheet_data)
     for mission_id, consultant_id, charge in timesheet_data:
-        mission = Mission.objects.select_related("lead").get(id=mission_id)
+        mission = missions[mission_id]
         if mission.lead:
             lead = mission.lead
         else:
             # Bad data, mission with nature prod without lead... This should not happened
             continue
-        consultant = Consultant.objects.get(id=consultant_id)
-        rates =  mission.consultant_rates()
+        consultant = consultants[consultant_id]
+        daily_rate = rates[(mission_id, consultant_id)][0]
         if not lead in billing_data:
             billing_data[lead] = [0.0, {}]  # Lead Total and dict of mission
         if not mission in billing_data[lead][1]:
             billing_data[lead][1][mission] = [0.0, []]  # Mission Total and detail per consultant
-        total = charge * rates[consultant][0]
+        total = charge * daily_rate
         billing_data[lead][0] += total
         billing_data[lead][1][mission][0] += total
         billing_data[lead][1][mission][1].append(
-            [consultant, to_int_or_round(charge, 2), rates[consultant][0], total])
+            [consultant, to_int_or_round(charge, 2), daily_rate, total])
 
     # Sort data
     billing_data = billing_data.items()
     billing_data.sort(key=lambda x: x[0].deal_id)
     return billing_data
+
+
+def get_bills_totals(bills):
+    """Sum bills amount in database
+    @:param bills: bills queryset
+    @:return (total amount, total amount with vat)"""
+    totals = bills.aggregate(Sum("amount"), Sum("amount_with_vat"))
+    return totals["amount__sum"], totals["amount_with_vat__sum"] or 0
+
+
+class DaysBetween(Func):
+    """Number of days from second date expression to first one"""
+    template = "(%(expressions)s)"
+    arg_joiner = " - "
+
+    def as_sqlite(self, compiler, connection):
+        self.template = "(julianday(%(expressions)s))"
+        self.arg_joiner = ") - julianday("
+        return self.as_sql(compiler, connection)
+
+    def as_mysql(self, compiler, connection):
+        self.template = "DATEDIFF(%(expressions)s)"
+        self.arg_joiner = ", "
+        return self.as_sql(compiler, connection)
+
+
+def get_payment_delays(bills, company_field, details=False):
+    """Compute client bills payment delay statistics by company. Averages are computed by database
+    @:param bills: client bills queryset
+    @:param company_field: lookup from bill to company used to group bills
+    @:param details: also compute median and 90th percentile. This needs to read delay of each bill
+    @:return list of (company, average, median, 90th percentile, last year average) delays in days, in company default order.
+    Median and percentile are None without details. Last year average is None if company has no bill created during the last year"""
+    today = date.today()
+    lastYear = today - timedelta(365)
+    delay = DaysBetween(Coalesce("payment_date", Value(today, output_field=DateField())), "creation_date",
+                        output_field=FloatField())
+    averages = bills.values_list(company_field).annotate(average=Avg(delay),
+                                                         last_year=Avg(Case(When(creation_date__gt=lastYear, then=delay),
+                                                                            output_field=FloatField()))).order_by()
+    averages = dict((company_id, (average, lastYearAverage)) for company_id, average, lastYearAverage in averages)
+    delays = defaultdict(list)  # Key is company id, value is list of delays in days
+    if details:
+        for company_id, companyDelay in bills.annotate(delay=delay).values_list(company_field, "delay").order_by():
+            delays[company_id].append(int(companyDelay))
+    result = []
+    for company in Company.objects.filter(id__in=averages.keys()):
+        average, lastYearAverage = averages[company.id]
+        companyDelays = sorted(delays[company.id])
+        result.append((company,
+                       int(math.floor(average)),
+                       companyDelays[len(companyDelays) / 2] if companyDelays else None,
+                       companyDelays[int(math.ceil(0.9 * len(companyDelays))) - 1] if companyDelays else None,
+                       int(math.floor(lastYearAverage)) if lastYearAverage is not None else None))
+    return result
+
+
+def graph_billing_data(today):
+    """Compute monthly bills, done work and forecasted work amounts for billing graph with grouped queries
+    @:param today: reference day. Data is taken about 24 month before and 6 month after it
+    @:return json jqplot graph data or None if there is no bills"""
+    billsData = defaultdict(lambda: defaultdict(float))  # Key is month, value is dict with state as key and amount as value
+    tsData = defaultdict(float)  # Timesheet done work graph data
+    staffingData = defaultdict(float)  # Staffing forecasted work graph data
+    wStaffingData = defaultdict(float)  # Weighted Staffing forecasted work graph data
+    start_date = today - timedelta(24 * 30)  # Screen data about 24 month before today
+    end_date = today + timedelta(6 * 30)  # No more than 6 month forecasted
+    current_month = today.replace(day=1)
+    start_month = start_date.replace(day=1)
+    graph_data = []  # Data that will be returned to jqplot
+
+    # Gathering billsData, using first day of each month as key date
+    bills = ClientBill.objects.filter(creation_date__gt=start_date)
+    bills = bills.values_list("creation_date", "state").annotate(Sum("amount")).order_by()
+    if not bills:
+        return None
+    for creation_date, state, amount in bills:
+        billsData[creation_date.replace(day=1)][state] += float(amount) / 1000
+
+    # Financial conditions as a hash for further lookup. Key is (mission id, consultant id). Value is (daily rate, bought daily rate)
+    financialConditions = rateResolver.rates()
+
+    # Collect data for done work according to valued timesheet rollup for full months
+    rollups = TimesheetRollup.objects.filter(month__gt=start_month, month__lt=current_month, nature="PROD")
+    for month, amount in rollups.values_list("month").annotate(Sum("amount")).order_by():
+        tsData[month] += amount / 1000
+    # and according to timesheet for first and current month that are not fully considered
+    timesheets = Timesheet.objects.filter(mission__nature="PROD")
+    timesheets = timesheets.filter(Q(working_date__gt=start_date, working_date__lt=nextMonth(start_month)) |
+                                   Q(working_date__gte=current_month, working_date__lt=today))
+    for working_date, mission_id, consultant_id, charge in timesheets.values_list("working_date", "mission", "consultant").annotate(Sum("charge")).order_by():
+        tsData[working_date.replace(day=1)] += charge * financialConditions.get((mission_id, consultant_id), (0, 0))[0] / 1000
+
+    # Collect data for forecasted work according to staffing data
+    staffings = Staffing.objects.filter(staffing_date__gte=current_month, staffing_date__lt=end_date, mission__nature="PROD")
+    staffings = staffings.values_list("staffing_date", "mission", "consultant", "mission__probability").annotate(Sum("charge")).order_by()
+    for staffing_date, mission_id, consultant_id, probability, charge in staffings:
+        kdate = staffing_date.replace(day=1)
+        amount = charge * financialConditions.get((mission_id, consultant_id), (0, 0))[0]
+        staffingData[kdate] += amount / 1000
+        wStaffingData[kdate] += amount * probability / 100 / 1000
+
+    # Draw a bar for each state
+    isoBillKdates = [a.isoformat() for a in sorted(billsData.keys())]  # List of date as string in ISO format
+    for state in ClientBill.CLIENT_BILL_STATE:
+        ydata = [amounts.get(state[0], 0) for amounts in sortedValues(billsData)]
+        graph_data.append(zip(isoBillKdates, ydata))
+
+    # Draw done work and forecasted work
+    for data in (tsData, staffingData, wStaffingData):
+        graph_data.append(zip([a.isoformat() for a in sorted(data.keys())], sortedValues(data)))
+
+    return json.dumps(graph_data)
@@ -19,14 +19,17 @@ from django.views.decorators.cache import cache_page
 from django.utils.translation import ugettext as _
 
 from billing.models import ClientBill, SupplierBill
-from billing.utils import get_billing_info
+from billing.utils import get_billing_info, get_bills_totals, get_payment_delays, graph_billing_data
 from leads.models import Lead
 from people.models import Consultant
-from staffing.models import Timesheet, FinancialCondition, Staffing, Mission
+from staffing.models import Timesheet, Staffing, Mission, FINANCIAL_CONDITION_VERSION_CACHE_KEY
 from crm.models import Company, Subsidiary
-from core.utils import COLORS, sortedValues, nextMonth, previousMonth, to_int_or_round, get_fiscal_years, get_parameter
+from core.utils import COLORS, nextMonth, previousMonth, to_int_or_round, get_fiscal_years, get_parameter, \
+    get_version_stamps, watermark_cached, model_version_key
 from core.decorator import pydici_non_public, pydici_feature
 
+BILLING_GRAPH_CACHE_KEY = "BILLING_GRAPH"
+
 
 @pydici_non_public
 @pydici_feature("reports")
@@ -42,20 +45,15 @@ def bill_review(request):
     litigious_bills = ClientBill.objects.filter(state="3_LITIGIOUS").select_related()
 
     # Compute totals
-    soondue_bills_total = soondue_bills.aggregate(Sum("amount"))["amount__sum"]
-    overdue_bills_total = overdue_bills.aggregate(Sum("amount"))["amount__sum"]
-    litigious_bills_total = litigious_bills.aggregate(Sum("amount"))["amount__sum"]
-    soondue_bills_total_with_vat = sum([bill.amount_with_vat for bill in soondue_bills if bill.amount_with_vat])
-    overdue_bills_total_with_vat = sum([bill.amount_with_vat for bill in overdue_bills if bill.amount_with_vat])
-    litigious_bills_total_with_vat = sum([bill.amount_with_vat for bill in litigious_bills if bill.amount_with_vat])
+    soondue_bills_total, soondue_bills_total_with_vat = get_bills_totals(soondue_bills)
+    overdue_bills_total, overdue_bills_total_with_vat = get_bills_totals(overdue_bills)
+    litigious_bills_total, litigious_bills_total_with_vat = get_bills_totals(litigious_bills)
 
     # Get leads with done timesheet in past three month that don't have bill yet
-    leadsWithoutBill = []
     threeMonthAgo = date.today() - timedelta(90)
-    for lead in Lead.objects.filter(state="WON").select_related():
-        if lead.clientbill_set.count() == 0:
-            if Timesheet.objects.filter(mission__lead=lead, working_date__gte=threeMonthAgo).count() != 0:
-                leadsWithoutBill.append(lead)
+    leadsWithoutBill = Timesheet.objects.filter(working_date__gte=threeMonthAgo, mission__lead__state="WON",
+                                                mission__lead__clientbill__isnull=True).values("mission__lead")
+    leadsWithoutBill = Lead.objects.filter(id__in=leadsWithoutBill).select_related()
 
     return render(request, "billing/bill_review.html",
                   {"overdue_bills": overdue_bills,
@@ -76,24 +74,17 @@ def bill_review(request):
 @pydici_feature("reports")
 def bill_payment_delay(request):
     """Report on client bill payment delay"""
-    # List of tuple (company, avg delay in days)
-    directDelays = list()  # for direct client
-    indirectDelays = list()  # for client with paying authority
-    for company in Company.objects.all():
-        # Direct delays
-        bills = ClientBill.objects.filter(lead__client__organisation__company=company, lead__paying_authority__isnull=True, state="2_PAID")
-        res = [i.payment_delay() for i in bills]
-        if res:
-            directDelays.append((company, sum(res) / len(res)))
-        # Indirect delays
-        bills = ClientBill.objects.filter(lead__paying_authority__company=company, state="2_PAID")
-        res = [i.payment_delay() for i in bills]
-        if res:
-            indirectDelays.append((company, sum(res) / len(res)))
+    details = bool(request.GET.get("details"))  # Display median, 90th percentile and last year average
+    bills = ClientBill.objects.filter(state="2_PAID")
+    # List of tuple (company, avg delay in days, median, 90th percentile, last year avg) for direct client
+    directDelays = get_payment_delays(bills.filter(lead__paying_authority__isnull=True), "lead__client__organisation__company", details)
+    # Same for client with paying authority
+    indirectDelays = get_payment_delays(bills.filter(lead__paying_authority__isnull=False), "lead__paying_authority__company", details)
 
     return render(request, "billing/payment_delay.html",
                   {"direct_delays": directDelays,
                    "indirect_delays": indirectDelays,
+                   "details": details,
                    "user": request.user},)
 
 
@@ -155,34 +146,41 @@ def pre_billing(request, year=None, month=None, mine=False):
                                                           timesheet__working_date__gte=month,
                                                           timesheet__working_date__lt=next_month)
 
-    timespent_timesheets = Timesheet.objects.filter(working_date__gte=month, working_date__lt=next_month,
-                                                    mission__nature="PROD", mission__billing_mode="TIME_SPENT")
-
-    internalBillingTimesheets = Timesheet.objects.filter(working_date__gte=month, working_date__lt=next_month,
-                                                    mission__nature="PROD")
-    internalBillingTimesheets = internalBillingTimesheets.exclude(Q(consultant__company=F("mission__subsidiary")) & Q(consultant__company=F("mission__lead__subsidiary")))
+    timesheets = Timesheet.objects.filter(working_date__gte=month, working_date__lt=next_month, mission__nature="PROD")
     #TODO: hanlde fixed price mission fully delegated to a subsidiary
 
     if mine:  # Filter on consultant mission/lead as responsible
         fixedPriceMissions = fixedPriceMissions.filter(Q(lead__responsible=billing_consultant) | Q(responsible=billing_consultant))
         undefinedBillingModeMissions = undefinedBillingModeMissions.filter(Q(lead__responsible=billing_consultant) | Q(responsible=billing_consultant))
-        timespent_timesheets = timespent_timesheets.filter(Q(mission__lead__responsible=billing_consultant) | Q(mission__responsible=billing_consultant))
-        internalBillingTimesheets = internalBillingTimesheets.filter(Q(mission__lead__responsible=billing_consultant) | Q(mission__responsible=billing_consultant))
+        timesheets = timesheets.filter(Q(mission__lead__responsible=billing_consultant) | Q(mission__responsible=billing_consultant))
 
     fixedPriceMissions = fixedPriceMissions.order_by("lead").distinct()
     undefinedBillingModeMissions = undefinedBillingModeMissions.order_by("lead").distinct()
 
-    timesheet_data = timespent_timesheets.order_by("mission__lead", "consultant").values_list("mission", "consultant").annotate(Sum("charge"))
-    timeSpentBilling = get_billing_info(timesheet_data)
-
-    for subsidiary in Subsidiary.objects.all():
-        subsidiary_timesheet_data = internalBillingTimesheets.filter(consultant__company=subsidiary)
-        for target_subsidiary in Subsidiary.objects.exclude(pk=subsidiary.id):
-            timesheet_data = subsidiary_timesheet_data.filter(mission__lead__subsidiary=target_subsidiary)
-            timesheet_data = timesheet_data .order_by("mission__lead", "consultant").values_list("mission", "consultant").annotate(Sum("charge"))
-            billing_info = get_billing_info(timesheet_data)
-            if billing_info:
-                internalBilling[(subsidiary,target_subsidiary)] = billing_info
+    # One timesheet aggregate for both time spent and internal billing
+    timesheet_data = timesheets.values_list("consultant__company", "mission__lead__subsidiary", "mission__subsidiary",
+                                            "mission__billing_mode", "mission", "consultant")
+    timesheet_data = list(timesheet_data.annotate(Sum("charge")).order_by("mission__lead", "consultant"))
+    missions = Mission.objects.select_related("lead").in_bulk(set(i[4] for i in timesheet_data))
+    consultants = Consultant.objects.in_bulk(set(i[5] for i in timesheet_data))
+    subsidiaries = Subsidiary.objects.in_bulk(set(i[0] for i in timesheet_data) | set(i[1] for i in timesheet_data))
+
+    timeSpentData = [(mission_id, consultant_id, charge) for c, l, m, billing_mode, mission_id, consultant_id, charge in timesheet_data
+                     if billing_mode == "TIME_SPENT"]
+    timeSpentBilling = get_billing_info(timeSpentData, missions, consultants)
+
+    internalBillingData = defaultdict(list)  # Key is (consultant subsidiary, lead subsidiary) ids
+    for consultantSubsidiary, leadSubsidiary, missionSubsidiary, billing_mode, mission_id, consultant_id, charge in timesheet_data:
+        if consultantSubsidiary == missionSubsidiary and consultantSubsidiary == leadSubsidiary:
+            # Nothing to bill between subsidiaries
+            continue
+        if leadSubsidiary is None or consultantSubsidiary == leadSubsidiary:
+            continue
+        internalBillingData[(consultantSubsidiary, leadSubsidiary)].append((mission_id, consultant_id, charge))
+    for (subsidiary_id, target_subsidiary_id), data in internalBillingData.items():
+        billing_info = get_billing_info(data, missions, consultants)
+        if billing_info:
+            internalBilling[(subsidiaries[subsidiary_id], subsidiaries[target_subsidiary_id])] = billing_info
 
     return render(request, "billing/pre_billing.html",
                   {"time_spent_billing": timeSpentBilling,
@@ -196,88 +194,19 @@ def pre_billing(request, year=None, month=None, mine=False):
 
 @pydici_non_public
 @pydici_feature("reports")
-@cache_page(60 * 10)
 def graph_billing_jqp(request):
     """Nice graph bar of incomming cash from bills
+    Graph data is cached as long as bills, timesheet, staffing, missions or rates do not change
     @todo: per year, with start-end date"""
-    billsData = defaultdict(list)  # Bill graph Data
-    tsData = {}  # Timesheet done work graph data
-    staffingData = {}  # Staffing forecasted work graph data
-    wStaffingData = {}  # Weighted Staffing forecasted work graph data
     today = date.today()
-    start_date = today - timedelta(24 * 30)  # Screen data about 24 month before today
-    end_date = today + timedelta(6 * 30)  # No more than 6 month forecasted
-    graph_data = []  # Data that will be returned to jqplot
-
-    # Gathering billsData
-    bills = ClientBill.objects.filter(creation_date__gt=start_date)
-    if bills.count() == 0:
+    versions = [model_version_key(model) for model in (ClientBill, Timesheet, Staffing, Mission)]
+    watermark = (today, get_version_stamps(versions + [FINANCIAL_CONDITION_VERSION_CACHE_KEY]))
+    graph_data = watermark_cached(BILLING_GRAPH_CACHE_KEY, watermark, lambda: graph_billing_data(today))
+    if graph_data is None:
         return HttpResponse()
 
-    for bill in bills:
-        # Using first day of each month as key date
-        kdate = bill.creation_date.replace(day=1)
-        billsData[kdate].append(bill)
-
-    # Collect Financial conditions as a hash for further lookup
-    financialConditions = {}  # First key is consultant id, second is mission id. Value is daily rate
-    # TODO: filter FC on timesheet date to forget old fc (perf)
-    for fc in FinancialCondition.objects.filter(mission__nature="PROD"):
-        if not fc.consultant_id in financialConditions:
-            financialConditions[fc.consultant_id] = {}  # Empty dict for missions
-        financialConditions[fc.consultant_id][fc.mission_id] = fc.daily_rate
-
-    # Collect data for done work according to timesheet data
-    for ts in Timesheet.objects.filter(working_date__lt=today, working_date__gt=start_date, mission__nature="PROD").select_related():
-        kdate = ts.working_date.replace(day=1)
-        if kdate not in tsData:
-            tsData[kdate] = 0  # Create key
-        tsData[kdate] += ts.charge * financialConditions.get(ts.consultant_id, {}).get(ts.mission_id, 0) / 1000
-
-    # Collect data for forecasted work according to staffing data
-    for staffing in Staffing.objects.filter(staffing_date__gte=today.replace(day=1), staffing_date__lt=end_date, mission__nature="PROD").select_related():
-        kdate = staffing.staffing_date.replace(day=1)
-        if kdate not in staffingData:
-            staffingData[kdate] = 0  # Create key
-            wStaffingData[kdate] = 0  # Create key
-        staffingData[kdate] += staffing.charge * financialConditions.get(staffing.consultant_id, {}).get(staffing.mission_id, 0) / 1000
-        wStaffingData[kdate] += staffing.charge * financialConditions.get(staffing.consultant_id, {}).get(staffing.mission_id, 0) * staffing.mission.probability / 100 / 1000
-
-    # Set bottom of each graph. Starts if [0, 0, 0, ...]
-    billKdates = billsData.keys()
-    billKdates.sort()
-    isoBillKdates = [a.isoformat() for a in billKdates]  # List of date as string in ISO format
-
-    # Draw a bar for each state
-    for state in ClientBill.CLIENT_BILL_STATE:
-        ydata = [sum([float(i.amount) / 1000 for i in x if i.state == state[0]]) for x in sortedValues(billsData)]
-        graph_data.append(zip(isoBillKdates, ydata))
-
-    # Sort keys
-    tsKdates = tsData.keys()
-    tsKdates.sort()
-    isoTsKdates = [a.isoformat() for a in tsKdates]  # List of date as string in ISO format
-    staffingKdates = staffingData.keys()
-    staffingKdates.sort()
-    isoStaffingKdates = [a.isoformat() for a in staffingKdates]  # List of date as string in ISO format
-    wStaffingKdates = staffingData.keys()
-    wStaffingKdates.sort()
-    isoWstaffingKdates = [a.isoformat() for a in wStaffingKdates]  # List of date as string in ISO format
-
-    # Sort values according to keys
-    tsYData = sortedValues(tsData)
-    staffingYData = sortedValues(staffingData)
-    wStaffingYData = sortedValues(wStaffingData)
-
-    # Draw done work
-    graph_data.append(zip(isoTsKdates, tsYData))
-
-    # Draw forecasted work
-    graph_data.append(zip(isoStaffingKdates, staffingYData))
-    graph_data.append(zip(isoWstaffingKdates, wStaffingYData))
-
     return render(request, "billing/graph_billing_jqp.html",
-                  {"graph_data": json.dumps(graph_data),
+                  {"graph_data": graph_data,
                    "series_label": [i[1] for i in ClientBill.CLIENT_BILL_STATE],
                    "series_colors": COLORS,
                    # "min_date": min_date,
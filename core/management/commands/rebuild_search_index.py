@@ -0,0 +1,20 @@
+# coding: utf-8
+"""
+Rebuild the search index
+@author: Sébastien Renard (sebastien.renard@digitalfox.org)
+@license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
+"""
+
+from django.core.management.base import BaseCommand
+
+from core.search import rebuild_search_index
+from core.utils import flush_after_commit
+
+
+class Command(BaseCommand):
+    help = "Rebuild search index from consultants, companies, contacts, tags, leads, missions and bills. Needed once after install or upgrade"
+
+    @flush_after_commit
+    def handle(self, *args, **options):
+        n = rebuild_search_index()
+        self.stdout.write("%s objects indexed" % n)
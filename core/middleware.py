@@ -0,0 +1,30 @@
+# coding: utf-8
+"""
+Pydici middlewares
+@author: Sébastien Renard (sebastien.renard@digitalfox.org)
+@license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
+"""
+
+from django.conf import settings
+
+from core.utils import request_memo_start, request_memo_stop, run_after_commit
+
+
+class RequestMemoMiddleware(object):
+    """Enable request scoped memo of cached data (cacheable methods, parameters and version stamps) during each request.
+    Repeated lookups of the same data within a request do not hit cache backend again.
+    In debug mode, memo hits and misses are returned in X-Pydici-Memo response header.
+    Cache invalidations deferred until transaction commit are run once request is processed"""
+    def process_request(self, request):
+        request_memo_start()
+
+    def process_response(self, request, response):
+        hits, misses = request_memo_stop()
+        run_after_commit()
+        if settings.DEBUG:
+            response["X-Pydici-Memo"] = "hits=%s misses=%s" % (hits, misses)
+        return response
+
+    def process_exception(self, request, exception):
+        request_memo_stop()
+        run_after_commit()
@@ -14,6 +14,7 @@ To check for access from a template, use `{% if pydici_feature.<feature_name> %}
 """
 
 from django.contrib.auth.models import Group
+from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from django.core.cache import cache
@@ -65,5 +66,23 @@ class Parameter(models.Model):
 
     def save(self, *args, **kwargs):
         """Invalidate cache for this param"""
+        from core.utils import request_memo_clear  # Late import to avoid circular reference
         cache.set(self.PARAMETER_CACHE_KEY % self.key, None)
-        super(Parameter, self).save(*args, **kwargs)
\ No newline at end of file
+        request_memo_clear()
+        super(Parameter, self).save(*args, **kwargs)
+
+class SearchToken(models.Model):
+    """Search index: one row per distinct token of each indexed object with its weight.
+    This table is derived from consultants, companies, contacts, tags, leads, missions and bills.
+    It is kept up to date by signals and can be rebuilt from scratch with the rebuild_search_index command"""
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    token = models.CharField(max_length=64, db_index=True)
+    weight = models.PositiveSmallIntegerField(default=1)
+
+    def __unicode__(self):
+        return u"%s (%s %s)" % (self.token, self.content_type, self.object_id)
+
+    class Meta:
+        index_together = (("content_type", "object_id"),)
+        verbose_name = _("Search token")
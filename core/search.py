@@ -0,0 +1,222 @@
+# coding: utf-8
+
+"""
+Module that handle full text search index of pydici objects
+@author: Sébastien Renard (sebastien.renard@digitalfox.org)
+@license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
+"""
+
+import re
+import unicodedata
+from operator import or_
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Q, F, Max, Case, When, Value, IntegerField
+from django.contrib.contenttypes.models import ContentType
+
+from core.models import SearchToken
+
+
+TOKEN_MAX_LENGTH = 64
+
+
+def consultant_terms(consultant):
+    return [(consultant.name, 3), (consultant.trigramme, 3)]
+
+
+def company_terms(company):
+    return [(company.name, 3)]
+
+
+def contact_terms(contact):
+    return [(contact.name, 3)]
+
+
+def tag_terms(tag):
+    return [(tag.name, 3)]
+
+
+def lead_terms(lead):
+    terms = [(lead.name, 3), (lead.deal_id, 3), (lead.description, 1),
+             (lead.client.organisation.name, 1), (lead.client.organisation.company.name, 1)]
+    if lead.client.contact:
+        terms.append((lead.client.contact.name, 1))
+    terms.extend((tag.name, 2) for tag in lead.tags.all())
+    if lead.deal_id:
+        # Mission ids, see Mission.mission_id()
+        terms.extend((lead.deal_id + chr(97 + rank), 2) for rank in range(len(lead.mission_set.all())))
+    return terms
+
+
+def mission_terms(mission):
+    return [(mission.mission_id(), 3), (mission.deal_id, 3), (mission.description, 1)]
+
+
+def bill_terms(bill):
+    return [(bill.bill_id, 3), (bill.comment, 1)]
+
+
+# Indexed models. Key is model label, value is (function that returns (text, weight) list of an object,
+# select_related and prefetch_related lookups used to fetch objects to index)
+SEARCH_INDEX = {"people.Consultant": (consultant_terms, [], []),
+                "crm.Company": (company_terms, [], []),
+                "crm.Contact": (contact_terms, [], []),
+                "taggit.Tag": (tag_terms, [], []),
+                "leads.Lead": (lead_terms, ["client__organisation__company", "client__contact"], ["tags", "mission_set"]),
+                "staffing.Mission": (mission_terms, ["lead"], []),
+                "billing.ClientBill": (bill_terms, [], [])}
+
+
+def indexed_objects(label):
+    """@return: queryset of all objects of given indexed model, with related objects needed by index"""
+    terms, select_related, prefetch_related = SEARCH_INDEX[label]
+    return apps.get_model(label).objects.select_related(*select_related).prefetch_related(*prefetch_related)
+
+
+def lead_related(lead):
+    return indexed_objects("staffing.Mission").filter(lead=lead)  # Mission ids depend on lead deal id
+
+
+def mission_related(mission):
+    return indexed_objects("leads.Lead").filter(id=mission.lead_id) if mission.lead_id else []
+
+
+def company_related(company):
+    return indexed_objects("leads.Lead").filter(client__organisation__company=company)
+
+
+def organisation_related(organisation):
+    return indexed_objects("leads.Lead").filter(client__organisation=organisation)
+
+
+def client_related(client):
+    return indexed_objects("leads.Lead").filter(client=client)
+
+
+def contact_related(contact):
+    return indexed_objects("leads.Lead").filter(client__contact=contact)
+
+
+def tag_related(tag):
+    return indexed_objects("leads.Lead").filter(tags=tag)
+
+
+def tagged_item_related(tagged_item):
+    Lead = apps.get_model("leads", "Lead")
+    if tagged_item.content_type_id == ContentType.objects.get_for_model(Lead).id:
+        return indexed_objects("leads.Lead").filter(id=tagged_item.object_id)
+    return []
+
+
+# Objects whose index depends on a changed object. Key is model label, value is function that returns those objects
+SEARCH_INDEX_RELATED = {"leads.Lead": lead_related,
+                        "staffing.Mission": mission_related,
+                        "crm.Company": company_related,
+                        "crm.ClientOrganisation": organisation_related,
+                        "crm.Client": client_related,
+                        "crm.Contact": contact_related,
+                        "taggit.Tag": tag_related,
+                        "taggit.TaggedItem": tagged_item_related}
+
+
+def model_label(model):
+    return "%s.%s" % (model._meta.app_label, model._meta.object_name)
+
+
+def tokenize(text):
+    """Split text in lower case ascii tokens
+    @return: list of tokens"""
+    if not text:
+        return []
+    text = unicodedata.normalize("NFKD", unicode(text)).encode("ascii", "ignore").lower()
+    return [token[:TOKEN_MAX_LENGTH] for token in re.findall("[a-z0-9]+", text)]
+
+
+def get_search_tokens(obj, content_type=None):
+    """@return: list of SearchToken (not saved) of given object"""
+    terms = SEARCH_INDEX[model_label(obj.__class__)][0]
+    content_type = content_type or ContentType.objects.get_for_model(obj)
+    weights = {}
+    for text, weight in terms(obj):
+        for token in tokenize(text):
+            weights[token] = max(weight, weights.get(token, 0))
+    return [SearchToken(content_type=content_type, object_id=obj.id, token=token, weight=weight) for token, weight in weights.items()]
+
+
+@transaction.atomic
+def update_search_index(objects):
+    """Index again given objects
+    @param objects: objects list or queryset. All objects must be of the same model"""
+    objects = list(objects)
+    if not objects:
+        return
+    content_type = ContentType.objects.get_for_model(objects[0])
+    SearchToken.objects.filter(content_type=content_type, object_id__in=[obj.id for obj in objects]).delete()
+    SearchToken.objects.bulk_create([token for obj in objects for token in get_search_tokens(obj, content_type)], batch_size=1000)
+
+
+def searchIndexSignalHandler(sender, **kwargs):
+    """Signal handler for new/updated objects of indexed models or models indexed ones depend on"""
+    if kwargs.get("raw"):
+        return  # Don't index during fixture loading. Use rebuild_search_index command instead
+    instance = kwargs["instance"]
+    label = model_label(sender)
+    if label in SEARCH_INDEX:
+        update_search_index([instance])
+    if label in SEARCH_INDEX_RELATED:
+        update_search_index(SEARCH_INDEX_RELATED[label](instance))
+
+
+def searchIndexDeleteSignalHandler(sender, **kwargs):
+    """Signal handler for deleted objects of indexed models or models indexed ones depend on"""
+    instance = kwargs["instance"]
+    label = model_label(sender)
+    if label in SEARCH_INDEX:
+        SearchToken.objects.filter(content_type=ContentType.objects.get_for_model(sender), object_id=instance.id).delete()
+    if label in SEARCH_INDEX_RELATED:
+        try:
+            update_search_index(SEARCH_INDEX_RELATED[label](instance))
+        except apps.get_model("leads", "Lead").DoesNotExist:
+            pass  # Related object has been deleted as well
+
+
+@transaction.atomic
+def rebuild_search_index():
+    """Compute again the whole search index
+    @return: number of indexed objects"""
+    SearchToken.objects.all().delete()
+    n = 0
+    for label in SEARCH_INDEX:
+        content_type = ContentType.objects.get_for_model(apps.get_model(label))
+        objects = list(indexed_objects(label))
+        SearchToken.objects.bulk_create([token for obj in objects for token in get_search_tokens(obj, content_type)], batch_size=1000)
+        n += len(objects)
+    return n
+
+
+def search(words, labels):
+    """Search objects matching all words. Words match tokens that start with them.
+    Objects are ranked by the weight of matched tokens. Exact matches are worth twice prefix matches.
+    @param words: list of words
+    @param labels: list of models labels to search for
+    @return: dict with model label as key and list of matching objects ids, best ranked first, as value"""
+    result = dict((label, []) for label in labels)
+    tokens = []
+    for word in words:
+        tokens.extend(t for t in tokenize(word) if t not in tokens)
+    if not tokens:
+        return result
+    content_types = ContentType.objects.get_for_models(*[apps.get_model(label) for label in labels])
+    content_types = dict((content_type.id, model_label(model)) for model, content_type in content_types.items())
+    matches = SearchToken.objects.filter(content_type__in=content_types.keys())
+    matches = matches.filter(reduce(or_, [Q(token__startswith=token) for token in tokens]))
+    matches = matches.values_list("content_type", "object_id").order_by()
+    for i, token in enumerate(tokens):
+        matches = matches.annotate(**{"score_%s" % i: Max(Case(When(token=token, then=F("weight") * 2),
+                                                               When(token__startswith=token, then=F("weight")),
+                                                               default=Value(0), output_field=IntegerField()))})
+    matches = matches.filter(**dict(("score_%s__gt" % i, 0) for i in range(len(tokens))))
+    for match in sorted(matches, key=lambda m: (sum(m[2:]), m[1]), reverse=True):
+        result[content_types[match[0]]].append(match[1])
+    return result
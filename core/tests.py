@@ -12,9 +12,13 @@ from django.core.cache import cache
 from django.contrib.auth.models import Group, User
 from django.db import IntegrityError
 from django.test import RequestFactory
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import F, Sum
+from django.utils.translation import ugettext as _
 from django.contrib.messages.storage import default_storage
 from django.contrib.staticfiles.testing import StaticLiveServerTestCase
 from django.conf import settings
+from django.utils import formats
 
 
 # Third party modules
@@ -23,28 +27,51 @@ import permissions.utils as perm
 from workflows.models import Transition
 
 # Pydici modules
-from core.utils import monthWeekNumber, previousWeek, nextWeek, nextMonth, previousMonth, cumulateList, capitalize, get_parameter
-from core.models import GroupFeature, FEATURES, Parameter
+from core.utils import monthWeekNumber, previousWeek, nextWeek, nextMonth, previousMonth, cumulateList, capitalize, get_parameter, \
+    working_days, months_working_days, working_days_mask, month_days, daysOfMonth
+from core import utils as core_utils
+from core.models import GroupFeature, FEATURES, Parameter, SearchToken
+from core.search import rebuild_search_index, search as search_index
 from leads.utils import postSaveLead
 from leads.models import Lead
 from leads import learn as leads_learn
 from people.models import Consultant, ConsultantProfile, RateObjective
-from crm.models import Client, Subsidiary, BusinessBroker, Supplier
-from staffing.models import Mission, Staffing, Timesheet, FinancialCondition
+from crm.models import Client, Subsidiary, BusinessBroker, Supplier, Company
+from staffing.models import Mission, Staffing, Timesheet, FinancialCondition, TimesheetRollup, rateResolver
+from staffing import models as staffing_models
 from billing.models import SupplierBill, ClientBill
 from expense.models import Expense, ExpenseCategory, ExpensePayment
 from expense.default_workflows import install_expense_workflow
+from staffing.utils import pdcMatrix, gatherTimesheetData, saveTimesheetData, consultantRatesData, consultantMetrics
+from people.utils import getRateObjectives
 import pydici.settings
 
 # Python modules used by tests
 from urllib2 import urlparse
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 import os
 import os.path
 import sys
 from decimal import Decimal
 from subprocess import Popen, PIPE
 import json
+import csv
+
+
+def streaming_csv_rows(response):
+    """@return: rows of a streamed csv response as list of list of (encoded) strings"""
+    return list(csv.reader("".join(response.streaming_content).splitlines(), delimiter=";"))
+
+
+def run_with_and_without_numpy(module, check):
+    """Run check function with pure python implementation of module, then with numpy one if available
+    @param module: module with optional numpy implementation, selected by its HAVE_NUMPY flag"""
+    have_numpy = module.HAVE_NUMPY
+    try:
+        for module.HAVE_NUMPY in sorted(set([False, have_numpy])):
+            check()
+    finally:
+        module.HAVE_NUMPY = have_numpy
 
 
 TEST_USERNAME = "sre"
@@ -169,6 +196,30 @@ class SimpleTest(TestCase):
             self.failUnlessEqual(response.status_code, 200,
                                  "Failed to test url %s (got %s instead of 200" % (page, response.status_code))
 
+    def test_search_index(self):
+        self.assertEqual(rebuild_search_index(), SearchToken.objects.values("content_type", "object_id").distinct().count())
+        self.assertEqual(search_index(["wonder"], ["leads.Lead"]), {"leads.Lead": [1]})
+        self.assertEqual(search_index(["PROJECT", "small"], ["leads.Lead"]), {"leads.Lead": [3]})
+        self.assertEqual(search_index([u"sébastien"], ["people.Consultant"]), {"people.Consultant": [1]})
+        self.assertEqual(search_index(["123456a"], ["staffing.Mission", "leads.Lead"]), {"staffing.Mission": [1], "leads.Lead": [1]})
+        # Incremental update and ranking
+        lead = Lead.objects.get(id=1)
+        lead.name = "interesting stuff"
+        lead.save()
+        self.assertEqual(search_index(["interesting"], ["leads.Lead"]), {"leads.Lead": [1, 3]})
+        company = Company.objects.get(id=2)
+        company.name = "Acme"
+        company.save()
+        self.assertEqual(search_index(["acm"], ["crm.Company", "leads.Lead"]), {"crm.Company": [2], "leads.Lead": [2]})
+        lead.tags.add("foobar")
+        self.assertEqual(search_index(["foobar"], ["leads.Lead"]), {"leads.Lead": [1]})
+        ClientBill.objects.get(bill_id="A101010").delete()
+        self.assertEqual(search_index(["a101010"], ["billing.ClientBill"]), {"billing.ClientBill": []})
+        self.client.login(username=TEST_USERNAME, password=TEST_PASSWORD)
+        response = self.client.get(PREFIX + "/search", {"q": "acme"})
+        self.assertEqual(response.context["leads"], [Lead.objects.get(id=2)])
+        self.assertEqual(set(response.context["missions"]), set(Mission.objects.filter(lead_id=2)))
+
     def test_redirect(self):
         self.client.login(username=TEST_USERNAME, password=TEST_PASSWORD)
         response = self.client.get(PREFIX + "/help")
@@ -215,6 +266,21 @@ class UtilsTest(TestCase):
         for weekNum, weekDate in dates:
             self.assertEqual(weekNum, monthWeekNumber(weekDate))
 
+    def test_working_days(self):
+        holidays = [date(2011, 4, 25), date(2011, 5, 1), date(2011, 5, 2), date(2011, 12, 25)]
+        months = [date(2011, m, 1) for m in range(1, 13)]
+        expected = [21, 20, 23, 20, 21, 22, 21, 23, 22, 21, 22, 22]
+
+        def check():
+            self.assertEqual([working_days(m, holidays) for m in months], expected)
+            self.assertEqual(months_working_days(months, holidays), dict(zip(months, expected)))
+            self.assertEqual(working_days_mask(daysOfMonth(date(2011, 5, 1), week=1), holidays), [False])
+            self.assertEqual(working_days_mask(daysOfMonth(date(2011, 5, 1), week=2), holidays),
+                             [False, True, True, True, True, False, False])
+        run_with_and_without_numpy(core_utils, check)
+        self.assertEqual(month_days(date(2012, 2, 1)), 29)
+        self.assertEqual(len(daysOfMonth(date(2011, 4, 12))), 30)
+
     def test_previousWeek(self):
         # Previous week first day, week day
         dates = ((date(2011, 3, 28), date(2011, 4, 1)),
@@ -274,6 +340,25 @@ class UtilsTest(TestCase):
         p.save()
         self.assertEquals(get_parameter(p.key), p.value)
 
+    def test_request_memo(self):
+        Parameter(key="testM", value="valueM", type="TEXT", desc="test").save()
+        core_utils.request_memo_start()
+        try:
+            for i in range(3):
+                self.assertEqual(get_parameter("testM"), "valueM")
+            self.assertEqual(core_utils.request_memo_stats(), (2, 1))
+            # Data change during request must clear memo
+            p = Parameter.objects.get(key="testM")
+            p.value = "newValueM"
+            p.save()
+            self.assertEqual(get_parameter("testM"), "newValueM")
+        finally:
+            self.assertEqual(core_utils.request_memo_stop(), (2, 2))
+        # Memo is not used outside requests
+        self.assertEqual(get_parameter("testM"), "newValueM")
+        self.assertEqual(core_utils.request_memoized("foo", lambda: "bar"), "bar")
+        self.assertEqual(core_utils.request_memo_stats(), (2, 2))
+
 
 class StaffingViewsTest(TestCase):
     fixtures = PYDICI_FIXTURES
@@ -344,6 +429,105 @@ class StaffingViewsTest(TestCase):
                                        [11.9, 18.7], [4.3, 13],
                                        [915.4, 935, 927.3], [860, 928.6, 910.5]])
 
+    def test_missions_report(self):
+        self.client.login(username=TEST_USERNAME, password=TEST_PASSWORD)
+        today = date.today()
+        consultant = Consultant.objects.get(id=1)
+        mission = Mission(subsidiary_id=1, nature="HOLIDAYS", probability=100)
+        mission.save()
+        Timesheet.objects.create(mission=mission, consultant=consultant, working_date=previousMonth(today), charge=1)
+        Timesheet.objects.create(mission=mission, consultant=consultant, working_date=today, charge=0.5)
+        if today < nextMonth(today) - timedelta(1):
+            # Timesheet after today is ignored, even in current month
+            Timesheet.objects.create(mission=mission, consultant=consultant, working_date=today + timedelta(1), charge=1)
+        response = self.client.get(urlresolvers.reverse("holidays-pivotable-all"))
+        self.assertEqual(response.status_code, 200)
+        data = [d for d in json.loads(response.context["data"]) if d[_("consultant")] == consultant.name]
+        expected = Timesheet.objects.filter(consultant=consultant, mission__nature="HOLIDAYS", working_date__lte=today).aggregate(Sum("charge"))
+        self.assertEqual(sum(d[_("days")] for d in data), expected.values()[0])
+        self.assertIn({"month": today.strftime("%Y-%m"), "days": 0.5},
+                      [{"month": d[_("month")], "days": d[_("days")]} for d in data])
+
+    def test_detailed_csv_timesheet(self):
+        self.client.login(username=TEST_USERNAME, password=TEST_PASSWORD)
+        mission = Mission.objects.get(id=2)
+        c1 = Consultant.objects.get(id=1)
+        c2 = Consultant.objects.get(id=2)
+        Timesheet.objects.create(mission=mission, consultant=c2, working_date=date(2010, 8, 2), charge=2)
+        Staffing.objects.create(mission=mission, consultant=c2, staffing_date=date(2010, 9, 1), charge=3)
+        FinancialCondition.objects.create(mission=mission, consultant=c1, daily_rate=500)
+        response = self.client.get(urlresolvers.reverse("staffing.views.detailed_csv_timesheet", args=[2010, 8]))
+        self.assertEqual(response.status_code, 200)
+        rows = streaming_csv_rows(response)
+        self.assertEqual(rows[0], ["2010-08-01"])
+        self.assertEqual(len(rows[1]), 13)
+        self.assertEqual(rows[1][0], _("Lead").encode("ISO-8859-15"))
+        self.assertEqual(rows[1][-1], _("Days to be done").encode("ISO-8859-15"))
+        # One row for each mission and consultant with timesheet or staffing
+        self.assertEqual(len(rows), 2 + 4)
+        rows = dict(((row[4], row[7]), row[8:]) for row in rows[2:])  # Key is (mission id, consultant)
+        n = formats.number_format
+        self.assertEqual(rows[(mission.mission_id(), c1.name.encode("ISO-8859-15"))], ["500", "0", n(4.5), n(1.98), "0"])
+        self.assertEqual(rows[(mission.mission_id(), c2.name.encode("ISO-8859-15"))], ["0", "0", "0", n(2.0), n(3.0)])
+
+    def test_mission_csv_timesheet(self):
+        self.client.login(username=TEST_USERNAME, password=TEST_PASSWORD)
+        mission = Mission.objects.get(id=2)
+        c1 = Consultant.objects.get(id=1)
+        c2 = Consultant.objects.get(id=2)
+        Timesheet.objects.create(mission=mission, consultant=c2, working_date=date(2010, 8, 2), charge=2)
+        response = self.client.get(urlresolvers.reverse("staffing.views.mission_timesheet", args=[mission.id]), {"csv": 1})
+        self.assertEqual(response.status_code, 200)
+        rows = streaming_csv_rows(response)
+        # Each month with timesheet has a title, two day headers, one row per consultant with timesheet and an empty row
+        self.assertEqual(len(rows), 5 + 6 + 5)
+        titles = [row[0] for row in rows if len(row) == 1 and row[0]]
+        self.assertEqual(titles, [("%s - %s" % (mission.full_name(), formats.date_format(month, format="YEAR_MONTH_FORMAT"))).encode("ISO-8859-15")
+                                  for month in (date(2010, 7, 1), date(2010, 8, 1), date(2010, 9, 1))])
+        august = rows[5:11]
+        self.assertEqual(august[1], [""] + [str(d) for d in range(1, 32)])
+        self.assertEqual(august[2][0], _("Consultants").encode("ISO-8859-15"))
+        self.assertEqual(august[2][-1], _("total").encode("ISO-8859-15"))
+        n = formats.number_format
+        consultantRows = dict((row[0], row[1:]) for row in august[3:5])
+        self.assertEqual(consultantRows[c2.name.encode("ISO-8859-15")], ["", n(2.0)] + [""] * 29 + [n(2.0)])
+        self.assertEqual(consultantRows[c1.name.encode("ISO-8859-15")][-1], n(1.98))
+        self.assertEqual(august[5], [""])
+        september = rows[11:]
+        self.assertEqual(september[1], [""] + [str(d) for d in range(1, 31)])
+        self.assertEqual(len(september[2]), len(august[2]))  # Padding aligns total column
+        self.assertEqual(september[3][0], c1.name.encode("ISO-8859-15"))
+        self.assertEqual(september[3][-1], n(5.0))
+
+    def test_financial_control(self):
+        self.client.login(username=TEST_USERNAME, password=TEST_PASSWORD)
+        month = date(2010, 8, 1)
+        mission = Mission.objects.get(id=2)
+        c1 = Consultant.objects.get(id=1)
+        c2 = Consultant.objects.get(id=2)
+        Timesheet.objects.create(mission=mission, consultant=c2, working_date=date(2010, 8, 2), charge=2)
+        Staffing.objects.create(mission=mission, consultant=c2, staffing_date=month, charge=3)
+        FinancialCondition.objects.create(mission=mission, consultant=c1, daily_rate=500)
+        response = self.client.get(urlresolvers.reverse("core.views.financialControl", args=["201008", "201008"]))
+        self.assertEqual(response.status_code, 200)
+        rows = streaming_csv_rows(response)
+        header = rows[0]
+        self.assertEqual(len(header), 35)
+        self.assertEqual((header[0], header[-1]), ("FiscalYear", "EndDate"))
+        rows = [dict(zip(header, row)) for row in rows[1:]]
+        # A done and a forecast row for each mission and consultant
+        self.assertEqual(len(rows), 2 * 4)
+        done = Timesheet.objects.filter(working_date__gte=month, working_date__lt=nextMonth(month))
+        done = done.values_list("mission", "consultant").annotate(Sum("charge")).order_by()
+        self.assertEqual(dict(((r["MissionId"], r["Trigramme"]), r["QuantityInDays"]) for r in rows if r["BudgetType"] == "done"),
+                         dict(((Mission.objects.get(id=m).mission_id(), Consultant.objects.get(id=c).trigramme), str(charge))
+                              for m, c, charge in done))
+        rows = dict(((r["MissionId"], r["Trigramme"], r["BudgetType"]), r) for r in rows)
+        row = rows[(mission.mission_id(), c1.trigramme, "done")]
+        self.assertEqual((row["DailyRate"], row["QuantityInEuros"], row["StartDate"], row["EndDate"]), ("500", "990.0", "2010-08-11", "2010-08-16"))
+        row = rows[(mission.mission_id(), c2.trigramme, "forecast")]
+        self.assertEqual((row["QuantityInDays"], row["StartDate"], row["EndDate"]), ("3.0", "2010-08-01", "2010-08-01"))
+
 
 class CrmModelTest(TestCase):
     fixtures = PYDICI_FIXTURES
@@ -385,6 +569,18 @@ class CrmModelTest(TestCase):
         c = Consultant.objects.get(trigramme="SRE")
         self.assertQuerysetEqual(c.pending_actions(), [])
 
+    def test_rate_objectives(self):
+        c = Consultant.objects.get(trigramme="SRE")
+        RateObjective.objects.create(consultant=c, start_date=date(2014, 1, 1), rate=500, rate_type="DAILY_RATE")
+        RateObjective.objects.create(consultant=c, start_date=date(2014, 6, 1), rate=600, rate_type="DAILY_RATE")
+        RateObjective.objects.create(consultant=c, start_date=date(2014, 3, 1), rate=80, rate_type="PROD_RATE")
+        dates = [date(2013, 12, 1), date(2014, 1, 1), date(2014, 5, 1), date(2014, 7, 1)]
+        for rate_type in ("DAILY_RATE", "PROD_RATE"):
+            rates = getRateObjectives(Consultant.objects.all(), dates, rate_type=rate_type)
+            for d in dates:
+                objective = c.getRateObjective(workingDate=d, rate_type=rate_type)
+                self.assertEqual(rates.get((c.id, d)), objective.rate if objective else None)
+
 
 class CrmViewsTest(TestCase):
     fixtures = PYDICI_FIXTURES
@@ -618,6 +814,308 @@ class StaffingModelTest(TestCase):
         mission.save()
         self.assertEqual(mission.staffing_set.count(), 0)
 
+    def test_mission_ids(self):
+        missions = list(Mission.objects.all())
+        Mission(lead=missions[0].lead, nature="PROD", subsidiary_id=1).save()
+        missions = list(Mission.objects.select_related("lead"))
+        self.assertEqual(Mission.mission_ids(missions), dict((m.id, m.mission_id()) for m in missions))
+
+    def test_staffing_bulk_upsert(self):
+        missions = Mission.objects.filter(id__in=(1, 2))
+        consultants = Consultant.objects.filter(id__in=(1, 2))
+        dates = [date(2014, 3, 1), date(2014, 4, 12)]
+        Staffing.objects.filter(staffing_date__in=(date(2014, 3, 1), date(2014, 4, 1))).delete()
+        Staffing.objects.create(mission_id=1, consultant_id=1, staffing_date=date(2014, 3, 1), charge=3)
+        self.assertEqual(Staffing.bulk_upsert(missions, consultants, dates, update=False, charge=1), (7, 0))
+        self.assertEqual(Staffing.objects.get(mission_id=1, consultant_id=1, staffing_date=date(2014, 3, 1)).charge, 3)
+        self.assertEqual(Staffing.bulk_upsert(missions, consultants, dates, charge=2, comment="mass"), (0, 8))
+        staffings = Staffing.objects.filter(mission__in=missions, consultant__in=consultants, staffing_date__in=(date(2014, 3, 1), date(2014, 4, 1)))
+        self.assertEqual(set(staffings.values_list("charge", "comment")), set([(2, "mass")]))
+
+    def test_pdc_matrix(self):
+        consultant = Consultant.objects.get(id=1)
+        month = date(2014, 3, 1)
+        won = Mission.objects.get(id=1)
+        won.probability = 100
+        won.save()
+        other = Mission.objects.get(id=2)
+        other.probability = 50
+        other.save()
+        Staffing.objects.filter(consultant=consultant, staffing_date=month).delete()
+        Staffing.objects.create(mission=won, consultant=consultant, staffing_date=month, charge=4)
+        Staffing.objects.create(mission=other, consultant=consultant, staffing_date=month, charge=2)
+        for projection, expected in (("none", 4), ("balanced", 5), ("full", 6)):
+            charges, companies = pdcMatrix(Consultant.objects.filter(id=1), [month], projection)
+            self.assertEqual(sum(charges[(consultant.id, month)].values()), expected)
+        self.assertIn(won.lead.client.organisation.company, companies[consultant.id])
+
+    def test_save_timesheet_data(self):
+        consultant = Consultant.objects.get(id=1)
+        missions = [Mission.objects.get(id=1), Mission.objects.get(id=2)]
+        month = date(2014, 3, 1)
+        data = {"charge_1_3": 1, "charge_1_4": 0.5, "charge_2_4": 0.5, "lunch_ticket_3": True}
+        saveTimesheetData(consultant, month, data, {})
+        timesheetData, timesheetTotal, warning = gatherTimesheetData(consultant, missions, month)
+        self.assertEqual(timesheetData, data)
+        self.assertEqual(timesheetTotal, {1: 1.5, 2: 0.5, "ticket": 1})
+        self.assertEqual(warning[2:4], [0, 0])
+        # Update, delete and create at once
+        oldData = timesheetData
+        data = {"charge_1_3": 0.5, "charge_1_4": 0, "charge_2_4": 0.5, "charge_2_5": 1, "lunch_ticket_3": False, "lunch_ticket_5": True}
+        saveTimesheetData(consultant, month, data, oldData)
+        timesheetData, timesheetTotal, warning = gatherTimesheetData(consultant, missions, month)
+        self.assertEqual(timesheetData, {"charge_1_3": 0.5, "charge_2_4": 0.5, "charge_2_5": 1, "lunch_ticket_5": True})
+        self.assertEqual(TimesheetRollup.objects.get(consultant=consultant, mission_id=1, month=month).charge, 0.5)
+        self.assertEqual(TimesheetRollup.objects.get(consultant=consultant, mission_id=2, month=month).charge, 1.5)
+
+    def test_save_timesheet_data_many_rows(self):
+        consultant = Consultant.objects.get(id=1)
+        month = date(2014, 3, 1)
+        lead = Mission.objects.get(id=1).lead
+        for i in range(15):
+            Mission(lead=lead, nature="PROD", subsidiary_id=1).save()
+        missions = list(Mission.objects.all())
+        Timesheet.objects.filter(consultant=consultant, working_date__gte=month, working_date__lt=date(2014, 4, 1)).delete()
+        data = dict(("charge_%s_%s" % (m.id, d), 1) for m in missions for d in range(1, 32))
+        self.assertGreater(len(data), 999 / 2)  # More than default parameters limit of sqlite < 3.32 for a single update
+        saveTimesheetData(consultant, month, data, {})
+        oldData = gatherTimesheetData(consultant, missions, month)[0]
+        self.assertEqual(oldData, data)
+        data = dict((k, 0.5) for k in data)
+        saveTimesheetData(consultant, month, data, oldData)
+        self.assertEqual(gatherTimesheetData(consultant, missions, month)[0], data)
+        oldData = data
+        data = dict((k, 0) for k in data)
+        saveTimesheetData(consultant, month, data, oldData)
+        self.assertFalse(Timesheet.objects.filter(consultant=consultant, working_date__gte=month, working_date__lt=date(2014, 4, 1)).exists())
+        self.assertFalse(TimesheetRollup.objects.filter(consultant=consultant, month=month).exists())
+
+    def test_done_and_forecasted_works(self):
+        current_month = date.today().replace(day=1)
+        missions = list(Mission.objects.filter(id__in=(1, 2)))
+        Timesheet.objects.filter(mission__in=missions).delete()
+        Staffing.objects.filter(mission__in=missions).delete()
+        FinancialCondition.objects.filter(mission__in=missions).delete()
+        FinancialCondition.objects.create(mission_id=1, consultant_id=1, daily_rate=500)
+        Timesheet.objects.create(mission_id=1, consultant_id=1, working_date=previousMonth(current_month), charge=2)
+        Timesheet.objects.create(mission_id=1, consultant_id=1, working_date=current_month, charge=1)
+        Timesheet.objects.create(mission_id=1, consultant_id=2, working_date=current_month, charge=1)
+        Staffing.objects.create(mission_id=1, consultant_id=1, staffing_date=current_month, charge=5)
+        Staffing.objects.create(mission_id=1, consultant_id=1, staffing_date=nextMonth(current_month), charge=3)
+        self.assertEqual(Mission.done_works(missions), {1: (4, 1500), 2: (0, 0)})
+        self.assertEqual(Mission.forecasted_works(missions), {1: (7, 3500), 2: (0, 0)})
+        cache.clear()
+        self.assertEqual(Mission.objects.get(id=1).done_work(), (4, 1500))
+        self.assertEqual(Mission.objects.get(id=1).forecasted_work(), (7, 3500))
+        Mission.objects.filter(id=1).update(price=10)
+        missions = list(Mission.objects.filter(id__in=(1, 2)))
+        self.assertEqual(Mission.margins(missions), {1: 8.5, 2: 0})
+        self.assertEqual(Mission.margins(missions, mode="target"), {1: 5, 2: 0})
+        self.assertEqual(Mission.objects.get(id=1).margin(mode="target"), 5)
+
+    def test_objective_margins(self):
+        missions = list(Mission.objects.filter(id__in=(1, 2)))
+        Timesheet.objects.filter(mission__in=missions).delete()
+        Staffing.objects.filter(mission__in=missions).delete()
+        FinancialCondition.objects.filter(mission__in=missions).delete()
+        consultant = Consultant.objects.get(id=1)
+        subcontractor = Consultant.objects.get(id=2)
+        subcontractor.subcontractor = True
+        subcontractor.save()
+        RateObjective.objects.filter(consultant=consultant).delete()
+        RateObjective.objects.create(consultant=consultant, start_date=date(2014, 1, 1), rate=400, rate_type="DAILY_RATE")
+        RateObjective.objects.create(consultant=consultant, start_date=date(2014, 3, 1), rate=450, rate_type="DAILY_RATE")
+        FinancialCondition.objects.create(mission_id=1, consultant=consultant, daily_rate=500)
+        FinancialCondition.objects.create(mission_id=1, consultant=subcontractor, daily_rate=500, bought_daily_rate=300)
+        Timesheet.objects.create(mission_id=1, consultant=consultant, working_date=date(2014, 2, 3), charge=2)
+        Timesheet.objects.create(mission_id=1, consultant=consultant, working_date=date(2014, 3, 3), charge=1)
+        Timesheet.objects.create(mission_id=1, consultant=consultant, working_date=date(2014, 3, 20), charge=1)
+        Timesheet.objects.create(mission_id=1, consultant=subcontractor, working_date=date(2014, 3, 3), charge=3)
+        Staffing.objects.create(mission_id=2, consultant=consultant, staffing_date=date(2014, 3, 1), charge=5)
+
+        def check():
+            self.assertEqual(Mission.objective_margins(missions), {1: {consultant: 300, subcontractor: 600}, 2: {consultant: 0}})
+            self.assertEqual(Mission.objective_margins(missions, startDate=date(2014, 3, 1)), {1: {consultant: 100, subcontractor: 600}, 2: {consultant: 0}})
+            self.assertEqual(Mission.objective_margins(missions, endDate=date(2014, 3, 10)), {1: {consultant: 250, subcontractor: 600}, 2: {consultant: 0}})
+        run_with_and_without_numpy(staffing_models, check)
+        self.assertEqual(Mission.objects.get(id=1).objectiveMargin(), {consultant: 300, subcontractor: 600})
+
+    def test_consultant_rates_data(self):
+        consultant = Consultant.objects.get(id=1)
+        month = date(2014, 3, 1)
+        Timesheet.objects.filter(consultant=consultant).delete()
+        RateObjective.objects.filter(consultant=consultant).delete()
+        RateObjective.objects.create(consultant=consultant, start_date=month, rate=500, rate_type="DAILY_RATE")
+        FinancialCondition.objects.filter(consultant=consultant).delete()
+        FinancialCondition.objects.create(mission_id=1, consultant=consultant, daily_rate=600)
+        FinancialCondition.objects.create(mission_id=2, consultant=consultant, daily_rate=300)
+        Mission.objects.filter(id__in=(1, 2)).update(nature="PROD")
+        Mission.objects.filter(id=3).update(nature="NONPROD")
+        Timesheet.objects.create(mission_id=1, consultant=consultant, working_date=previousMonth(month), charge=1)
+        Timesheet.objects.create(mission_id=1, consultant=consultant, working_date=month, charge=2)
+        Timesheet.objects.create(mission_id=2, consultant=consultant, working_date=month, charge=1)
+        Timesheet.objects.create(mission_id=3, consultant=consultant, working_date=month, charge=1)
+        self.assertEqual(consultantRatesData(consultant, previousMonth(month), nextMonth(month)),
+                         [(previousMonth(month), 600, 1, None, None), (month, 500, 0.75, 500, None)])
+        # Days with a null daily rate are valued
+        FinancialCondition.objects.create(mission_id=3, consultant=consultant, daily_rate=0)
+        self.assertEqual(consultantRatesData(consultant, month, nextMonth(month)), [(month, 375, 0.75, 500, None)])
+
+    def test_consultant_metrics(self):
+        consultant = Consultant.objects.get(id=1)
+        today = date.today()
+        month = today.replace(day=1)
+        Timesheet.objects.filter(consultant=consultant).delete()
+        FinancialCondition.objects.filter(consultant=consultant).delete()
+        FinancialCondition.objects.create(mission_id=1, consultant=consultant, daily_rate=600)
+        Mission.objects.filter(id__in=(1, 2)).update(nature="PROD")
+        Mission.objects.filter(id=3).update(nature="NONPROD")
+        Timesheet.objects.create(mission_id=1, consultant=consultant, working_date=previousMonth(month), charge=1)
+        Timesheet.objects.create(mission_id=1, consultant=consultant, working_date=month, charge=2)
+        Timesheet.objects.create(mission_id=2, consultant=consultant, working_date=month, charge=1)
+        Timesheet.objects.create(mission_id=3, consultant=consultant, working_date=month, charge=1)
+        metrics = consultantMetrics(consultant)
+        self.assertEqual(metrics["done_days"], consultant.done_days())
+        self.assertEqual(metrics["forecasted"], consultant.forecasted_days())
+        self.assertEqual(metrics["month_turnover"], consultant.getTurnover(month))
+        self.assertEqual(metrics["last_month_turnover"], 600 if today.day > 1 else 0)
+        self.assertEqual(metrics["daily_rate"], 600)
+        self.assertEqual(metrics["prod_rate"], 75)
+        self.assertEqual(metrics["daily_rate_objective"], None)
+        # Cached metrics are invalidated by rate objectives and mission nature changes
+        default_cache = core_utils.cache
+        core_utils.cache = LocMemCache("test_consultant_metrics", {})
+        try:
+            consultantMetrics(consultant)
+            RateObjective.objects.filter(consultant=consultant).delete()
+            RateObjective.objects.create(consultant=consultant, start_date=previousMonth(month), rate=500, rate_type="DAILY_RATE")
+            self.assertEqual(consultantMetrics(consultant)["daily_rate_objective"], 500)
+            mission = Mission.objects.get(id=3)
+            mission.nature = "PROD"
+            mission.save()
+            self.assertEqual(consultantMetrics(consultant)["prod_rate"], 100)
+        finally:
+            core_utils.cache = default_cache
+
+    def test_rate_resolver(self):
+        mission = Mission.objects.get(id=1)
+        consultant = Consultant.objects.get(id=1)
+        FinancialCondition.objects.filter(mission=mission, consultant=consultant).delete()
+        self.assertEqual(rateResolver.get(mission.id, consultant.id), (0, 0))
+        FinancialCondition.objects.create(mission=mission, consultant=consultant, daily_rate=800, bought_daily_rate=600)
+        self.assertEqual(rateResolver.get(mission.id, consultant.id), (800, 600))
+        self.assertEqual(rateResolver.get_many([(mission.id, consultant.id), (0, 0)]), {(mission.id, consultant.id): (800, 600), (0, 0): (0, 0)})
+        self.assertEqual(rateResolver.mission_rates(mission.id)[consultant.id], (800, 600))
+        self.assertEqual(rateResolver.mission_rates(0), {})
+        self.assertEqual(mission.consultant_rates()[consultant], (800, 600))
+
+    def test_timesheet_rollup(self):
+        mission = Mission.objects.get(id=1)
+        consultant = Consultant.objects.get(id=1)
+        month = date(2014, 3, 1)
+        TimesheetRollup.rebuild()
+        FinancialCondition.objects.filter(mission=mission, consultant=consultant).delete()
+        t1 = Timesheet.objects.create(mission=mission, consultant=consultant, working_date=month, charge=1)
+        Timesheet.objects.create(mission=mission, consultant=consultant, working_date=month.replace(day=3), charge=0.5)
+        rollup = TimesheetRollup.objects.get(mission=mission, consultant=consultant, month=month)
+        self.assertEqual(rollup.charge, 1.5)
+        self.assertEqual(rollup.amount, 0)  # No rate yet
+        self.assertEqual(rollup.nature, mission.nature)
+        FinancialCondition.objects.create(mission=mission, consultant=consultant, daily_rate=500)
+        rollup = TimesheetRollup.objects.get(id=rollup.id)
+        self.assertEqual(rollup.amount, 750)
+        t1.delete()
+        rollup = TimesheetRollup.objects.get(id=rollup.id)
+        self.assertEqual(rollup.charge, 0.5)
+        self.assertEqual(rollup.amount, 250)
+        # Last financial condition wins, like rate resolver
+        FinancialCondition.objects.create(mission=mission, consultant=consultant, daily_rate=600)
+        self.assertEqual(TimesheetRollup.objects.get(id=rollup.id).amount, 300)
+        t2 = Timesheet.objects.create(mission=mission, consultant=consultant, working_date=month.replace(day=4), charge=1)
+        self.assertEqual(TimesheetRollup.objects.get(id=rollup.id).amount, 900)
+        # Timesheet moved to another mission updates both rollups
+        other_charge = Timesheet.objects.filter(mission_id=2, consultant=consultant, working_date__month=3, working_date__year=2014).aggregate(Sum("charge")).values()[0] or 0
+        t2.mission_id = 2
+        t2.save()
+        self.assertEqual(TimesheetRollup.objects.get(id=rollup.id).charge, 0.5)
+        self.assertEqual(TimesheetRollup.objects.get(mission_id=2, consultant=consultant, month=month).charge, other_charge + 1)
+        # Rebuild must give the same result than incremental updates
+        data = list(TimesheetRollup.objects.values_list("consultant", "mission", "month", "charge", "amount").order_by("consultant", "mission", "month"))
+        TimesheetRollup.rebuild()
+        self.assertEqual(data, list(TimesheetRollup.objects.values_list("consultant", "mission", "month", "charge", "amount").order_by("consultant", "mission", "month")))
+
+    def test_cacheable_dependencies(self):
+        mission = Mission.objects.get(id=1)
+        consultant = Consultant.objects.get(id=1)
+        month = date(2014, 3, 1)
+        TimesheetRollup.rebuild()
+        default_cache = core_utils.cache
+        core_utils.cache = LocMemCache("test_cacheable", {})
+        try:
+            done_days = mission.done_work()[0]
+            Timesheet.objects.filter(mission=mission).update(charge=F("charge") + 1)  # No signal, cached data is used
+            TimesheetRollup.rebuild()
+            self.assertEqual(mission.done_work()[0], done_days)
+            Timesheet.objects.create(mission=mission, consultant=consultant, working_date=month, charge=1)
+            done_days = Mission.done_works([mission])[mission.id][0]
+            self.assertEqual(mission.done_work()[0], done_days)
+            self.assertEqual(Mission.objects.get(id=2).done_work(), Mission.done_works([Mission.objects.get(id=2)])[2])
+            # Bulk timesheet update must invalidate cache as well
+            saveTimesheetData(consultant, month, {"charge_1_4": 1}, {})
+            self.assertEqual(mission.done_work()[0], done_days + 1)
+            # Timesheet moved to another mission invalidates both missions
+            other_mission = Mission.objects.get(id=2)
+            other_done_days = other_mission.done_work()[0]
+            timesheet = Timesheet.objects.filter(mission=mission, working_date=month).get(consultant=consultant)
+            timesheet.mission = other_mission
+            timesheet.save()
+            self.assertEqual(mission.done_work()[0], done_days)
+            self.assertEqual(other_mission.done_work()[0], other_done_days + 1)
+            # Lead and client depend on timesheets of their missions only
+            mission.billing_mode = "TIME_SPENT"
+            mission.save()
+            FinancialCondition.objects.create(mission=mission, consultant=consultant, daily_rate=1234)
+            lead = mission.lead
+            to_bill = lead.still_to_be_billed()
+            margin = lead.client.objectiveMargin()
+            client_generation_key = core_utils.cacheable_generation_key("staffing.Timesheet", "mission__lead__client", lead.client_id)
+            client_generation = core_utils.get_version_stamp(client_generation_key)
+            other_to_bill = other_mission.lead.still_to_be_billed()
+            Timesheet.objects.create(mission=mission, consultant=consultant, working_date=month + timedelta(1), charge=2)
+            self.assertNotEqual(lead.still_to_be_billed(), to_bill)
+            self.assertNotEqual(core_utils.get_version_stamp(client_generation_key), client_generation)
+            self.assertEqual(other_mission.lead.still_to_be_billed(), other_to_bill)
+            to_bill, margin = lead.still_to_be_billed(), lead.client.objectiveMargin()
+            core_utils.cache.clear()
+            self.assertEqual(lead.still_to_be_billed(), to_bill)
+            self.assertEqual(lead.client.objectiveMargin(), margin)
+        finally:
+            core_utils.cache = default_cache
+
+
+    def test_model_version_stamps(self):
+        consultant = Consultant.objects.get(id=1)
+        month = date(2014, 3, 1)
+        default_cache = core_utils.cache
+        core_utils.cache = LocMemCache("test_model_version", {})
+        try:
+            def check(model, change):
+                version = core_utils.get_version_stamp(core_utils.model_version_key(model))
+                change()
+                self.assertNotEqual(core_utils.get_version_stamp(core_utils.model_version_key(model)), version)
+            bill = ClientBill.objects.filter(state="1_SENT")[0]
+            bill.due_date = bill.due_date + timedelta(1)  # In place edit, same count and amount
+            check(ClientBill, bill.save)
+            check(Timesheet, lambda: saveTimesheetData(consultant, month, {"charge_1_4": 1}, {}))
+            check(Staffing, lambda: Staffing.bulk_upsert(Mission.objects.filter(id=1), [consultant], [month], charge=1))
+            mission = Mission.objects.get(id=1)
+            check(Mission, mission.save)
+            lead = Lead.objects.get(id=1)
+            lead.state = "LOST"
+            check(Lead, lead.save)
+        finally:
+            core_utils.cache = default_cache
+
 
 class BillingModelTest(TransactionTestCase):
     """Test Billing application model"""
@@ -665,6 +1163,70 @@ class BillingModelTest(TransactionTestCase):
 
 
 
+class BillingViewsTest(TestCase):
+    fixtures = PYDICI_FIXTURES
+
+    def setUp(self):
+        setup_test_user_features()
+
+    def test_bill_review(self):
+        self.client.login(username=TEST_USERNAME, password=TEST_PASSWORD)
+        Lead.objects.filter(id__in=(1, 3)).update(state="WON")
+        ClientBill.objects.filter(lead_id=3).delete()
+        for lead_id in (1, 3):
+            mission = Mission.objects.create(lead_id=lead_id, subsidiary_id=1, nature="PROD", probability=100)
+            Timesheet.objects.create(mission=mission, consultant_id=1, working_date=date.today(), charge=1)
+        response = self.client.get(urlresolvers.reverse("billing.views.bill_review"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context["leads_without_bill"]), [Lead.objects.get(id=3)])  # Lead 1 already has a bill
+        sent_bills = ClientBill.objects.filter(state="1_SENT", due_date__lte=date.today())
+        self.assertEqual(response.context["overdue_bills_total"], sum(b.amount for b in sent_bills))
+        self.assertEqual(response.context["overdue_bills_total_with_vat"], sum(b.amount_with_vat for b in sent_bills if b.amount_with_vat))
+
+
+    def test_bill_payment_delay(self):
+        self.client.login(username=TEST_USERNAME, password=TEST_PASSWORD)
+        bills = ClientBill.objects.filter(state="2_PAID", lead__paying_authority__isnull=True)
+        delays = sorted(b.payment_delay() for b in bills)
+        response = self.client.get(urlresolvers.reverse("billing.views.bill_payment_delay"), {"details": 1})
+        self.assertEqual(response.status_code, 200)
+        company, average, median, percentile, last_year = response.context["direct_delays"][0]
+        self.assertEqual(company, bills[0].lead.client.organisation.company)
+        self.assertEqual(average, sum(delays) / len(delays))
+        self.assertEqual(median, delays[len(delays) / 2])
+        self.assertEqual(percentile, delays[-1])
+        self.assertEqual(last_year, None)  # Fixture bills are older than one year
+        bill = bills[0]
+        ClientBill.objects.filter(id=bill.id).update(creation_date=date.today() - timedelta(10), payment_date=date.today())
+        response = self.client.get(urlresolvers.reverse("billing.views.bill_payment_delay"))
+        company, average, median, percentile, last_year = response.context["direct_delays"][0]
+        self.assertEqual(last_year, 10)
+        self.assertEqual((median, percentile), (None, None))
+
+    def test_pre_billing(self):
+        self.client.login(username=TEST_USERNAME, password=TEST_PASSWORD)
+        month = date(2014, 3, 1)
+        lead = Lead.objects.get(id=1)
+        other_subsidiary = Subsidiary.objects.create(name="other company", code="O")
+        c1 = Consultant.objects.get(id=1)
+        c2 = Consultant.objects.get(id=2)
+        c2.company = other_subsidiary
+        c2.save()
+        mission = Mission.objects.create(lead=lead, subsidiary=lead.subsidiary, nature="PROD", billing_mode="TIME_SPENT", probability=100)
+        FinancialCondition.objects.create(mission=mission, consultant=c1, daily_rate=500)
+        FinancialCondition.objects.create(mission=mission, consultant=c2, daily_rate=800)
+        Timesheet.objects.create(mission=mission, consultant=c1, working_date=month, charge=2)
+        Timesheet.objects.create(mission=mission, consultant=c2, working_date=month, charge=1)
+        Timesheet.objects.create(mission=mission, consultant=c2, working_date=month.replace(day=3), charge=0.5)
+        response = self.client.get(urlresolvers.reverse("billing.views.pre_billing", args=[2014, 3]))
+        self.assertEqual(response.status_code, 200)
+        lead_data = dict(response.context["time_spent_billing"])[lead]
+        self.assertEqual(lead_data[0], 2200)
+        self.assertEqual(lead_data[1][mission], [2200, [[c2, 1.5, 800, 1200], [c1, 2, 500, 1000]]])
+        self.assertEqual(response.context["internal_billing"].keys(), [(other_subsidiary, lead.subsidiary)])
+        lead_data = dict(response.context["internal_billing"][(other_subsidiary, lead.subsidiary)])[lead]
+        self.assertEqual(lead_data[1][mission], [1200, [[c2, 1.5, 800, 1200]]])
+
 class WorkflowTest(TestCase):
     """Test pydici workflows"""
     fixtures = PYDICI_FIXTURES
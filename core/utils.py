@@ -10,20 +10,32 @@ appropriate to live in models or view
 import re
 import os
 from datetime import timedelta, date, datetime
+from calendar import monthrange
+from uuid import uuid4
 import unicodedata
 from functools import wraps
 import json
+import threading
 from decimal import Decimal
 
 import permissions.utils as perm
 
+HAVE_NUMPY = True
+try:
+    import numpy as np
+except ImportError:
+    HAVE_NUMPY = False
+
 from django.template.loader import get_template
 from django.template import RequestContext
 from django.template.defaultfilters import slugify
 from django.core.mail import EmailMultiAlternatives
 from django.core import urlresolvers
 from django.core.cache import cache
+from django.db import connection
 from django.db.models import Max, Min
+from django.db.models.signals import pre_save, post_save, pre_delete, class_prepared
+from django.apps import apps
 
 import pydici.settings
 
@@ -110,39 +122,68 @@ def to_int_or_round(x, precision=1):
         return x
 
 
+def _working_days_bounds(monthDate, upToToday=False):
+    """@return: (first day, excluded last day) of days to consider to count working days of a month"""
+    if isinstance(monthDate, datetime):
+        monthDate = monthDate.date()
+    end = nextMonth(monthDate)
+    if upToToday:
+        # First day is always considered
+        end = max(min(end, date.today()), monthDate + timedelta(1))
+    return monthDate, end
+
+
 def working_days(monthDate, holidays=None, upToToday=False):
     """Compute the number of working days of a month
     @param monthDate: first day of month datetime.date
     @param holidays: list of days (datetime.date) that are not worked
     @param upToToday: only count days up to (but excluding) today. Only relevant for current month (default is false)
     @return: number of working days (int)"""
-    day = timedelta(1)
-    today = date.today()
+    start, end = _working_days_bounds(monthDate, upToToday)
     holidays = holidays or []  # Initialise to empty list here, not in default args to avoid funny things
+    if HAVE_NUMPY:
+        return int(np.busday_count(start, end, holidays=list(holidays)))
+    holidays = set(holidays)
     n = 0
-    if isinstance(monthDate, datetime):
-        monthDate = monthDate.date()
-    currentMonth = monthDate.month
-    while monthDate.month == currentMonth:
-        if monthDate.weekday() < 5 and monthDate not in holidays:  # Only count working days
+    day = timedelta(1)
+    while start < end:
+        if start.weekday() < 5 and start not in holidays:  # Only count working days
             n += 1
-        monthDate += day
-        if upToToday and monthDate >= today:
-            break
+        start += day
     return n
 
 
+def months_working_days(months, holidays=None, upToToday=False):
+    """Compute the number of working days of many months at once
+    @param months: list of first day of month datetime.date
+    @param holidays: list of days (datetime.date) that are not worked
+    @param upToToday: only count days up to (but excluding) today. Only relevant for current month (default is false)
+    @return: dict with month as key and number of working days (int) as value"""
+    holidays = list(holidays or [])
+    if HAVE_NUMPY and months:
+        bounds = [_working_days_bounds(month, upToToday) for month in months]
+        counts = np.busday_count([b[0] for b in bounds], [b[1] for b in bounds], holidays=holidays)
+        return dict(zip(months, [int(n) for n in counts]))
+    return dict((month, working_days(month, holidays, upToToday)) for month in months)
+
+
+def working_days_mask(days, holidays=None):
+    """Tell for each day if it is a working day (neither week end nor holiday)
+    @param days: list of datetime.date
+    @param holidays: list of days (datetime.date) that are not worked
+    @return: list of boolean"""
+    holidays = holidays or []
+    if HAVE_NUMPY and days:
+        return [bool(i) for i in np.is_busday(days, holidays=list(holidays))]
+    holidays = set(holidays)
+    return [d.weekday() < 5 and d not in holidays for d in days]
+
+
 def month_days(monthDate):
     """Compute the number of days in a month
     @param monthDate: first day of month datetime.date
     @return: number of days (int)"""
-    day = timedelta(1)
-    n = 0
-    currentMonth = monthDate.month
-    while monthDate.month == currentMonth:
-        n += 1
-        monthDate += day
-    return n
+    return monthrange(monthDate.year, monthDate.month)[1] - monthDate.day + 1
 
 
 def nextMonth(month):
@@ -164,28 +205,11 @@ def daysOfMonth(month, week=None):
     @param month: date object of any day in the month
     @param week:week number of week to consider (1 is first etc.). All is none
     @return: list of days (date object) for given month"""
-    days = []
-    day = timedelta(1)
     month = month.replace(day=1)
-    tmpDate = month
-    nWeek = 1  # Week count
-    while tmpDate.month == month.month:
-        if week:
-            # Only add days if we are in the given week
-            if nWeek == week:
-                days.append(tmpDate)
-            elif nWeek > week:
-                # No need to browse remaining days
-                break
-        else:
-            # No week given, we count all days
-            days.append(tmpDate)
-        if tmpDate.isoweekday() == 7:
-            # Sunday, this is next week
-            nWeek += 1
-                # increment days
-        tmpDate += day
-
+    days = [month.replace(day=d) for d in range(1, month_days(month) + 1)]
+    if week:
+        # Only keep days of the given week
+        days = [d for d in days if monthWeekNumber(d) == week]
     return days
 
 
@@ -213,14 +237,8 @@ def previousWeek(cDate):
 
 def monthWeekNumber(cDate):
     """@return: month week number of given date. First week of month is 1"""
-    day = timedelta(1)
-    nWeek = 1
-    tDate = cDate.replace(day=1)
-    while tDate < cDate:
-        tDate += day
-        if tDate.isoweekday() == 1:
-            nWeek += 1
-    return nWeek
+    # Weeks start on monday. Shift by the weekday of the first day of month
+    return (cDate.day - 1 + cDate.replace(day=1).weekday()) // 7 + 1
 
 
 def sortedValues(data):
@@ -304,23 +322,277 @@ def disable_for_loaddata(signal_handler):
     return wrapper
 
 
-def cacheable(cache_key, timeout=3600):
+_request_memo = threading.local()  # Request scoped memo of cached data. Only active during requests (see core.middleware)
+
+
+def request_memo_start():
+    """Enable request scoped memo for current thread"""
+    _request_memo.data = {}
+    _request_memo.hits = 0
+    _request_memo.misses = 0
+
+
+def request_memo_stop():
+    """Disable request scoped memo for current thread
+    @return: (hits, misses)"""
+    stats = request_memo_stats()
+    _request_memo.data = None
+    return stats
+
+
+def request_memo_stats():
+    """@return: (hits, misses) of request scoped memo for current thread"""
+    return getattr(_request_memo, "hits", 0), getattr(_request_memo, "misses", 0)
+
+
+def request_memo_clear():
+    """Drop request scoped memo content. Used when data changes during request (version stamps and
+    cacheable generations bumps, parameter changes)"""
+    data = getattr(_request_memo, "data", None)
+    if data:
+        data.clear()
+
+
+def request_memoized(key, func):
+    """Get data from request scoped memo, or compute it with func and store it in memo for the rest of the request.
+    Outside requests, func is simply called
+    @param key: memo key, usually the cache key of data
+    @param func: function without args that get data (usually from cache)
+    @return: data"""
+    data = getattr(_request_memo, "data", None)
+    if data is None:
+        return func()
+    if key in data:
+        _request_memo.hits += 1
+        return data[key]
+    _request_memo.misses += 1
+    data[key] = func()
+    return data[key]
+
+
+CACHEABLE_GENERATION_CACHE_KEY = "CACHEABLE_GENERATION_%s"  # Model label
+CACHEABLE_INSTANCE_GENERATION_CACHE_KEY = "CACHEABLE_GENERATION_%s_%s_%s"  # Model label, field name, field value
+CACHEABLE_DEPENDENCIES = {}  # Models that cached methods depends on. Key is model label, value is set of fields or fields path (None for whole model)
+
+
+def cacheable(cache_key, timeout=3600, depends_on=None):
     """Decorator to simplify model level method caching.
-    Adapted from http://djangosnippets.org/snippets/1130/"""
+    Adapted from http://djangosnippets.org/snippets/1130/
+    @param cache_key: cache key pattern, formatted with object __dict__
+    @param timeout: cache timeout in seconds
+    @param depends_on: list of models the result depends on. Either "app_label.Model" (any change of any object
+    invalidates cache) or ("app_label.Model", "field") (only changes of objects whose field points to self invalidate cache).
+    Field can be a path through foreign keys, like "mission__lead" to depend on timesheets of missions of a lead.
+    When defined, cached result is also invalidated on day change, so long timeout can be used safely.
+    Result is also kept in request scoped memo"""
+    dependencies = []
+    for dependency in depends_on or []:
+        label, field = dependency if isinstance(dependency, tuple) else (dependency, None)
+        if label not in CACHEABLE_DEPENDENCIES:
+            CACHEABLE_DEPENDENCIES[label] = set()
+            try:
+                connectCacheableSignalHandler(apps.get_registered_model(*label.split(".")))
+            except LookupError:
+                pass  # Model is not defined yet. Signal handler will be connected when model class is prepared
+        CACHEABLE_DEPENDENCIES[label].add(field)
+        dependencies.append((label, field))
+
     def paramed_decorator(func):
-        def decorated(self):
-            key = cache_key % self.__dict__
+        def cached(self, key):
+            if dependencies:
+                generations = get_version_stamps([cacheable_generation_key(label, field, self.pk) for label, field in dependencies])
+                return watermark_cached(key, (date.today(), generations), lambda: func(self), timeout)
             res = cache.get(key)
             if res is None:
                 res = func(self)
                 cache.set(key, res, timeout)
             return res
+
+        def decorated(self):
+            key = cache_key % self.__dict__
+            return request_memoized(key, lambda: cached(self, key))
         decorated.__doc__ = func.__doc__
         decorated.__dict__ = func.__dict__
         return decorated
     return paramed_decorator
 
 
+def cacheable_generation_key(label, field=None, value=None):
+    """@return: cache key of generation counter of a model (if field is None) or of model objects with given field value"""
+    if field is None:
+        return CACHEABLE_GENERATION_CACHE_KEY % label
+    return CACHEABLE_INSTANCE_GENERATION_CACHE_KEY % (label, field, value)
+
+
+def bump_cacheable_generations(model, **fields):
+    """Invalidate cached methods that depend on given model. Use it after bulk operations that do not send signals
+    @param model: model class
+    @param fields: field name as key and list of changed objects values of this field as value. Values of fields path
+    starting with a given foreign key (like "mission__lead" for "mission") are retrieved from database"""
+    request_memo_clear()
+    label = "%s.%s" % (model._meta.app_label, model._meta.object_name)
+    dependencies = CACHEABLE_DEPENDENCIES.get(label, set())
+    keys = []
+    if None in dependencies:
+        keys.append(cacheable_generation_key(label))
+    for field, values in fields.items():
+        values = set(values)
+        if field in dependencies:
+            keys.extend(cacheable_generation_key(label, field, value) for value in values)
+        paths = sorted(d for d in dependencies if d and d.startswith(field + "__"))
+        values.discard(None)
+        if paths and values:
+            # Get all paths values with one query on related model
+            related = model._meta.get_field(field).rel.to
+            rows = related._base_manager.filter(pk__in=values).values_list(*[p[len(field) + 2:] for p in paths])
+            for row in rows:
+                keys.extend(cacheable_generation_key(label, path, value) for path, value in zip(paths, row))
+    if keys:
+        cache.set_many(dict((key, uuid4().hex) for key in keys), None)
+        # Bump again after commit, other processes may have cached data read before commit under the new generations
+        after_commit(("cacheable",) + tuple(keys), lambda: cache.set_many(dict((key, uuid4().hex) for key in keys), None))
+
+
+def cacheable_dependency_fields(model):
+    """@return: names of fields of model that cached methods depend on. Fields path are reduced to their first field"""
+    dependencies = CACHEABLE_DEPENDENCIES.get("%s.%s" % (model._meta.app_label, model._meta.object_name), [])
+    return sorted(set(d.split("__")[0] for d in dependencies if d is not None))
+
+
+def cacheableSignalHandler(sender, **kwargs):
+    """Signal handler for saved or deleted objects of models that cached methods depend on. Bump generation counters.
+    Deleted objects are handled before deletion to be able to follow fields path"""
+    instance = kwargs["instance"]
+    fields = cacheable_dependency_fields(sender)
+    bump_cacheable_generations(sender, **dict((f, [getattr(instance, sender._meta.get_field(f).attname)]) for f in fields))
+
+
+def cacheablePreSaveSignalHandler(sender, **kwargs):
+    """Signal handler for objects of models that cached methods depend on, before they are saved.
+    Bump generation counters of previous fields values, as they may change"""
+    instance = kwargs["instance"]
+    fields = cacheable_dependency_fields(sender)
+    if not fields or instance.pk is None:
+        return
+    for row in sender._base_manager.filter(pk=instance.pk).values_list(*fields):
+        bump_cacheable_generations(sender, **dict((f, [value]) for f, value in zip(fields, row)))
+
+
+def connectCacheableSignalHandler(model):
+    """Connect cacheable signal handlers to given model. Handlers are not connected to all models to keep fast deletes"""
+    pre_save.connect(cacheablePreSaveSignalHandler, sender=model, dispatch_uid="cacheablePreSaveSignalHandler")
+    post_save.connect(cacheableSignalHandler, sender=model, dispatch_uid="cacheableSignalHandler")
+    pre_delete.connect(cacheableSignalHandler, sender=model, dispatch_uid="cacheableSignalHandler")
+
+
+def cacheableClassPreparedSignalHandler(sender, **kwargs):
+    """Signal handler for newly defined model classes. Connect cacheable signal handler if cached methods depend on it"""
+    if "%s.%s" % (sender._meta.app_label, sender._meta.object_name) in CACHEABLE_DEPENDENCIES:
+        connectCacheableSignalHandler(sender)
+
+class_prepared.connect(cacheableClassPreparedSignalHandler)
+
+
+def get_version_stamp(cache_key):
+    """Get version stamp shared by all processes through cache. A new one is created if missing
+    @param cache_key: cache key of version stamp
+    @return: version stamp (str)"""
+    def get():
+        version = cache.get(cache_key)
+        if version is None:
+            version = uuid4().hex
+            if not cache.add(cache_key, version, None):
+                version = cache.get(cache_key) or version
+        return version
+    return request_memoized(cache_key, get)
+
+
+def get_version_stamps(cache_keys):
+    """Get many version stamps with one cache request. Missing ones are created
+    @param cache_keys: list of version stamps cache keys
+    @return: list of version stamps"""
+    versions = cache.get_many(cache_keys)
+    return [versions.get(key) or get_version_stamp(key) for key in cache_keys]
+
+
+def bump_version_stamp(cache_key):
+    """Change shared version stamp to tell all processes that data has changed
+    @param cache_key: cache key of version stamp"""
+    request_memo_clear()
+    cache.set(cache_key, uuid4().hex, None)
+    # Bump again after commit, other processes may have cached data read before commit under the new version
+    after_commit(cache_key, lambda: cache.set(cache_key, uuid4().hex, None))
+
+
+_after_commit = threading.local()
+
+
+def after_commit(key, func):
+    """Defer function call until current transaction is committed. Nothing is done outside transactions.
+    Deferred calls are run by run_after_commit(), by middleware once request is processed or by flush_after_commit decorator
+    @param key: identifier of call. Only last function registered with a given key is called
+    @param func: function without args"""
+    if not connection.in_atomic_block:
+        return
+    if getattr(_after_commit, "funcs", None) is None:
+        _after_commit.funcs = {}
+    _after_commit.funcs[key] = func
+
+
+def run_after_commit():
+    """Run deferred calls if no transaction is in progress anymore"""
+    if connection.in_atomic_block:
+        return
+    funcs = getattr(_after_commit, "funcs", None) or {}
+    _after_commit.funcs = None
+    for func in funcs.values():
+        func()
+
+
+def flush_after_commit(func):
+    """Decorator for entry points run outside requests (commands, background tasks) that runs deferred calls
+    (see after_commit) once decorated function returns. Requests are handled by middleware"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            run_after_commit()
+    return wrapper
+
+
+MODEL_VERSION_CACHE_KEY = "MODEL_VERSION_%s"  # Model label
+
+
+def model_version_key(model):
+    """@return: cache key of version stamp changed on each change of given model objects"""
+    return MODEL_VERSION_CACHE_KEY % ("%s.%s" % (model._meta.app_label, model._meta.object_name))
+
+
+def bump_model_version_stamp(model):
+    """Tell all processes that some objects of given model changed. Use it after bulk operations that do not send signals"""
+    bump_version_stamp(model_version_key(model))
+
+
+def modelVersionSignalHandler(sender, **kwargs):
+    """Signal handler for new/updated/deleted objects of models whose changes are tracked with a version stamp"""
+    bump_model_version_stamp(sender)
+
+
+def watermark_cached(cache_key, watermark, func, timeout=3600):
+    """Get data from cache as long as its data watermark does not change. Else compute it again and cache it
+    @param cache_key: cache key of data
+    @param watermark: any comparable value that change when underlying data changes (usually cheap aggregates)
+    @param func: function without args that compute data
+    @param timeout: cache timeout in seconds
+    @return: data"""
+    cached = cache.get(cache_key)
+    if cached and cached[0] == watermark:
+        return cached[1]
+    data = func()
+    cache.set(cache_key, (watermark, data), timeout)
+    return data
+
 def convertDictKeyToDate(data):
     """Convert dict key from unicode string with %Y-%m-%d %H:%M:%S format, to date.
     This is used to convert dict from queryset for sqlite3 that don't support properly date trunc functions
@@ -343,6 +615,12 @@ def cumulateList(aList):
         result.append(s)
     return result
 
+class EchoBuffer(object):
+    """File like object that just returns what is written. Used with csv writer to stream csv lines"""
+    def write(self, value):
+        return value
+
+
 class GNode(object):
     """Graph node object wrapper"""
     def __init__(self, id_, label, color="#FFF"):
@@ -423,15 +701,17 @@ def user_has_features(user, features):
 
 def get_parameter(key):
     """Get pydici parameter according to key"""
-    value = cache.get(Parameter.PARAMETER_CACHE_KEY % key)
-    if value is None:
-        parameter = Parameter.objects.get(key=key)
-        if parameter.type == "FLOAT":
-            value = float(parameter.value)
-        else:
-            value = parameter.value
-        cache.set(Parameter.PARAMETER_CACHE_KEY % key, value, 3600*24)
-    return value
+    def get():
+        value = cache.get(Parameter.PARAMETER_CACHE_KEY % key)
+        if value is None:
+            parameter = Parameter.objects.get(key=key)
+            if parameter.type == "FLOAT":
+                value = float(parameter.value)
+            else:
+                value = parameter.value
+            cache.set(Parameter.PARAMETER_CACHE_KEY % key, value, 3600*24)
+        return value
+    return request_memoized(Parameter.PARAMETER_CACHE_KEY % key, get)
 
 def get_fiscal_years(queryset, date_field_name):
     """Extract fiscal years of items in query set.
@@ -12,9 +12,10 @@ import json
 from django.shortcuts import render
 from django.db.models import Q, Sum, Min, Max
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils.html import strip_tags
 from django.utils.translation import ugettext as _
+from django.utils.translation import get_language
 from django.core.urlresolvers import reverse
 from django.core.cache import cache
 
@@ -25,14 +26,18 @@ from core.decorator import pydici_non_public, pydici_feature, PydiciNonPublicdMi
 from leads.models import Lead
 from people.models import Consultant
 from crm.models import Company, Contact
-from staffing.models import Mission, FinancialCondition, Staffing, Timesheet
+from staffing.models import Mission, Staffing, Timesheet, TimesheetRollup, rateResolver, FINANCIAL_CONDITION_VERSION_CACHE_KEY
 from billing.models import ClientBill
 from expense.models import Expense
 from people.views import consultant_home
-from core.utils import nextMonth, previousMonth
+from core.utils import nextMonth, previousMonth, EchoBuffer, watermark_cached, get_version_stamps, model_version_key
+from core.search import search as search_index
+from people.utils import getRateObjectives
 
 import pydici.settings
 
+RISK_REPORTING_CACHE_KEY = "RISK_REPORTING"
+
 
 @login_required
 def index(request):
@@ -56,7 +61,7 @@ def index(request):
 @pydici_non_public
 @pydici_feature("search")
 def search(request):
-    """Very simple search function on all major pydici objects"""
+    """Search function on all major pydici objects. Words are looked up in search index (see core.search)"""
 
     words = request.GET.get("q", "")
     words = words.split()
@@ -65,80 +70,29 @@ def search(request):
     more_record = False # Wether we have more records
 
     if words:
-        # Consultant
-        consultants = Consultant.objects.all()
-        for word in words:
-            consultants = consultants.filter(Q(name__icontains=word) |
-                                             Q(trigramme__icontains=word))
-        consultants = consultants.distinct()
-
-        # Companies
-        companies = Company.objects.all()
-        for word in words:
-            companies = companies.filter(name__icontains=word)
-        companies = companies.distinct()
-
-        # Contacts
-        contacts = Contact.objects.all()
-        for word in words:
-            contacts = contacts.filter(name__icontains=word)
-        contacts = contacts.distinct()[:max_record]
-        if len(contacts) >= max_record:
+        labels = ("people.Consultant", "crm.Company", "crm.Contact", "taggit.Tag", "leads.Lead", "staffing.Mission", "billing.ClientBill")
+        results = search_index(words, labels)
+        if [ids for ids in results.values() if len(ids) > max_record]:
             more_record = True
 
-        # Tags
-        tags = Tag.objects.all()
-        for word in words:
-            tags = tags.filter(name__icontains=word)
-
-        # Leads
-        leads = Lead.objects.all()
-        for word in words:
-            leads = leads.filter(Q(name__icontains=word) |
-                                 Q(description__icontains=word) |
-                                 Q(tags__name__iexact=word) |
-                                 Q(client__contact__name__icontains=word) |
-                                 Q(client__organisation__company__name__icontains=word) |
-                                 Q(client__organisation__name__iexact=word) |
-                                 Q(deal_id__icontains=word[:-1]))  # Squash last letter that could be mission letter
-        leads = leads.distinct().select_related("client__organisation__company")[:max_record]
-        if len(leads) >= max_record:
-            more_record = True
+        def ranked(queryset, label):
+            """Fetch first matching objects of label, best ranked first"""
+            objects = queryset.in_bulk(results[label][:max_record])
+            return [objects[i] for i in results[label][:max_record] if i in objects]
 
-        # Missions
-        missions = Mission.objects.all()
-        for word in words:
-            missions = missions.filter(Q(deal_id__icontains=word) |
-                                       Q(description__icontains=word))
-        missions = missions.select_related("lead__client__organisation__company")[:max_record]
-        if len(missions) >= max_record:
-            more_record = True
+        consultants = ranked(Consultant.objects.all(), "people.Consultant")
+        companies = ranked(Company.objects.all(), "crm.Company")
+        contacts = ranked(Contact.objects.all(), "crm.Contact")
+        tags = ranked(Tag.objects.all(), "taggit.Tag")
+        leads = ranked(Lead.objects.select_related("client__organisation__company"), "leads.Lead")
+        missions = ranked(Mission.objects.select_related("lead__client__organisation__company"), "staffing.Mission")
+        bills = ranked(ClientBill.objects.select_related("lead__client__organisation__company"), "billing.ClientBill")
 
-        # Add missions from lead
+        # Add missions and bills from lead
         if leads:
-            missions = set(missions)
-            for lead in leads.prefetch_related("mission_set"):
-                for mission in lead.mission_set.all():
-                    missions.add(mission)
-            missions = list(missions)
-
-        # Bills
-        bills = ClientBill.objects.all()
-        for word in words:
-            bills = bills.filter(Q(bill_id__icontains=word) |
-                                 Q(comment__icontains=word))
-        bills = bills.select_related("lead__client__organisation__company")[:max_record]
-        if len(bills) >= max_record:
-            more_record = True
-
-        # Add bills from lead
-        if leads:
-            bills = set(bills)
-            for lead in leads.prefetch_related("clientbill_set"):
-                for bill in lead.clientbill_set.all():
-                    bills.add(bill)
+            missions.extend(m for m in Mission.objects.filter(lead__in=leads).select_related("lead__client__organisation__company") if m not in missions)
+            bills.extend(b for b in ClientBill.objects.filter(lead__in=leads).select_related("lead__client__organisation__company") if b not in bills)
         # Sort
-        bills = list(bills)
         bills.sort(key=lambda x: x.creation_date)
 
     return render(request, "core/search.html",
@@ -177,13 +131,7 @@ def financialControl(request, start_date=None, end_date=None):
     else:
         start_date = datetime.date(int(start_date[0:4]), int(start_date[4:6]), 1)
 
-    response = HttpResponse(content_type="text/plain")
-    response["Content-Disposition"] = "attachment; filename=financialControl.dat"
-    writer = csv.writer(response, delimiter=';')
-
-    financialConditions = {}
-    for fc in FinancialCondition.objects.all():
-        financialConditions["%s-%s" % (fc.mission_id, fc.consultant_id)] = (fc.daily_rate, fc.bought_daily_rate)
+    financialConditions = rateResolver.rates()
 
     # Header
     header = ["FiscalYear", "Month", "Type", "Nature", "Archived",
@@ -195,20 +143,20 @@ def financialControl(request, start_date=None, end_date=None):
               "ObjectiveRate", "DailyRate", "BoughtDailyRate", "BudgetType", "QuantityInDays", "QuantityInEuros",
               "StartDate", "EndDate"]
 
-    writer.writerow([unicode(i).encode("ISO-8859-15", "ignore") for i in header])
-
     timesheets = Timesheet.objects.filter(working_date__gte=start_date, working_date__lt=nextMonth(end_date))
     staffings = Staffing.objects.filter(staffing_date__gte=start_date, staffing_date__lt=nextMonth(end_date))
 
-    consultants = dict([(i.trigramme.lower(), i) for i in Consultant.objects.all().select_related()])
-
     missionsIdsFromStaffing = Mission.objects.filter(probability__gt=0, staffing__staffing_date__gte=start_date, staffing__staffing_date__lt=nextMonth(end_date)).values_list("id", flat=True)
     missionsIdsFromTimesheet = Mission.objects.filter(probability__gt=0, timesheet__working_date__gte=start_date, timesheet__working_date__lt=nextMonth(end_date)).values_list("id", flat=True)
     missionsIds = set(list(missionsIdsFromStaffing) + list(missionsIdsFromTimesheet))
     missions = Mission.objects.filter(id__in=missionsIds)
     missions = missions.distinct().select_related().prefetch_related("lead__client__organisation__company", "lead__responsible")
 
-    def createMissionRow(mission, start_date, end_date):
+    archivedMissions = Mission.objects.filter(active=False, archived_date__gte=start_date, archived_date__lt=end_date)
+    archivedMissions = archivedMissions.filter(lead__state="WON")
+    archivedMissions = archivedMissions.prefetch_related("lead__client__organisation__company", "lead__responsible")
+
+    def createMissionRow(mission, start_date, end_date, doneWork):
         """Inner function to create mission row"""
         missionRow = []
         missionRow.append(start_date.year)
@@ -236,91 +184,103 @@ def financialControl(request, start_date=None, end_date=None):
         missionRow.append(mission.mission_id())
         missionRow.append(mission.billing_mode or "")
         missionRow.append(mission.price or 0)
-        missionRow.extend(mission.done_work())
+        missionRow.extend(doneWork)
         return missionRow
 
-    for mission in missions:
-        missionRow = createMissionRow(mission, start_date, end_date)
-        for consultant in mission.consultants().select_related().prefetch_related("staffing_manager"):
-            consultantRow = missionRow[:]  # copy
-            daily_rate, bought_daily_rate = financialConditions.get("%s-%s" % (mission.id, consultant.id), [0, 0])
-            rateObjective = consultant.getRateObjective(end_date, rate_type="DAILY_RATE")
-            if rateObjective:
-                rateObjective = rateObjective.rate
-            else:
-                rateObjective = 0
-            doneDays = timesheets.filter(mission_id=mission.id, consultant=consultant.id).aggregate(charge=Sum("charge"), min_date=Min("working_date"), max_date=Max("working_date"))
-            forecastedDays = staffings.filter(mission_id=mission.id, consultant=consultant.id).aggregate(charge=Sum("charge"), min_date=Min("staffing_date"), max_date=Max("staffing_date"))
-            consultantRow.append(consultant.company)
-            consultantRow.append(consultant.staffing_manager.trigramme if consultant.staffing_manager else "")
-            consultantRow.append(consultant.trigramme)
-            consultantRow.append(consultant.name)
-            consultantRow.append(consultant.subcontractor)
-            consultantRow.append(mission.subsidiary != consultant.company)
-            consultantRow.append(rateObjective)
-            consultantRow.append(daily_rate or 0)
-            consultantRow.append(bought_daily_rate or 0)
-            # Timesheet row
-            for budgetType, days in (("done", doneDays), ("forecast", forecastedDays)):
-                quantity = days["charge"] or 0
-                row = consultantRow[:]  # Copy
-                row.append(budgetType)
-                row.append(quantity or 0)
-                row.append((quantity * daily_rate) if (quantity > 0 and daily_rate > 0) else 0)
-                row.append(days["min_date"] or "")
-                row.append(days["max_date"] or "")
-                writer.writerow([unicode(i).encode("ISO-8859-15", "ignore") for i in row])
-
-    archivedMissions = Mission.objects.filter(active=False, archived_date__gte=start_date, archived_date__lt=end_date)
-    archivedMissions = archivedMissions.filter(lead__state="WON")
-    archivedMissions = archivedMissions.prefetch_related("lead__client__organisation__company", "lead__responsible")
-    for mission in archivedMissions:
-        if mission in missions:
-            # Mission has already been processed for this period
-            continue
-        missionRow = createMissionRow(mission, start_date, end_date)
-        writer.writerow([unicode(i).encode("ISO-8859-15", "ignore") for i in missionRow])
-
-    for expense in Expense.objects.filter(expense_date__gte=start_date, expense_date__lt=nextMonth(end_date), chargeable=False).select_related():
-        row = []
-        row.append(start_date.year)
-        row.append(end_date.isoformat())
-        row.append("expense")
-        row.append(expense.category)
-        if expense.lead:
-            row.append(expense.lead.subsidiary)
-            row.extend(["", "", "", ""])
-            row.append(expense.lead.deal_id)
-        else:
-            row.extend(["", "", "", "", "", ""])
-        row.extend(["", "", "", "", ""])
-        try:
-            consultant = consultants[expense.user.username.lower()]
-            row.append(consultant.company.name)
-            row.append(consultant.staffing_manager.trigramme)
-            row.append(consultant.trigramme)
-            row.append(consultant.name)
-            row.append(consultant.subcontractor)
+    def rows():
+        yield header
+
+        # Done and forecasted days of the period with their bounds, grouped by (mission id, consultant id)
+        doneDays = dict(((m, c), (charge, min_date, max_date)) for m, c, charge, min_date, max_date in
+                        timesheets.values_list("mission", "consultant").annotate(Sum("charge"), Min("working_date"), Max("working_date")).order_by())
+        forecastedDays = dict(((m, c), (charge, min_date, max_date)) for m, c, charge, min_date, max_date in
+                              staffings.values_list("mission", "consultant").annotate(Sum("charge"), Min("staffing_date"), Max("staffing_date")).order_by())
+        # Consultants forecasted or that once charge timesheet for each mission (see Mission.consultants())
+        missionConsultants = set(Staffing.objects.filter(mission__in=missionsIds).values_list("mission", "consultant").distinct().order_by())
+        missionConsultants.update(TimesheetRollup.objects.filter(mission__in=missionsIds).values_list("mission", "consultant").distinct().order_by())
+        consultants = Consultant.objects.select_related("company", "staffing_manager").in_bulk(set(c for m, c in missionConsultants))
+        rateObjectives = getRateObjectives(consultants.values(), [end_date])
+        # Consultants of each mission, ordered by name. Key is mission id
+        consultantsByMission = {}
+        for mission_id, consultant_id in missionConsultants:
+            consultantsByMission.setdefault(mission_id, []).append(consultants[consultant_id])
+        for consultantList in consultantsByMission.values():
+            consultantList.sort(key=lambda c: c.name)
+        # Archived missions that have not already been processed for this period
+        otherArchivedMissions = [m for m in archivedMissions if m.id not in missionsIds]
+        doneWorks = Mission.done_works(list(missions) + otherArchivedMissions)
+
+        for mission in missions:
+            missionRow = createMissionRow(mission, start_date, end_date, doneWorks[mission.id])
+            for consultant in consultantsByMission.get(mission.id, []):
+                consultantRow = missionRow[:]  # copy
+                daily_rate, bought_daily_rate = financialConditions.get((mission.id, consultant.id), (0, 0))
+                consultantRow.append(consultant.company)
+                consultantRow.append(consultant.staffing_manager.trigramme if consultant.staffing_manager else "")
+                consultantRow.append(consultant.trigramme)
+                consultantRow.append(consultant.name)
+                consultantRow.append(consultant.subcontractor)
+                consultantRow.append(mission.subsidiary != consultant.company)
+                consultantRow.append(rateObjectives.get((consultant.id, end_date), 0))
+                consultantRow.append(daily_rate or 0)
+                consultantRow.append(bought_daily_rate or 0)
+                # Timesheet row
+                for budgetType, days in (("done", doneDays), ("forecast", forecastedDays)):
+                    quantity, min_date, max_date = days.get((mission.id, consultant.id), (0, None, None))
+                    row = consultantRow[:]  # Copy
+                    row.append(budgetType)
+                    row.append(quantity or 0)
+                    row.append((quantity * daily_rate) if (quantity > 0 and daily_rate > 0) else 0)
+                    row.append(min_date or "")
+                    row.append(max_date or "")
+                    yield row
+
+        for mission in otherArchivedMissions:
+            yield createMissionRow(mission, start_date, end_date, doneWorks[mission.id])
+
+        consultants = dict([(i.trigramme.lower(), i) for i in Consultant.objects.all().select_related()])
+        for expense in Expense.objects.filter(expense_date__gte=start_date, expense_date__lt=nextMonth(end_date), chargeable=False).select_related():
+            row = []
+            row.append(start_date.year)
+            row.append(end_date.isoformat())
+            row.append("expense")
+            row.append(expense.category)
             if expense.lead:
-                row.append(expense.lead.subsidiary != consultant.company)
+                row.append(expense.lead.subsidiary)
+                row.extend(["", "", "", ""])
+                row.append(expense.lead.deal_id)
             else:
-                row.append("unknown for now")
-        except KeyError:
-            # Exepense user is not a consultant
-            row.extend(["", "", "", "", "", ""])
-        row.extend(["", "", "", "", ""])
-        row.append(expense.amount)  # TODO: compute pseudo HT amount
-        writer.writerow([unicode(i).encode("ISO-8859-15", "ignore") for i in row])
-
+                row.extend(["", "", "", "", "", ""])
+            row.extend(["", "", "", "", ""])
+            try:
+                consultant = consultants[expense.user.username.lower()]
+                row.append(consultant.company.name)
+                row.append(consultant.staffing_manager.trigramme)
+                row.append(consultant.trigramme)
+                row.append(consultant.name)
+                row.append(consultant.subcontractor)
+                if expense.lead:
+                    row.append(expense.lead.subsidiary != consultant.company)
+                else:
+                    row.append("unknown for now")
+            except KeyError:
+                # Exepense user is not a consultant
+                row.extend(["", "", "", "", "", ""])
+            row.extend(["", "", "", "", ""])
+            row.append(expense.amount)  # TODO: compute pseudo HT amount
+            yield row
+
+    writer = csv.writer(EchoBuffer(), delimiter=';')
+    response = StreamingHttpResponse((writer.writerow([unicode(i).encode("ISO-8859-15", "ignore") for i in row]) for row in rows()),
+                                     content_type="text/plain")
+    response["Content-Disposition"] = "attachment; filename=financialControl.dat"
     return response
 
 
-@pydici_non_public
-@pydici_feature("reports")
-def riskReporting(request):
-    """Risk reporting synthesis"""
+def riskReportingData(today):
+    """Compute risk reporting data
+    @return: list of dict, one per risk"""
     data = []
-    today = datetime.date.today()
     # Sent bills (still not paid)
     for bill in ClientBill.objects.filter(state="1_SENT").select_related():
         if bill.due_date < today:
@@ -337,22 +297,39 @@ def riskReporting(request):
                      })
 
     # Leads with done works beyond sent or paid bills
-    for lead in Lead.objects.filter(mission__active=True).distinct().select_related():
-        if not "TIME_SPENT" in [m.billing_mode for m in lead.mission_set.all()]:
-            # All missions of this lead are fixed price (no one is time spent). So done works beyond billing is not considered here
-            # Fixed price mission tracking is done a separate report
+    leads = Lead.objects.filter(mission__active=True).distinct().select_related()
+    # All missions of a lead without time spent mission are fixed price. So done works beyond billing is not considered here
+    # Fixed price mission tracking is done a separate report
+    timeSpentLeads = set(Mission.objects.filter(lead__in=leads, billing_mode="TIME_SPENT").values_list("lead", flat=True))
+    doneWorks = TimesheetRollup.objects.filter(mission__lead__in=leads, month__lt=nextMonth(today))
+    doneWorks = dict(doneWorks.values_list("mission__lead").annotate(Sum("amount")).order_by())
+    billed = ClientBill.objects.filter(lead__in=leads).filter(Q(state="1_SENT") | Q(state="2_PAID"))
+    billed = dict(billed.values_list("lead").annotate(Sum("amount")).order_by())
+    for lead in leads:
+        if lead.id not in timeSpentLeads:
             continue
-        done_d, done_a = lead.done_work()
-        billed = float(ClientBill.objects.filter(lead=lead).filter(Q(state="1_SENT") | Q(state="2_PAID")).aggregate(amount=Sum("amount"))["amount"] or 0)
-        if billed < done_a:
+        done_a = doneWorks.get(lead.id) or 0
+        leadBilled = float(billed.get(lead.id) or 0)
+        if leadBilled < done_a:
             data.append({_("type"): _("work without bill"),
                          _("subsidiary"): unicode(lead.subsidiary),
                          _("deal_id"): lead.deal_id,
                          _("deal"): lead.name,
-                         _("amount"): int(done_a - billed),
+                         _("amount"): int(done_a - leadBilled),
                          _("company"): unicode(lead.client.organisation.company),
                          _("client"): unicode(lead.client),
                          })
+    return data
+
+
+@pydici_non_public
+@pydici_feature("reports")
+def riskReporting(request):
+    """Risk reporting synthesis. Report is cached as long as bills, leads, missions, timesheet and rates do not change"""
+    today = datetime.date.today()
+    versions = [model_version_key(model) for model in (ClientBill, Lead, Mission, Timesheet)]
+    watermark = (today, get_language(), get_version_stamps(versions + [FINANCIAL_CONDITION_VERSION_CACHE_KEY]))  # Report labels are translated
+    data = watermark_cached(RISK_REPORTING_CACHE_KEY, watermark, lambda: riskReportingData(today))
 
     return render(request, "core/risks.html", { "data": json.dumps(data),
                                                     "derivedAttributes": []})
@@ -9,6 +9,7 @@ from datetime import date, timedelta
 
 from django.db import models
 from django.db.models import Sum, Q, get_model
+from django.db.models.signals import post_save, post_delete
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import ugettext
 from django.core import urlresolvers
@@ -16,6 +17,7 @@ from django.utils.safestring import mark_safe
 
 
 from core.utils import GEdge, GEdges, GNode, GNodes, cacheable
+from core.search import searchIndexSignalHandler, searchIndexDeleteSignalHandler
 
 SHORT_DATETIME_FORMAT = "%d/%m/%y %H:%M"
 
@@ -300,39 +302,50 @@ class Client(models.Model):
         rates.sort(key=lambda x: x[0].level)
         return rates
 
-    @cacheable("Client__objectiveMargin__%(id)s", 60)
+    @cacheable("Client__objectiveMargin__%(id)s", 6 * 3600,
+               depends_on=[("staffing.Timesheet", "mission__lead__client"), ("staffing.Staffing", "mission__lead__client"),
+                           ("staffing.FinancialCondition", "mission__lead__client"), ("staffing.Mission", "lead__client"),
+                           ("leads.Lead", "client"), ("billing.ClientBill", "lead__client"), "people.RateObjective"])
     def objectiveMargin(self):
         """Compute margin over budget objective across all mission of this client
         @return: list of (margin in €, margin in % of total turnover) for internal consultant and subcontractor"""
-        Mission = get_model("staffing", "Mission")  # Get Mission with get_model to avoid circular imports
-        consultantMargin = 0
-        subcontractorMargin = 0
+        return Client.objectiveMargins([self])[self.id]
 
-        for mission in Mission.objects.filter(lead__client=self):
-            for consultant, margin in mission.objectiveMargin().items():
-                if consultant.subcontractor:
-                    subcontractorMargin += margin
-                else:
-                    consultantMargin += margin
-        sales = self.sales()
-        if sales > 0:
-            consultantMargin_pc = 100 * consultantMargin / (1000 * sales)
-            subcontractorMargin_pc = 100 * subcontractorMargin / (1000 * sales)
-        else:
-            consultantMargin_pc = 0
-            subcontractorMargin_pc = 0
-        return ((consultantMargin, consultantMargin_pc), (subcontractorMargin, subcontractorMargin_pc))
+    @classmethod
+    def objectiveMargins(cls, clients):
+        """Compute margin over budget objective across all mission of many clients at once
+        @param clients: clients list or queryset
+        @return: dict with client id as key and objectiveMargin() result as value"""
+        from billing.models import ClientBill
+        Mission = get_model("staffing", "Mission")  # Get Mission with get_model to avoid circular imports
+        margins = dict((client.id, [0, 0]) for client in clients)  # Consultant and subcontractor margin
+        missions = Mission.objects.filter(lead__client__in=margins.keys())
+        missionClient = dict(missions.values_list("id", "lead__client"))
+        for mission_id, missionMargin in Mission.objective_margins(missions).items():
+            for consultant, margin in missionMargin.items():
+                margins[missionClient[mission_id]][int(consultant.subcontractor)] += margin
+        bills = ClientBill.objects.filter(lead__client__in=margins.keys())
+        clientSales = dict((client_id, float(amount or 0) / 1000) for client_id, amount in bills.values_list("lead__client").annotate(Sum("amount")).order_by())
+        result = {}
+        for client in clients:
+            consultantMargin, subcontractorMargin = margins[client.id]
+            sales = clientSales.get(client.id, 0)
+            if sales > 0:
+                consultantMargin_pc = 100 * consultantMargin / (1000 * sales)
+                subcontractorMargin_pc = 100 * subcontractorMargin / (1000 * sales)
+            else:
+                consultantMargin_pc = 0
+                subcontractorMargin_pc = 0
+            result[client.id] = ((consultantMargin, consultantMargin_pc), (subcontractorMargin, subcontractorMargin_pc))
+        return result
 
     def fixedPriceMissionMargin(self):
         """Compute total fixed price margin in €  mission for this client. Only finished mission (ie archived) are
         considered"""
         Mission = get_model("staffing", "Mission")  # Get Mission with get_model to avoid circular imports
-        margin = 0
         missions = Mission.objects.filter(lead__client=self, active=False,
                                           lead__state = "WON", billing_mode="FIXED_PRICE")
-        for mission in missions:
-            margin += mission.margin()
-        return margin * 1000
+        return sum(Mission.margins(missions).values()) * 1000
 
     def sales(self, onlyLastYear=False):
         """Sales billed for this client in keuros"""
@@ -436,3 +449,14 @@ class AdministrativeContact(models.Model):
         verbose_name = _("Administrative contact")
         ordering = ("company", "contact")
         unique_together = (("company", "contact",))
+
+
+# Signal connection to maintain search index
+post_save.connect(searchIndexSignalHandler, sender=Company)
+post_delete.connect(searchIndexDeleteSignalHandler, sender=Company)
+post_save.connect(searchIndexSignalHandler, sender=ClientOrganisation)
+post_delete.connect(searchIndexDeleteSignalHandler, sender=ClientOrganisation)
+post_save.connect(searchIndexSignalHandler, sender=Contact)
+post_delete.connect(searchIndexDeleteSignalHandler, sender=Contact)
+post_save.connect(searchIndexSignalHandler, sender=Client)
+post_delete.connect(searchIndexDeleteSignalHandler, sender=Client)
@@ -412,10 +412,13 @@ def company_detail(request, company_id):
 def company_rates_margin(request, company_id):
     """ajax fragment that display useful stats about margin and rates for this company"""
     company = Company.objects.get(id=company_id)
+    clients = Client.objects.filter(organisation__company=company).select_related()
+    objectiveMargins = Client.objectiveMargins(clients)
 
     return render(request, "crm/_clientcompany_rates_margin.html",
         {"company": company,
-         "clients": Client.objects.filter(organisation__company=company).select_related(),
+         "clients": clients,
+         "client_margins": [(client, objectiveMargins[client.id]) for client in clients],
          "profiles": ConsultantProfile.objects.all().order_by("level")})
 
 
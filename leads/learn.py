@@ -34,6 +34,7 @@ from django.db.models.query import QuerySet
 from leads.models import Lead, StateProba
 from taggit.models import Tag
 from billing.models import ClientBill
+from core.utils import flush_after_commit
 
 
 STATES= { "WON": 1, "LOST": 2, "FORGIVEN": 3}
@@ -363,6 +364,7 @@ def predict_similar(lead):
 
 ############# Entry points for computation ##########################
 @background
+@flush_after_commit
 def compute_leads_state(relearn=True, leads_id=None):
     """Learn state from past leads and compute state probal for current leads. This function is intended to be run async
     as it could last few seconds.
@@ -399,6 +401,7 @@ def compute_leads_state(relearn=True, leads_id=None):
                     mission.save()
 
 @background
+@flush_after_commit
 def compute_leads_tags():
     """Learn tags from past leads and cache model"""
 
@@ -423,6 +426,7 @@ def compute_leads_tags():
 
 
 @background
+@flush_after_commit
 def compute_lead_similarity():
     """Compute a model to find similar leads and cache it"""
 
@@ -13,11 +13,12 @@ from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import ugettext
 from django.contrib.admin.models import LogEntry, ContentType
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.db.models import Q, Sum
 from django.core.urlresolvers import reverse
 
 from taggit.managers import TaggableManager
+from taggit.models import Tag, TaggedItem
 
 from core.utils import compact_text
 import pydici.settings
@@ -25,7 +26,8 @@ from crm.models import Client, BusinessBroker, Subsidiary
 from people.models import Consultant, SalesMan
 from actionset.models import ActionState
 from actionset.utils import launchTrigger
-from core.utils import createProjectTree, disable_for_loaddata, getLeadDirs, cacheable
+from core.utils import createProjectTree, disable_for_loaddata, getLeadDirs, cacheable, modelVersionSignalHandler
+from core.search import searchIndexSignalHandler, searchIndexDeleteSignalHandler
 
 
 SHORT_DATETIME_FORMAT = "%d/%m/%y %H:%M"
@@ -81,7 +83,7 @@ class Lead(models.Model):
 
     objects = LeadManager()  # Custom manager that factorise active/passive lead code
 
-    @cacheable("Lead.__unicode__%(id)s", 3)
+    @cacheable("Lead.__unicode__%(id)s", 6 * 3600, depends_on=[("leads.Lead", "id"), "crm.ClientOrganisation", "crm.Company"])
     def __unicode__(self):
         return u"%s - %s" % (self.client.organisation, self.name)
 
@@ -148,8 +150,7 @@ class Lead(models.Model):
         @return: (done work in days, done work in euros)"""
         days = 0
         amount = 0
-        for mission in self.mission_set.all():
-            mDays, mAmount = mission.done_work()
+        for mDays, mAmount in self.mission_set.model.done_works(self.mission_set.all()).values():
             days += mDays
             amount += mAmount
 
@@ -177,8 +178,8 @@ class Lead(models.Model):
         @return: dict where key is consultant, value is cumulated margin over objective
         @see: for global sum, see totalMarginObjectives()"""
         leadMargin = {}
-        for mission in self.mission_set.all():
-            missionMargin = mission.objectiveMargin(startDate, endDate)
+        Mission = self.mission_set.model
+        for missionMargin in Mission.objective_margins(self.mission_set.all(), startDate, endDate).values():
             for consultant in missionMargin:
                 if consultant in leadMargin:
                     leadMargin[consultant] += missionMargin[consultant]
@@ -192,18 +193,22 @@ class Lead(models.Model):
         @see: for per consultant, look at marginObjectives()"""
         return sum(self.objectiveMargin(startDate, endDate).values())
 
-    @cacheable("Lead.__billed__%(id)s", 3)
+    @cacheable("Lead.__billed__%(id)s", 6 * 3600, depends_on=[("billing.ClientBill", "lead")])
     def billed(self):
         """Total amount billed for this lead"""
         return self.clientbill_set.filter(state__in=("1_SENT", "2_PAID")).aggregate(Sum("amount")).values()[0] or 0
 
-    @cacheable("Lead.__still_to_be_billed__%(id)s", 3)
+    @cacheable("Lead.__still_to_be_billed__%(id)s", 6 * 3600,
+               depends_on=[("billing.ClientBill", "lead"), ("staffing.Mission", "lead"), ("expense.Expense", "lead"),
+                           ("staffing.Timesheet", "mission__lead"), ("staffing.FinancialCondition", "mission__lead")])
     def still_to_be_billed(self):
         """Amount that still need to be billed"""
         to_bill = 0
-        for mission in self.mission_set.all():
+        missions = list(self.mission_set.all())
+        done_works = self.mission_set.model.done_works([m for m in missions if m.billing_mode == "TIME_SPENT"])
+        for mission in missions:
             if mission.billing_mode == "TIME_SPENT":
-                to_bill += float(mission.done_work()[1])
+                to_bill += float(done_works[mission.id][1])
             else:
                 # TODO: sum as well subcontractor bills for fixed priced mission
                 if mission.price:
@@ -312,3 +317,13 @@ def leadSignalHandler(sender, **kwargs):
 
 # Signal connection to throw actionset
 post_save.connect(leadSignalHandler, sender=Lead)
+
+# Signal connection to maintain search index
+post_save.connect(searchIndexSignalHandler, sender=Lead)
+post_delete.connect(searchIndexDeleteSignalHandler, sender=Lead)
+post_save.connect(modelVersionSignalHandler, sender=Lead)
+post_delete.connect(modelVersionSignalHandler, sender=Lead)
+post_save.connect(searchIndexSignalHandler, sender=Tag)
+post_delete.connect(searchIndexDeleteSignalHandler, sender=Tag)
+post_save.connect(searchIndexSignalHandler, sender=TaggedItem)
+post_delete.connect(searchIndexDeleteSignalHandler, sender=TaggedItem)
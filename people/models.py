@@ -11,12 +11,13 @@ from django.utils.translation import ugettext
 from django.db.models import F, Sum
 from django.apps import apps
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.core.urlresolvers import reverse
 
 from datetime import date, timedelta
 
 from core.utils import capitalize, disable_for_loaddata, cacheable, previousMonth, working_days
+from core.search import searchIndexSignalHandler, searchIndexDeleteSignalHandler
 from crm.models import Subsidiary
 from actionset.models import ActionState
 from actionset.utils import launchTrigger
@@ -214,13 +215,14 @@ class Consultant(models.Model):
                                        staffing_date__lte=today).aggregate(Sum("charge")).values()[0]
         return days or 0
 
-    @cacheable(CONSULTANT_IS_IN_HOLIDAYS_CACHE_KEY, 6*3600)
+    @cacheable(CONSULTANT_IS_IN_HOLIDAYS_CACHE_KEY, 24 * 3600,
+               depends_on=[("staffing.Timesheet", "consultant"), "staffing.Mission", "staffing.Holiday"])
     def is_in_holidays(self):
         """True if consultant is in holiday today. Else False"""
         Timesheet = apps.get_model("staffing", "Timesheet")  # Get Timesheet with get_model to avoid circular imports
-        Holiday = apps.get_model("staffing", "Holiday")  # Idem
+        from staffing.utils import getHolidays  # Idem
         working_date = date.today()
-        holidays = Holiday.objects.filter(day__gte=working_date)
+        holidays = getHolidays()
         day = timedelta(1)
         while working_date.weekday() in (5,6) or working_date in holidays:
             # Go to next open day
@@ -238,7 +240,7 @@ class Consultant(models.Model):
         ordering = ["name", ]
         verbose_name = _("Consultant")
 
-    @cacheable(TIMESHEET_IS_UP_TO_DATE_CACHE_KEY, 6 * 3600)
+    @cacheable(TIMESHEET_IS_UP_TO_DATE_CACHE_KEY, 24 * 3600, depends_on=[("staffing.Timesheet", "consultant"), "staffing.Holiday"])
     def timesheet_is_up_to_date(self):
         """return tuple (previous month late days, current month late days). (0, 0) means everything is up to date. Current day is not included"""
         Timesheet = apps.get_model("staffing", "Timesheet")  # Get Timesheet with get_model to avoid circular imports
@@ -307,3 +309,7 @@ def consultantSignalHandler(sender, **kwargs):
 
 # Signal connection to throw actionset
 post_save.connect(consultantSignalHandler, sender=Consultant)
+
+# Signal connection to maintain search index
+post_save.connect(searchIndexSignalHandler, sender=Consultant)
+post_delete.connect(searchIndexDeleteSignalHandler, sender=Consultant)
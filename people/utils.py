@@ -10,9 +10,31 @@ appropriate to live in People models or view
 from django.db.models import Count
 from django.utils.translation import ugettext as _
 
-from people.models import Consultant
+from people.models import Consultant, RateObjective
 from crm.models import Subsidiary
 
+def getRateObjectives(consultants, dates, rate_type="DAILY_RATE"):
+    """Get rate objectives of many consultants for many dates in one query. Same semantic as Consultant.getRateObjective
+    @param consultants: consultants list or queryset
+    @param dates: list of dates to consider
+    @param rate_type: DAILY_RATE (default) or PROD_RATE
+    @return: dict with (consultant id, date) as key and rate as value. Missing rate objectives are not in dict"""
+    result = {}
+    if not dates:
+        return result
+    objectives = {}  # Rate objectives per consultant id, ordered by start date
+    rates = RateObjective.objects.filter(consultant__in=consultants, rate_type=rate_type, start_date__lte=max(dates))
+    for consultant_id, start_date, rate in rates.order_by("start_date").values_list("consultant_id", "start_date", "rate"):
+        objectives.setdefault(consultant_id, []).append((start_date, rate))
+    for consultant_id, consultant_objectives in objectives.items():
+        for day in dates:
+            for start_date, rate in consultant_objectives:
+                if start_date > day:
+                    break
+                result[(consultant_id, day)] = rate
+    return result
+
+
 def getScopes(subsidiary, team, target="all"):
     """Define scopes than can be used to filter data. Either team, subsidiary or everybody (default). Format is (type, filter, label) where type is "team_id" or "subsidiary_id".
     @:param target: all (default), subsidiary or team
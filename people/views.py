@@ -12,9 +12,10 @@ from django.http import Http404
 
 from people.models import Consultant
 from crm.models import Company
-from staffing.models import Holiday, Timesheet
+from staffing.models import Staffing
+from staffing.utils import holidayDays, consultantMetrics
 from core.decorator import pydici_non_public
-from core.utils import working_days, previousMonth, nextMonth
+from core.utils import working_days
 
 
 def _consultant_home(request, consultant):
@@ -46,21 +47,23 @@ def consultant_detail(request, consultant_id):
         # Compute consultant current mission based on forecast
         missions = consultant.active_missions().filter(nature="PROD").filter(lead__state="WON")
         # Identify staled missions that may need new staffing or archiving
-        staled_missions = [m for m in missions if m.no_more_staffing_since()]
+        staffed_missions = set(Staffing.objects.filter(mission__in=missions, staffing_date__gte=month).values_list("mission", flat=True))
+        staled_missions = [m for m in missions if m.id not in staffed_missions]
         # Consultant clients and missions
         companies = Company.objects.filter(clientorganisation__client__lead__mission__timesheet__consultant=consultant).distinct()
         business_territory = Company.objects.filter(businessOwner=consultant)
         leads_as_responsible = set(consultant.lead_responsible.active())
         leads_as_staffee = consultant.lead_set.active()
+        metrics = consultantMetrics(consultant)
         # Timesheet donut data
-        holidays = [h.day for h in Holiday.objects.all()]
+        holidays = holidayDays(month)
         month_days = working_days(month, holidays, upToToday=False)
-        done_days = consultant.done_days()
+        done_days = metrics["done_days"]
         late = working_days(month, holidays, upToToday=True) - done_days
         if late < 0:
             late = 0  # Don't warn user if timesheet is ok !
         # Forecast donut data
-        forecasted = consultant.forecasted_days()
+        forecasted = metrics["forecasted"]
         to_be_done = month_days - late - done_days
         forecasting_balance = month_days - forecasted
         if forecasting_balance < 0:
@@ -70,30 +73,16 @@ def consultant_detail(request, consultant_id):
             overhead = 0
             missing = forecasting_balance
         # Turnover
-        monthTurnover = consultant.getTurnover(month)
-        lastMonthTurnover = None
-        day = date.today().day
-        while lastMonthTurnover is None:
-            try:
-                lastMonthTurnover = consultant.getTurnover(previousMonth(month), previousMonth(month).replace(day=day))  # Turnover for last month up to the same day
-            except ValueError:
-                # Corner case, last month has fewer days than current one. Go back one day and try again till it works.
-                lastMonthTurnover = None
-                day -= 1
+        monthTurnover = metrics["month_turnover"]
+        lastMonthTurnover = metrics["last_month_turnover"]  # Turnover for last month up to the same day
         if lastMonthTurnover:
             turnoverVariation = 100 * (monthTurnover - lastMonthTurnover) / lastMonthTurnover
         else:
             turnoverVariation = 100
         # Daily rate
-        fc = consultant.getFinancialConditions(month, nextMonth(month))
-        if fc:
-            daily_rate = int(sum([rate * days for rate, days in fc]) / sum([days for rate, days in fc]))
-        else:
-            daily_rate = 0
-        daily_rate_objective = consultant.getRateObjective(workingDate=month, rate_type="DAILY_RATE")
-        if daily_rate_objective:
-            daily_rate_objective = daily_rate_objective.rate
-        else:
+        daily_rate = metrics["daily_rate"]
+        daily_rate_objective = metrics["daily_rate_objective"]
+        if daily_rate_objective is None:
             daily_rate_objective = daily_rate
         if daily_rate > daily_rate_objective:
             daily_overhead = daily_rate - daily_rate_objective
@@ -103,11 +92,9 @@ def consultant_detail(request, consultant_id):
             daily_overhead = 0
             daily_missing = daily_rate_objective - daily_rate
         # Production rate
-        prod_rate = round(100 * consultant.getProductionRate(month, nextMonth(month)), 1)
-        prod_rate_objective = consultant.getRateObjective(workingDate=month, rate_type="PROD_RATE")
-        if prod_rate_objective:
-            prod_rate_objective = prod_rate_objective.rate
-        else:
+        prod_rate = metrics["prod_rate"]
+        prod_rate_objective = metrics["prod_rate_objective"]
+        if prod_rate_objective is None:
             prod_rate_objective = prod_rate
         if prod_rate > prod_rate_objective:
             prod_overhead = prod_rate - prod_rate_objective
@@ -0,0 +1,20 @@
+# coding: utf-8
+"""
+Rebuild the timesheet monthly rollup table
+@author: Sébastien Renard (sebastien.renard@digitalfox.org)
+@license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
+"""
+
+from django.core.management.base import BaseCommand
+
+from staffing.models import TimesheetRollup
+from core.utils import flush_after_commit
+
+
+class Command(BaseCommand):
+    help = "Rebuild timesheet monthly rollup from timesheet data. Needed once after install or upgrade"
+
+    @flush_after_commit
+    def handle(self, *args, **options):
+        n = TimesheetRollup.rebuild()
+        self.stdout.write("%s timesheet rollup rows computed" % n)
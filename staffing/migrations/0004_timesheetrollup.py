@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import date
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def fill_timesheet_rollup(apps, schema_editor):
+    """Compute rollup from existing timesheet. Same as TimesheetRollup.rebuild() with historical models"""
+    Timesheet = apps.get_model("staffing", "Timesheet")
+    FinancialCondition = apps.get_model("staffing", "FinancialCondition")
+    Mission = apps.get_model("staffing", "Mission")
+    TimesheetRollup = apps.get_model("staffing", "TimesheetRollup")
+    natures = dict(Mission.objects.values_list("id", "nature"))
+    rates = {}
+    for mission_id, consultant_id, daily_rate in FinancialCondition.objects.order_by("id").values_list("mission_id", "consultant_id", "daily_rate"):
+        rates[(mission_id, consultant_id)] = daily_rate  # Last one wins, like rate resolver
+    for month in Timesheet.objects.dates("working_date", "month"):
+        next_month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+        timesheets = Timesheet.objects.filter(working_date__gte=month, working_date__lt=next_month)
+        timesheets = timesheets.values_list("consultant", "mission").annotate(Sum("charge")).order_by()
+        TimesheetRollup.objects.bulk_create([TimesheetRollup(consultant_id=consultant_id, mission_id=mission_id, month=month,
+                                                             nature=natures[mission_id], charge=charge,
+                                                             amount=charge * rates.get((mission_id, consultant_id), 0))
+                                             for consultant_id, mission_id, charge in timesheets])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('people', '0004_auto_20170817_2015'),
+        ('staffing', '0003_auto_20160228_1841'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimesheetRollup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('month', models.DateField(verbose_name='Month')),
+                ('nature', models.CharField(default=b'PROD', max_length=30, verbose_name='Type', choices=[(b'PROD', 'Productif'), (b'NONPROD', 'Non productif'), (b'HOLIDAYS', 'Cong\xe9s')])),
+                ('charge', models.FloatField(default=0, verbose_name='Load')),
+                ('amount', models.FloatField(default=0, verbose_name='Amount')),
+                ('consultant', models.ForeignKey(to='people.Consultant')),
+                ('mission', models.ForeignKey(to='staffing.Mission')),
+            ],
+            options={
+                'ordering': ['month', 'consultant'],
+                'verbose_name': 'Timesheet rollup',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='timesheetrollup',
+            unique_together=set([('consultant', 'mission', 'month')]),
+        ),
+        migrations.RunPython(fill_timesheet_rollup, migrations.RunPython.noop),
+    ]
@@ -5,23 +5,32 @@ Database access layer for pydici staffing module
 @license: AGPL v3 or newer (http://www.gnu.org/licenses/agpl-3.0.html)
 """
 
-from django.db import models, connections
-from django.db.models import Sum, Min
+from django.db import models, connections, transaction
+from django.db.models import Sum, Min, F
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import ugettext
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.contrib.auth.models import User
 from django.contrib.admin.models import ContentType
 from django.core.urlresolvers import reverse
 
 from datetime import datetime, date, timedelta
 
+HAVE_NUMPY = True
+try:
+    import numpy as np
+except ImportError:
+    HAVE_NUMPY = False
+
 from leads.models import Lead
-from people.models import Consultant
+from people.models import Consultant, RateObjective
+from people.utils import getRateObjectives
 from crm.models import MissionContact, Subsidiary
 from actionset.utils import launchTrigger
 from actionset.models import ActionState
-from core.utils import disable_for_loaddata, cacheable, convertDictKeyToDate, nextMonth
+from core.utils import disable_for_loaddata, cacheable, convertDictKeyToDate, nextMonth, get_version_stamp, bump_version_stamp, \
+    bump_cacheable_generations, modelVersionSignalHandler, bump_model_version_stamp
+from core.search import searchIndexSignalHandler, searchIndexDeleteSignalHandler
 
 
 class Mission(models.Model):
@@ -103,14 +112,9 @@ class Mission(models.Model):
             staffing_date = self.lead.start_date
         else:
             staffing_date = today
-        for consultant in self.lead.staffing.all():
-            staffing = Staffing()
-            staffing.mission = self
-            staffing.consultant = consultant
-            staffing.staffing_date = staffing_date
-            staffing.update_date = datetime.now().replace(microsecond=0)  # Remove useless microsecond that pollute form validation in callback
-            staffing.last_user = "-"
-            staffing.save()
+        Staffing.bulk_upsert([self], self.lead.staffing.all(), [staffing_date], update=False,
+                             update_date=datetime.now().replace(microsecond=0),  # Remove useless microsecond that pollute form validation in callback
+                             last_user="-")
 
     def sister_missions(self):
         """Return other missions linked to the same deal"""
@@ -119,12 +123,14 @@ class Mission(models.Model):
         else:
             return []
 
-    @cacheable("Mission.consultant_rates%(id)s", 5)
+    @cacheable("Mission.consultant_rates%(id)s", 6 * 3600,
+               depends_on=[("staffing.FinancialCondition", "mission"), ("staffing.Staffing", "mission"),
+                           ("staffing.Timesheet", "mission"), "people.Consultant"])
     def consultant_rates(self):
         """@return: dict with consultant as key and (daily rate, bought daily rate) as value or 0 if not defined."""
-        rates = {}
-        for condition in FinancialCondition.objects.filter(mission=self).select_related():
-            rates[condition.consultant] = (condition.daily_rate, condition.bought_daily_rate)
+        mission_rates = rateResolver.mission_rates(self.id)
+        consultants = Consultant.objects.in_bulk(mission_rates.keys())
+        rates = dict((consultants[consultant_id], rate) for consultant_id, rate in mission_rates.items())
         # Put 0 for consultant forecasted on this mission but without defined daily rate
         for consultant in self.consultants():
             if not consultant in rates:
@@ -135,7 +141,7 @@ class Mission(models.Model):
         """@return: True if all rates are defined for consultants forecasted or that already consume time for this mission. Else False"""
         return not bool([i[0] for i in self.consultant_rates().values()].count(0))
 
-    @cacheable("Mission.mission_id%(id)s", 120)
+    @cacheable("Mission.mission_id%(id)s", 6 * 3600, depends_on=["staffing.Mission", "leads.Lead"])
     def mission_id(self):
         """Compute mission id :
             if mission has lead, it is based on lead deal_id if exists
@@ -148,48 +154,77 @@ class Mission(models.Model):
         else:
             return unicode(self.id)
 
-    @cacheable("Mission.done_work%(id)s", 10)
+    @classmethod
+    def mission_ids(cls, missions):
+        """Compute mission id of many missions with one query. Same rules as mission_id()
+        @param missions: missions list. Leads should be fetched with select_related to avoid extra queries
+        @return: dict with mission pk as key and mission id as value"""
+        result = {}
+        ranks = {}  # Mission rank in its lead. Key is mission pk
+        lead_ranks = {}  # Number of missions of each lead
+        lead_ids = set(m.lead_id for m in missions if m.lead and m.lead.deal_id)
+        for lead_id, mission_id in cls.objects.filter(lead__in=lead_ids).order_by("id").values_list("lead_id", "id"):
+            ranks[mission_id] = lead_ranks.get(lead_id, 0)
+            lead_ranks[lead_id] = ranks[mission_id] + 1
+        for mission in missions:
+            if mission.lead and mission.lead.deal_id:
+                result[mission.id] = mission.lead.deal_id + chr(97 + ranks[mission.id])  # chr(97) is 'a'
+            elif mission.deal_id:
+                result[mission.id] = mission.deal_id
+            else:
+                result[mission.id] = unicode(mission.id)
+        return result
+
+    @cacheable("Mission.done_work%(id)s", 6 * 3600,
+               depends_on=[("staffing.Timesheet", "mission"), ("staffing.FinancialCondition", "mission")])
     def done_work(self):
         """Compute done work according to timesheet for this mission
-        Result is cached for few seconds
+        Result is cached until timesheet or financial conditions of this mission change
         @return: (done work in days, done work in euros)"""
-        rates = dict([(i.id, j[0]) for i, j in self.consultant_rates().items()])  # switch to consultant id
-        days = 0
-        amount = 0
-        timesheets = Timesheet.objects.filter(mission=self, working_date__lt=nextMonth(date.today()))
-        timesheets = timesheets.values_list("consultant").annotate(Sum("charge")).order_by()
-        for consultant_id, charge in timesheets:
-            days += charge
-            if consultant_id in rates:
-                amount += charge * rates[consultant_id]
-        return (days, amount)
+        return Mission.done_works([self])[self.id]
+
+    @classmethod
+    def done_works(cls, missions):
+        """Compute done work according to timesheet of many missions with one query
+        @param missions: missions list or queryset
+        @return: dict with mission id as key and (done work in days, done work in euros) as value"""
+        result = dict((mission.id, (0, 0)) for mission in missions)
+        rollups = TimesheetRollup.objects.filter(mission__in=result.keys(), month__lt=nextMonth(date.today()))
+        for mission_id, days, amount in rollups.values_list("mission").annotate(Sum("charge"), Sum("amount")).order_by():
+            result[mission_id] = (days, amount)
+        return result
 
     def done_work_k(self):
         """Same as done_work, but with amount in keur"""
         days, amount = self.done_work()
         return days, amount / 1000
 
-    @cacheable("Mission.forecasted_work%(id)s", 10)
+    @cacheable("Mission.forecasted_work%(id)s", 6 * 3600,
+               depends_on=[("staffing.Staffing", "mission"), ("staffing.Timesheet", "mission"), ("staffing.FinancialCondition", "mission")])
     def forecasted_work(self):
         """Compute forecasted work according to staffing for this mission
-        Result is cached for few seconds
+        Result is cached until staffing, timesheet or financial conditions of this mission change
         @return: (forecasted work in days, forecasted work in euros"""
-        rates = dict([(i.id, j[0]) for i, j in self.consultant_rates().items()])  # switch to consultant id
-        days = 0
-        amount = 0
+        return Mission.forecasted_works([self])[self.id]
+
+    @classmethod
+    def forecasted_works(cls, missions):
+        """Compute forecasted work according to staffing of many missions with two queries.
+        Current month done work is substracted from current month forecast
+        @param missions: missions list or queryset
+        @return: dict with mission id as key and (forecasted work in days, forecasted work in euros) as value"""
+        result = dict((mission.id, (0, 0)) for mission in missions)
+        rates = rateResolver.rates()
         current_month = date.today().replace(day=1)
-        staffings = Staffing.objects.filter(mission=self, staffing_date__gte=current_month)
-        staffings = staffings.values_list("consultant").annotate(Sum("charge")).order_by()
-        current_month_done = Timesheet.objects.filter(mission=self, working_date__gte=current_month, working_date__lt=nextMonth(date.today()))
-        current_month_done = dict(current_month_done.values_list("consultant").annotate(Sum("charge")).order_by())
-        for consultant_id, charge in staffings:
-            days += charge  # Add forecasted days
-            days -= current_month_done.get(consultant_id, 0) # Substract current month done works from forecastinng
-            if consultant_id in rates:
-                amount += charge * rates[consultant_id]
-                amount -= current_month_done.get(consultant_id, 0) * rates[consultant_id]
-
-        return (days, amount)
+        staffings = Staffing.objects.filter(mission__in=result.keys(), staffing_date__gte=current_month)
+        staffings = staffings.values_list("mission", "consultant").annotate(Sum("charge")).order_by()
+        current_month_done = TimesheetRollup.objects.filter(mission__in=result.keys(), month=current_month)
+        current_month_done = dict(((m, c), charge) for m, c, charge in current_month_done.values_list("mission", "consultant", "charge"))
+        for mission_id, consultant_id, charge in staffings:
+            charge -= current_month_done.get((mission_id, consultant_id), 0)  # Substract current month done works from forecasting
+            days, amount = result[mission_id]
+            result[mission_id] = (days + charge, amount + charge * rates.get((mission_id, consultant_id), (0, 0))[0])
+        return result
 
     def forecasted_work_k(self):
         """Same as forecasted_work, but with amount in keur"""
@@ -199,48 +234,94 @@ class Mission(models.Model):
     def margin(self, mode="current"):
         """Compute mission margin in keuros
         @:parameter mode: can be current (default) to compute margin as of today (ie. remaining budget) or target to compute margin at mission end (with forecasted work"""
-        if self.price:
-            done_days, done_amount = self.done_work_k()
-            if mode=="current":
-                return float(self.price) - done_amount
-            else: # Target
-                forecasted_days, forecasted_amount = self.forecasted_work_k()
-                return float(self.price) - done_amount - forecasted_amount
-        else:
-            return 0
+        return Mission.margins([self], mode)[self.id]
+
+    @classmethod
+    def margins(cls, missions, mode="current"):
+        """Compute margin in keuros of many missions with a constant number of queries
+        @param missions: missions list or queryset
+        @param mode: current (default) or target. See margin()
+        @return: dict with mission id as key and margin in keuros as value"""
+        result = dict((mission.id, 0) for mission in missions)
+        priced = [mission for mission in missions if mission.price]
+        if not priced:
+            return result
+        done_works = Mission.done_works(priced)
+        if mode != "current":  # Target
+            forecasted_works = Mission.forecasted_works(priced)
+        for mission in priced:
+            margin = float(mission.price) - done_works[mission.id][1] / 1000
+            if mode != "current":
+                margin -= forecasted_works[mission.id][1] / 1000
+            result[mission.id] = margin
+        return result
 
     def objectiveMargin(self, startDate=None, endDate=None):
         """Compute margin over rate objective
         @param startDate: starting date to consider. This date is included in range. If None, start date is the begining of the mission
         @param endDate: ending date to consider. This date is excluded from range. If None, end date is last timesheet for this mission.
         @return: dict where key is consultant, value is cumulated margin over objective"""
-        dateTrunc = connections[Timesheet.objects.db].ops.date_trunc_sql  # Shortcut to SQL date trunc function
-        result = {}
-        consultant_rates = self.consultant_rates()
-        # Gather timesheet (Only consider timesheet up to current month)
-        timesheets = Timesheet.objects.filter(mission=self)
-        if startDate:
-            timesheets = timesheets.filter(working_date__gte=startDate)
-        if endDate:
-            timesheets = timesheets.filter(working_date__lt=endDate)
-        timesheets = timesheets.order_by("working_date")
-        timesheetMonths = list(timesheets.dates("working_date", "month"))
-        for consultant in self.consultants():
-            result[consultant] = 0  # Initialize margin over rate objective for this consultant
-            data = dict(timesheets.filter(consultant=consultant).extra(select={'month': dateTrunc("month", "working_date")}).values_list("month").annotate(Sum("charge")).order_by("month"))
-            data = convertDictKeyToDate(data)
-
-            for month in timesheetMonths:
-                n_days = data.get(month, 0)
-                if consultant.subcontractor:
-                    # Compute objective margin on sold rate
-                    if consultant_rates[consultant][0] and consultant_rates[consultant][1]:
-                        result[consultant] += n_days * (consultant_rates[consultant][0] - consultant_rates[consultant][1])
-                else:
-                    # Compute objective margin on rate objective for this period
-                    objectiveRate = consultant.getRateObjective(workingDate=month, rate_type="DAILY_RATE")
-                    if objectiveRate:
-                        result[consultant] += n_days * (consultant_rates[consultant][0] - objectiveRate.rate)
+        return Mission.objective_margins([self], startDate, endDate)[self.id]
+
+    @classmethod
+    def objective_margins(cls, missions, startDate=None, endDate=None):
+        """Compute margin over rate objective of many missions with a constant number of queries.
+        Subcontractors margin is computed on sold rate minus bought rate, other consultants margin on sold rate minus
+        rate objective of each timesheet month
+        @param missions: missions list or queryset
+        @param startDate: starting date to consider. This date is included in range. If None, start date is the begining of each mission
+        @param endDate: ending date to consider. This date is excluded from range. If None, end date is last timesheet of each mission.
+        @return: dict with mission id as key and dict (consultant as key, cumulated margin over objective as value) as value"""
+        mission_ids = [mission.id for mission in missions]
+        # Consultants forecasted or that once charge timesheet for each mission
+        pairs = set(Staffing.objects.filter(mission__in=mission_ids).values_list("mission", "consultant").distinct().order_by())
+        pairs.update(TimesheetRollup.objects.filter(mission__in=mission_ids).values_list("mission", "consultant").distinct().order_by())
+        consultants = Consultant.objects.in_bulk(set(consultant_id for mission_id, consultant_id in pairs))
+        result = dict((mission_id, {}) for mission_id in mission_ids)
+        for mission_id, consultant_id in pairs:
+            result[mission_id][consultants[consultant_id]] = 0
+
+        # Timesheet month sums. Rollup can be used unless bounds do not fall on month start
+        if all(d is None or d.day == 1 for d in (startDate, endDate)):
+            timesheets = TimesheetRollup.objects.filter(mission__in=mission_ids)
+            if startDate:
+                timesheets = timesheets.filter(month__gte=startDate)
+            if endDate:
+                timesheets = timesheets.filter(month__lt=endDate)
+            timesheets = list(timesheets.values_list("mission", "consultant", "month", "charge"))
+        else:
+            dateTrunc = connections[Timesheet.objects.db].ops.date_trunc_sql  # Shortcut to SQL date trunc function
+            timesheets = Timesheet.objects.filter(mission__in=mission_ids)
+            if startDate:
+                timesheets = timesheets.filter(working_date__gte=startDate)
+            if endDate:
+                timesheets = timesheets.filter(working_date__lt=endDate)
+            timesheets = timesheets.extra(select={"month": dateTrunc("month", "working_date")})
+            timesheets = timesheets.values_list("mission", "consultant", "month").annotate(Sum("charge")).order_by()
+            timesheets = list(timesheets)
+            # Month returned by database can be string, datetime or date depending on backend
+            monthDates = dict((v, k) for k, v in convertDictKeyToDate(dict((t[2], t[2]) for t in timesheets)).items())
+            timesheets = [(m, c, monthDates[month], charge) for m, c, month, charge in timesheets]
+        if not timesheets:
+            return result
+
+        rates = rateResolver.rates()
+        objectives = getRateObjectives([c for c in consultants.values() if not c.subcontractor],
+                                       list(set(month for m, c, month, charge in timesheets)))
+        sold = [rates.get((m, c), (0, 0))[0] for m, c, month, charge in timesheets]
+        bought = [rates.get((m, c), (0, 0))[1] for m, c, month, charge in timesheets]
+        # Subcontractor with sold and bought rate defined or consultant with rate objective defined
+        subcontractor = [consultants[c].subcontractor for m, c, month, charge in timesheets]
+        reference = [b if sub else objectives.get((c, month)) for (m, c, month, charge), b, sub in zip(timesheets, bought, subcontractor)]
+        defined = [bool(s and r) if sub else r is not None for s, r, sub in zip(sold, reference, subcontractor)]
+        if HAVE_NUMPY:
+            margins = np.where(defined,
+                               np.array([t[3] for t in timesheets], dtype=float) * (np.array(sold, dtype=float) - np.array([r or 0 for r in reference], dtype=float)),
+                               0).tolist()
+        else:
+            margins = [charge * (s - r) if d else 0 for (m, c, month, charge), s, r, d in zip(timesheets, sold, reference, defined)]
+        for (mission_id, consultant_id, month, charge), margin in zip(timesheets, margins):
+            result[mission_id][consultants[consultant_id]] += margin
         return result
 
     def actions(self):
@@ -261,7 +342,7 @@ class Mission(models.Model):
         """returns done actions for this mission and its lead"""
         return self.actions().exclude(state="TO_BE_DONE")
 
-    @cacheable("Mission.staffing_start_date%(id)s", 10)
+    @cacheable("Mission.staffing_start_date%(id)s", 6 * 3600, depends_on=[("staffing.Staffing", "mission")])
     def staffing_start_date(self):
         """Starting date (=oldiest) staffing date of this mission. None if no staffing"""
         start_dates = self.staffing_set.all().aggregate(Min("staffing_date")).values()
@@ -278,40 +359,39 @@ class Mission(models.Model):
         mission_name = self.short_name()
         current_month = date.today().replace(day=1)  # Current month
         subsidiary = unicode(self.subsidiary)
-        dateTrunc = connections[Timesheet.objects.db].ops.date_trunc_sql  # Shortcut to SQL date trunc function
         consultant_rates = self.consultant_rates()
         billing_mode = self.get_billing_mode_display()
 
-        # Gather timesheet and staffing (Only consider data up to current month)
-        timesheets = Timesheet.objects.filter(mission=self).filter(working_date__lt=nextMonth(current_month)).order_by("working_date")
-        staffings = Staffing.objects.filter(mission=self).filter(staffing_date__lt=nextMonth(current_month)).order_by("staffing_date")
+        # Gather timesheet rollup and staffing (Only consider data up to current month)
+        rollups = TimesheetRollup.objects.filter(mission=self).filter(month__lt=nextMonth(current_month))
+        staffings = Staffing.objects.filter(mission=self).filter(staffing_date__lt=nextMonth(current_month))
         if startDate:
-            timesheets = timesheets.filter(working_date__gte=startDate)
+            rollups = rollups.filter(month__gte=startDate.replace(day=1))
             staffings = staffings.filter(staffing_date__gte=startDate)
         if endDate:
-            timesheets = timesheets.filter(working_date__lte=endDate)
+            rollups = rollups.filter(month__lte=endDate)
             staffings = staffings.filter(staffing_date__lte=endDate)
-        timesheetMonths = list(timesheets.dates("working_date", "month"))
+        timesheetMonths = list(rollups.dates("month", "month"))
         staffingMonths = list(staffings.dates("staffing_date", "month"))
 
+        timesheet_data = dict(((c, m), (charge, amount)) for c, m, charge, amount in rollups.values_list("consultant", "month", "charge", "amount"))
+        staffing_data = dict(((c, m), charge) for c, m, charge in staffings.values_list("consultant", "staffing_date").annotate(Sum("charge")).order_by())
+
         for consultant in self.consultants():
             consultant_name = unicode(consultant)
-            timesheet_data = dict(timesheets.filter(consultant=consultant).extra(select={'month': dateTrunc("month", "working_date")}).values_list("month").annotate(Sum("charge")).order_by("month"))
-            timesheet_data = convertDictKeyToDate(timesheet_data)
-            staffing_data = dict(staffings.filter(consultant=consultant).values_list("staffing_date").annotate(Sum("charge")).order_by("staffing_date"))
-            staffing_data = convertDictKeyToDate(staffing_data)
-
             for month in set(timesheetMonths + staffingMonths):
+                done_days, done_amount = timesheet_data.get((consultant.id, month), (0, 0))
+                forecast_days = staffing_data.get((consultant.id, month), 0)
                 data.append({ugettext("mission id"): mission_id,
                              ugettext("mission name"): mission_name,
                              ugettext("consultant"): consultant_name,
                              ugettext("subsidiary"): subsidiary,
                              ugettext("billing mode"): billing_mode,
                              ugettext("date"): month.strftime("%Y/%m"),
-                             ugettext("done (days)"): timesheet_data.get(month, 0),
-                             ugettext("done (keur)"): timesheet_data.get(month, 0) * consultant_rates[consultant][0] / 1000,
-                             ugettext("forecast (days)"): staffing_data.get(month, 0),
-                             ugettext("forecast (keur)"): staffing_data.get(month, 0) * consultant_rates[consultant][0] / 1000})
+                             ugettext("done (days)"): done_days,
+                             ugettext("done (keur)"): done_amount / 1000,
+                             ugettext("forecast (days)"): forecast_days,
+                             ugettext("forecast (keur)"): forecast_days * consultant_rates[consultant][0] / 1000})
         return data
 
 
@@ -323,6 +403,10 @@ class Mission(models.Model):
         verbose_name = _("Mission")
 
 
+HOLIDAY_VERSION_CACHE_KEY = "HOLIDAY_VERSION"
+CONSULTANT_METRICS_VERSION_CACHE_KEY = "CONSULTANT_METRICS_VERSION_%s"  # Consultant id
+
+
 class Holiday(models.Model):
     """List of public and enterprise specific holidays"""
     day = models.DateField(_("Date"))
@@ -349,6 +433,33 @@ class Staffing(models.Model):
         self.staffing_date = datetime(self.staffing_date.year, self.staffing_date.month, 1)
         super(Staffing, self).save(*args, **kwargs)
 
+    @classmethod
+    @transaction.atomic
+    def bulk_upsert(cls, missions, consultants, staffing_dates, update=True, **values):
+        """Create or update staffing of each mission, consultant and date with the same values.
+        Existing rows are resolved with one query, updated with one query and missing ones are created in batch
+        @param missions: missions list or queryset
+        @param consultants: consultants list or queryset
+        @param staffing_dates: list of dates. Only month is considered
+        @param update: update existing staffing with values. If False, only missing staffing are created
+        @param values: staffing fields values (charge, comment, update_date, last_user)
+        @return: (number of created staffing, number of updated staffing)"""
+        mission_ids = [m.id for m in missions]
+        consultant_ids = [c.id for c in consultants]
+        staffing_dates = set(date(d.year, d.month, 1) for d in staffing_dates)
+        existing = cls.objects.filter(mission_id__in=mission_ids, consultant_id__in=consultant_ids, staffing_date__in=staffing_dates)
+        existing = dict(((m, c, d), i) for i, m, c, d in existing.values_list("id", "mission_id", "consultant_id", "staffing_date"))
+        if update and existing and values:
+            cls.objects.filter(id__in=existing.values()).update(**values)
+        staffings = [cls(mission_id=m, consultant_id=c, staffing_date=d, **values)
+                     for m in mission_ids for c in consultant_ids for d in staffing_dates if (m, c, d) not in existing]
+        cls.objects.bulk_create(staffings, batch_size=500)
+        bump_cacheable_generations(cls, mission=mission_ids, consultant=consultant_ids)  # Bulk operations do not send signals
+        bump_model_version_stamp(cls)
+        for consultant_id in consultant_ids:
+            bump_version_stamp(CONSULTANT_METRICS_VERSION_CACHE_KEY % consultant_id)
+        return len(staffings), len(existing) if update else 0
+
     def get_absolute_url(self):
         return reverse("people.views.consultant_home", args=[str(self.consultant.trigramme)]) + "#tab-staffing"
 
@@ -398,6 +509,131 @@ class FinancialCondition(models.Model):
         verbose_name = _("Financial condition")
 
 
+FINANCIAL_CONDITION_VERSION_CACHE_KEY = "FINANCIAL_CONDITION_VERSION"
+
+
+class RateResolver(object):
+    """Process local map of financial conditions: (mission id, consultant id) => (daily rate, bought daily rate).
+    Map is loaded once and shared by all callers of the process. A version stamp stored in cache is changed
+    on each financial condition update to tell every process to load it again"""
+    def __init__(self):
+        self._maps = None  # Rates map and its index by mission: mission id => {consultant id: (daily rate, bought daily rate)}
+        self._version = None
+
+    def maps(self):
+        """@return: rates map (see rates()) and its index by mission (see mission_rates())"""
+        version = get_version_stamp(FINANCIAL_CONDITION_VERSION_CACHE_KEY)
+        if self._maps is None or version != self._version:
+            rates = {}
+            mission_rates = {}
+            for mission_id, consultant_id, daily_rate, bought_daily_rate in FinancialCondition.objects.values_list("mission_id", "consultant_id", "daily_rate", "bought_daily_rate").order_by("id"):
+                rates[(mission_id, consultant_id)] = (daily_rate, bought_daily_rate)
+                mission_rates.setdefault(mission_id, {})[consultant_id] = (daily_rate, bought_daily_rate)
+            self._maps, self._version = (rates, mission_rates), version
+        return self._maps
+
+    def rates(self):
+        """@return: dict with (mission id, consultant id) as key and (daily rate, bought daily rate) as value"""
+        return self.maps()[0]
+
+    def get(self, mission_id, consultant_id, default=(0, 0)):
+        """@return: (daily rate, bought daily rate) of consultant on mission or default if not defined"""
+        return self.rates().get((mission_id, consultant_id), default)
+
+    def get_many(self, keys, default=(0, 0)):
+        """Batch lookup
+        @param keys: iterable of (mission id, consultant id)
+        @return: dict with (mission id, consultant id) as key and (daily rate, bought daily rate) as value"""
+        rates = self.rates()
+        return dict((key, rates.get(key, default)) for key in keys)
+
+    def mission_rates(self, mission_id):
+        """@return: dict with consultant id as key and (daily rate, bought daily rate) as value for given mission"""
+        return dict(self.maps()[1].get(mission_id, {}))
+
+    def invalidate(self):
+        """Drop local map and change shared version stamp. Stamp is changed again once transaction is committed
+        to prevent other processes from keeping rates loaded before commit"""
+        self._maps = None
+        bump_version_stamp(FINANCIAL_CONDITION_VERSION_CACHE_KEY)
+
+rateResolver = RateResolver()
+
+
+class TimesheetRollup(models.Model):
+    """Timesheet monthly rollup: charge and valued amount per month per consultant per mission.
+    This table is derived from Timesheet, Mission nature and FinancialCondition. It is kept up to date
+    by signals and can be rebuilt from scratch with the rebuild_timesheet_rollup command"""
+    consultant = models.ForeignKey(Consultant)
+    mission = models.ForeignKey(Mission)
+    month = models.DateField(_("Month"))
+    nature = models.CharField(_("Type"), max_length=30, choices=Mission.MISSION_NATURE, default="PROD")
+    charge = models.FloatField(_("Load"), default=0)
+    amount = models.FloatField(_("Amount"), default=0)
+
+    def __unicode__(self):
+        return "%s/%s - %s: %s" % (self.month.month, self.month.year, self.consultant.trigramme, self.charge)
+
+    @classmethod
+    def refresh(cls, consultant_id, month, mission_ids=None):
+        """Compute again rollup of given consultant for the given month
+        @param mission_ids: only refresh those missions. All consultant missions of the month if None"""
+        month = month.replace(day=1)
+        timesheets = Timesheet.objects.filter(consultant_id=consultant_id, working_date__gte=month, working_date__lt=nextMonth(month))
+        rollups = cls.objects.filter(consultant_id=consultant_id, month=month)
+        if mission_ids is not None:
+            timesheets = timesheets.filter(mission_id__in=mission_ids)
+            rollups = rollups.filter(mission_id__in=mission_ids)
+        charges = dict(timesheets.values_list("mission").annotate(Sum("charge")).order_by())
+        natures = dict(Mission.objects.filter(id__in=charges.keys()).values_list("id", "nature"))
+        with transaction.atomic():
+            for rollup in rollups:
+                if rollup.mission_id not in charges:
+                    # No more timesheet for this mission
+                    rollup.delete()
+                    continue
+                charge = charges.pop(rollup.mission_id)
+                rollup.charge = charge
+                rollup.amount = charge * rateResolver.get(rollup.mission_id, consultant_id)[0]
+                rollup.nature = natures[rollup.mission_id]
+                rollup.save()
+            for mission_id, charge in charges.items():
+                cls.objects.create(consultant_id=consultant_id, mission_id=mission_id, month=month,
+                                   nature=natures[mission_id], charge=charge,
+                                   amount=charge * rateResolver.get(mission_id, consultant_id)[0])
+
+    @classmethod
+    def refresh_amount(cls, mission_id, consultant_id):
+        """Compute again valued amount of mission consultant rollup according to its current daily rate"""
+        rate = rateResolver.get(mission_id, consultant_id)[0]
+        cls.objects.filter(mission_id=mission_id, consultant_id=consultant_id).update(amount=F("charge") * rate)
+
+    @classmethod
+    @transaction.atomic
+    def rebuild(cls):
+        """Drop and compute again the whole rollup table from timesheet data.
+        @return: number of rollup created"""
+        n = 0
+        cls.objects.all().delete()
+        natures = dict(Mission.objects.values_list("id", "nature"))
+        rates = rateResolver.rates()
+        for month in Timesheet.objects.dates("working_date", "month"):
+            timesheets = Timesheet.objects.filter(working_date__gte=month, working_date__lt=nextMonth(month))
+            timesheets = timesheets.values_list("consultant", "mission").annotate(Sum("charge")).order_by()
+            rollups = [cls(consultant_id=consultant_id, mission_id=mission_id, month=month,
+                           nature=natures[mission_id], charge=charge,
+                           amount=charge * rates.get((mission_id, consultant_id), (0, 0))[0])
+                       for consultant_id, mission_id, charge in timesheets]
+            cls.objects.bulk_create(rollups)
+            n += len(rollups)
+        return n
+
+    class Meta:
+        unique_together = (("consultant", "mission", "month"),)
+        ordering = ["month", "consultant"]
+        verbose_name = _("Timesheet rollup")
+
+
 # Signal handling to throw actionset
 @disable_for_loaddata
 def missionSignalHandler(sender, **kwargs):
@@ -442,3 +678,83 @@ def missionSignalHandler(sender, **kwargs):
 
 # Signal connection to throw actionset
 post_save.connect(missionSignalHandler, sender=Mission)
+
+
+# Signal handling to keep timesheet rollup up to date. Fixtures loading is also considered.
+def timesheetRollupSignalHandler(sender, **kwargs):
+    """Signal handler for new/updated/deleted timesheet"""
+    timesheet = kwargs["instance"]
+    TimesheetRollup.refresh(timesheet.consultant_id, timesheet.working_date, mission_ids=[timesheet.mission_id, ])
+    previous = getattr(timesheet, "_previous_rollup", None)
+    if previous:
+        # Timesheet moved to another consultant, month or mission
+        TimesheetRollup.refresh(previous[0], previous[1], mission_ids=[previous[2], ])
+        timesheet._previous_rollup = None
+
+
+def timesheetRollupPreSaveSignalHandler(sender, **kwargs):
+    """Signal handler for updated timesheet. Remember its previous rollup if it changes"""
+    timesheet = kwargs["instance"]
+    if timesheet.pk is None:
+        return
+    for consultant_id, working_date, mission_id in Timesheet.objects.filter(pk=timesheet.pk).values_list("consultant", "working_date", "mission"):
+        if (consultant_id, working_date.replace(day=1), mission_id) != (timesheet.consultant_id, timesheet.working_date.replace(day=1), timesheet.mission_id):
+            timesheet._previous_rollup = (consultant_id, working_date, mission_id)
+
+
+def holidaySignalHandler(sender, **kwargs):
+    """Signal handler for new/updated/deleted holiday. Invalidate holidays cache"""
+    bump_version_stamp(HOLIDAY_VERSION_CACHE_KEY)
+
+
+def financialConditionSignalHandler(sender, **kwargs):
+    """Signal handler for new/updated/deleted financial condition. Invalidate rate resolver"""
+    rateResolver.invalidate()
+
+
+def financialConditionRollupSignalHandler(sender, **kwargs):
+    """Signal handler for new/updated/deleted financial condition"""
+    condition = kwargs["instance"]
+    TimesheetRollup.refresh_amount(condition.mission_id, condition.consultant_id)
+
+
+def consultantMetricsSignalHandler(sender, **kwargs):
+    """Signal handler for new/updated/deleted timesheet, staffing, financial condition and rate objective.
+    Invalidate consultant metrics"""
+    bump_version_stamp(CONSULTANT_METRICS_VERSION_CACHE_KEY % kwargs["instance"].consultant_id)
+
+
+def missionRollupSignalHandler(sender, **kwargs):
+    """Signal handler for updated missions. Mission nature is denormalized in rollup"""
+    mission = kwargs["instance"]
+    if TimesheetRollup.objects.filter(mission=mission).exclude(nature=mission.nature).update(nature=mission.nature):
+        # Nature changed. Production rate of consultants who worked on this mission changes as well
+        for consultant_id in TimesheetRollup.objects.filter(mission=mission).values_list("consultant", flat=True).distinct():
+            bump_version_stamp(CONSULTANT_METRICS_VERSION_CACHE_KEY % consultant_id)
+
+pre_save.connect(timesheetRollupPreSaveSignalHandler, sender=Timesheet)
+post_save.connect(timesheetRollupSignalHandler, sender=Timesheet)
+post_delete.connect(timesheetRollupSignalHandler, sender=Timesheet)
+post_save.connect(holidaySignalHandler, sender=Holiday)
+post_delete.connect(holidaySignalHandler, sender=Holiday)
+post_save.connect(financialConditionSignalHandler, sender=FinancialCondition)
+post_delete.connect(financialConditionSignalHandler, sender=FinancialCondition)
+post_save.connect(financialConditionRollupSignalHandler, sender=FinancialCondition)
+post_delete.connect(financialConditionRollupSignalHandler, sender=FinancialCondition)
+post_save.connect(missionRollupSignalHandler, sender=Mission)
+post_save.connect(consultantMetricsSignalHandler, sender=Timesheet)
+post_delete.connect(consultantMetricsSignalHandler, sender=Timesheet)
+post_save.connect(consultantMetricsSignalHandler, sender=Staffing)
+post_delete.connect(consultantMetricsSignalHandler, sender=Staffing)
+post_save.connect(consultantMetricsSignalHandler, sender=FinancialCondition)
+post_delete.connect(consultantMetricsSignalHandler, sender=FinancialCondition)
+post_save.connect(consultantMetricsSignalHandler, sender=RateObjective)
+post_delete.connect(consultantMetricsSignalHandler, sender=RateObjective)
+post_save.connect(modelVersionSignalHandler, sender=Timesheet)
+post_delete.connect(modelVersionSignalHandler, sender=Timesheet)
+post_save.connect(modelVersionSignalHandler, sender=Staffing)
+post_delete.connect(modelVersionSignalHandler, sender=Staffing)
+post_save.connect(modelVersionSignalHandler, sender=Mission)
+post_delete.connect(modelVersionSignalHandler, sender=Mission)
+post_save.connect(searchIndexSignalHandler, sender=Mission)
+post_delete.connect(searchIndexDeleteSignalHandler, sender=Mission)
@@ -12,12 +12,15 @@ from datetime import date, datetime
 
 from django.conf import settings
 from django.db import transaction
+from django.db.models import Sum, Case, When, Value, FloatField
 from django.utils import formats
-from django.core.cache import cache
 
-from staffing.models import Timesheet, Mission, LunchTicket, Holiday
-from core.utils import month_days, nextMonth, daysOfMonth
-from people.models import TIMESHEET_IS_UP_TO_DATE_CACHE_KEY, CONSULTANT_IS_IN_HOLIDAYS_CACHE_KEY
+from staffing.models import Timesheet, Mission, LunchTicket, Holiday, Staffing, TimesheetRollup, \
+    HOLIDAY_VERSION_CACHE_KEY, CONSULTANT_METRICS_VERSION_CACHE_KEY, rateResolver
+from crm.models import Company
+from core.utils import month_days, nextMonth, previousMonth, daysOfMonth, get_version_stamp, bump_version_stamp, \
+    working_days_mask, watermark_cached, bump_cacheable_generations, bump_model_version_stamp
+from people.utils import getRateObjectives
 
 
 def gatherTimesheetData(consultant, missions, month):
@@ -31,16 +34,15 @@ def gatherTimesheetData(consultant, missions, month):
     warning = []
     totalPerDay = [0] * month_days(month)
     next_month = nextMonth(month)
-    for mission in missions:
-        timesheets = Timesheet.objects.select_related().filter(consultant=consultant).filter(mission=mission)
-        timesheets = timesheets.filter(working_date__gte=month).filter(working_date__lt=next_month)
-        for timesheet in timesheets:
-            timesheetData["charge_%s_%s" % (timesheet.mission.id, timesheet.working_date.day)] = timesheet.charge
-            if mission.id in timesheetTotal:
-                timesheetTotal[mission.id] += timesheet.charge
-            else:
-                timesheetTotal[mission.id] = timesheet.charge
-            totalPerDay[timesheet.working_date.day - 1] += timesheet.charge
+    timesheets = Timesheet.objects.filter(consultant=consultant, mission__in=missions)
+    timesheets = timesheets.filter(working_date__gte=month).filter(working_date__lt=next_month)
+    for mission_id, working_date, charge in timesheets.values_list("mission_id", "working_date", "charge"):
+        timesheetData["charge_%s_%s" % (mission_id, working_date.day)] = charge
+        if mission_id in timesheetTotal:
+            timesheetTotal[mission_id] += charge
+        else:
+            timesheetTotal[mission_id] = charge
+        totalPerDay[working_date.day - 1] += charge
     # Gather lunck ticket data
     totalTicket = 0
     lunchTickets = LunchTicket.objects.filter(consultant=consultant)
@@ -59,24 +61,28 @@ def gatherTimesheetData(consultant, missions, month):
         else:  # warning (no data, or half day)
             warning.append(2)
     # Don't emit warning for no data during week ends and holidays
-    holiday_days = holidayDays(month)
-    for day in daysOfMonth(month):
-        if day.isoweekday() in (6, 7) or day in holiday_days:
+    days = daysOfMonth(month)
+    for day, workingDay in zip(days, working_days_mask(days, holidayDays(month))):
+        if not workingDay:
             warning[day.day - 1] = None
 
     return (timesheetData, timesheetTotal, warning)
 
 
+TIMESHEET_UPDATE_CHUNK_SIZE = 300  # Number of timesheets updated or deleted per query
+
+
 @transaction.atomic
 def saveTimesheetData(consultant, month, data, oldData):
-    """Save user input timesheet in database"""
-    previousMissionId = 0
-    mission = None
+    """Save user input timesheet in database. Only changed data is written, with bulk inserts,
+    updates and deletes for timesheet and lunch tickets"""
+    charges = {}  # Changed timesheet charge. Key is (mission id, day)
+    tickets = {}  # Changed lunch tickets. Key is day
+    next_month = nextMonth(month)
 
-    # Invalidate consultant cache stuff related to timesheet data
-    cache.delete(TIMESHEET_IS_UP_TO_DATE_CACHE_KEY % consultant.__dict__)
-    cache.delete(CONSULTANT_IS_IN_HOLIDAYS_CACHE_KEY % consultant.__dict__)
+    bump_version_stamp(CONSULTANT_METRICS_VERSION_CACHE_KEY % consultant.id)
 
+    # Compute diff between user input and existing data
     for key, charge in data.items():
         if not charge and not key in oldData:
             # No charge in new and old data
@@ -85,33 +91,42 @@ def saveTimesheetData(consultant, month, data, oldData):
             # Data does not changed - skip it
             continue
         (foo, missionId, day) = key.split("_")
-        day = int(day)
-        working_date = month.replace(day=day)
         if missionId == "ticket":
-            # Lunch ticket handling
-            lunchTicket, created = LunchTicket.objects.get_or_create(consultant=consultant,
-                                                                    lunch_date=working_date)
-            if charge:
-                # Create/update new data
-                lunchTicket.no_ticket = True
-                lunchTicket.save()
-            else:
-                lunchTicket.delete()
+            tickets[int(day)] = charge
         else:
-            # Standard mission handling
-            if missionId != previousMissionId:
-                mission = Mission.objects.get(id=missionId)
-                previousMissionId = missionId
-            timesheet, created = Timesheet.objects.get_or_create(consultant=consultant,
-                                                                 mission=mission,
-                                                                 working_date=working_date)
-            if charge:
-                # create/update new data
-                timesheet.charge = charge
-                timesheet.save()
-            else:
-                # remove data user just deleted
-                timesheet.delete()
+            charges[(int(missionId), int(day))] = charge
+
+    # Lunch ticket handling
+    if tickets:
+        lunchTickets = LunchTicket.objects.filter(consultant=consultant, lunch_date__gte=month, lunch_date__lt=next_month)
+        existing = set(d.day for d in lunchTickets.values_list("lunch_date", flat=True))
+        lunchTickets.filter(lunch_date__in=[month.replace(day=d) for d, c in tickets.items() if c]).update(no_ticket=True)
+        LunchTicket.objects.bulk_create([LunchTicket(consultant=consultant, lunch_date=month.replace(day=d), no_ticket=True)
+                                         for d, c in tickets.items() if c and d not in existing])
+        lunchTickets.filter(lunch_date__in=[month.replace(day=d) for d, c in tickets.items() if not c]).delete()
+
+    # Standard mission handling
+    if charges:
+        timesheets = Timesheet.objects.filter(consultant=consultant, working_date__gte=month, working_date__lt=next_month,
+                                              mission_id__in=set(m for m, d in charges.keys()))
+        existing = dict(((m, d.day), i) for i, m, d in timesheets.values_list("id", "mission_id", "working_date"))
+        updates = dict((existing[k], c) for k, c in charges.items() if c and k in existing)
+        updates = updates.items()
+        # Update by chunks to stay below database query parameters limit (999 for sqlite). Each row uses three of them
+        for i in range(0, len(updates), TIMESHEET_UPDATE_CHUNK_SIZE):
+            chunk = updates[i:i + TIMESHEET_UPDATE_CHUNK_SIZE]
+            Timesheet.objects.filter(id__in=[t for t, c in chunk]).update(
+                charge=Case(*[When(id=t, then=Value(c)) for t, c in chunk], output_field=FloatField()))
+        Timesheet.objects.bulk_create([Timesheet(consultant=consultant, mission_id=m, working_date=month.replace(day=d), charge=c)
+                                       for (m, d), c in charges.items() if c and (m, d) not in existing])
+        deletes = [existing[k] for k, c in charges.items() if not c and k in existing]
+        for i in range(0, len(deletes), TIMESHEET_UPDATE_CHUNK_SIZE):
+            # Regular delete sends signals for each timesheet, their cost is bounded by the chunk size
+            Timesheet.objects.filter(id__in=deletes[i:i + TIMESHEET_UPDATE_CHUNK_SIZE]).delete()
+        # Bulk updates and inserts do not send signals, update monthly rollup and invalidate cached data once for all
+        TimesheetRollup.refresh(consultant.id, month)
+        bump_cacheable_generations(Timesheet, consultant=[consultant.id], mission=[m for m, d in charges.keys()])
+        bump_model_version_stamp(Timesheet)
 
 
 def saveFormsetAndLog(formset, request):
@@ -161,6 +176,19 @@ def sortMissions(missions):
     return prodMissions + nonProdMissions + holidaysMissions
 
 
+_holidays = {"version": None, "days": frozenset()}  # Process local holidays cache
+
+
+def getHolidays():
+    """All holidays days. Cached in process and loaded again when a holiday is changed
+    @return: frozenset of holidays days (datetime.date)"""
+    version = get_version_stamp(HOLIDAY_VERSION_CACHE_KEY)
+    if _holidays["version"] != version:
+        _holidays["days"] = frozenset(Holiday.objects.values_list("day", flat=True))
+        _holidays["version"] = version
+    return _holidays["days"]
+
+
 def holidayDays(month=None):
     """
     @param month: month (datetime) to consider for holidays. Current month if None
@@ -168,7 +196,163 @@ def holidayDays(month=None):
     if not month:
         month = date.today()
     month = month.replace(day=1)
-    return [h.day for h in  Holiday.objects.filter(day__gte=month).filter(day__lt=nextMonth(month))]
+    next_month = nextMonth(month)
+    return sorted(d for d in getHolidays() if month <= d < next_month)
+
+
+def pdcMatrix(consultants, months, projection="balanced"):
+    """Compute staffing forecast of consultants for given months with only one staffing query
+    @param consultants: consultants queryset
+    @param months: list of month (first day of month)
+    @param projection: projection mode. none: only won missions,
+    balanced: charge weighted by mission probability, full: all forecast without ponderation
+    @return: (charges, companies). charges is a dict with (consultant id, month) as key and
+    dict of charge per mission nature as value. companies is a dict with consultant id as key
+    and set of prod missions client companies as value"""
+    charges = {}
+    companies = {}
+    staffings = Staffing.objects.filter(consultant__in=consultants, staffing_date__in=months)
+    if projection == "none":
+        staffings = staffings.filter(mission__probability=100)  # Only keep 100% mission
+    else:
+        staffings = staffings.filter(mission__probability__gt=0)  # Only exclude null (0%) mission
+    staffings = staffings.values_list("consultant_id", "staffing_date", "charge", "mission__nature", "mission__probability",
+                                      "mission__lead__client__organisation__company_id").order_by()
+    for consultant_id, month, charge, nature, probability, company_id in staffings:
+        if projection == "full":
+            weight = 1
+        else:
+            weight = probability / 100.0
+        natures = charges.setdefault((consultant_id, month), {"PROD": 0, "NONPROD": 0, "HOLIDAYS": 0})
+        natures[nature] = natures.get(nature, 0) + charge * weight
+        if nature == "PROD" and company_id:
+            companies.setdefault(consultant_id, set()).add(company_id)
+
+    # Resolve client companies in one query
+    company_ids = set()
+    for ids in companies.values():
+        company_ids.update(ids)
+    company_objects = Company.objects.in_bulk(company_ids)
+    for consultant_id, ids in companies.items():
+        companies[consultant_id] = set(company_objects[i] for i in ids)
+
+    return charges, companies
+
+
+def consultantsProdData(consultants, months):
+    """Compute done days per mission nature and turnover of consultants for given months in a few grouped queries.
+    Closed months are read from timesheet rollup, current month only consider timesheet up to today.
+    @param consultants: consultants list or queryset
+    @param months: list of month (first day of month)
+    @return: (days, turnover). Both are dict with (consultant id, month) as key. days value is a dict of
+    days per mission nature, turnover value is the turnover of PROD missions in euros"""
+    days = {}
+    turnover = {}
+    today = date.today()
+    closedMonths = [m for m in months if nextMonth(m) <= today]
+    openMonths = [m for m in months if nextMonth(m) > today]
+
+    rollups = TimesheetRollup.objects.filter(consultant__in=consultants, month__in=closedMonths)
+    rollups = rollups.values_list("consultant", "month", "nature").annotate(Sum("charge"), Sum("amount")).order_by()
+    for consultant_id, month, nature, charge, amount in rollups:
+        days.setdefault((consultant_id, month), {})[nature] = charge
+        if nature == "PROD":
+            turnover[(consultant_id, month)] = amount
+
+    for month in openMonths:
+        timesheets = Timesheet.objects.filter(consultant__in=consultants, charge__gt=0,
+                                              working_date__gte=month, working_date__lt=min(today, nextMonth(month)))
+        timesheets = timesheets.values_list("consultant", "mission", "mission__nature").annotate(Sum("charge")).order_by()
+        for consultant_id, mission_id, nature, charge in timesheets:
+            consultant_days = days.setdefault((consultant_id, month), {})
+            consultant_days[nature] = consultant_days.get(nature, 0) + charge
+            if nature == "PROD":
+                turnover[(consultant_id, month)] = turnover.get((consultant_id, month), 0) + charge * rateResolver.get(mission_id, consultant_id)[0]
+
+    return days, turnover
+
+
+def consultantRatesData(consultant, startDate, endDate):
+    """Compute monthly daily rate, production rate and rate objectives of a consultant in three queries
+    @param consultant: consultant
+    @param startDate: first month considered (first day of month)
+    @param endDate: end of period, excluded (first day of month)
+    @return: list of (month, daily rate, production rate, daily rate objective, production rate objective) for each month
+    with timesheet. Daily rate and production rate are None if not defined or null, objectives are None if not defined"""
+    days = {}  # Key is month, value is dict of days per mission nature
+    valued = {}  # Key is month, value is (amount, days with a defined rate)
+    rollups = TimesheetRollup.objects.filter(consultant=consultant, charge__gt=0, month__gte=startDate, month__lt=endDate)
+    rollups = rollups.values_list("month", "nature", "mission").annotate(Sum("charge"), Sum("amount")).order_by()
+    rates = rateResolver.rates()
+    for month, nature, mission_id, charge, amount in rollups:
+        monthDays = days.setdefault(month, {})
+        monthDays[nature] = monthDays.get(nature, 0) + charge
+        if (mission_id, consultant.id) in rates:
+            # Days with a financial condition are valued, even with a null daily rate
+            monthAmount, monthValuedDays = valued.get(month, (0, 0))
+            valued[month] = (monthAmount + amount, monthValuedDays + charge)
+    months = sorted(days.keys())
+    dailyRateObjectives = getRateObjectives([consultant], months, rate_type="DAILY_RATE")
+    prodRateObjectives = getRateObjectives([consultant], months, rate_type="PROD_RATE")
+
+    data = []
+    for month in months:
+        prodDays = days[month].get("PROD", 0)
+        nonProdDays = days[month].get("NONPROD", 0)
+        prodRate = prodDays / (prodDays + nonProdDays) if (prodDays + nonProdDays) > 0 else None
+        amount, valuedDays = valued.get(month, (0, 0))
+        dailyRate = int(amount / valuedDays) if valuedDays > 0 else None
+        data.append((month, dailyRate, prodRate or None,
+                     dailyRateObjectives.get((consultant.id, month)), prodRateObjectives.get((consultant.id, month))))
+    return data
+
+def consultantMetrics(consultant):
+    """Compute current month activity metrics of a consultant in a few grouped queries. Result is cached per consultant
+    and computed again when day changes or when consultant timesheet, staffing or financial conditions are updated
+    @param consultant: consultant
+    @return: dict with done_days, forecasted, month_turnover, last_month_turnover (up to the same day), daily_rate,
+    daily_rate_objective, prod_rate (percent) and prod_rate_objective. Objectives are None if not defined"""
+    today = date.today()
+    month = today.replace(day=1)
+    lastMonth = previousMonth(month)
+    lastMonthEnd = lastMonth.replace(day=min(today.day, month_days(lastMonth)))
+
+    def compute():
+        timesheets = Timesheet.objects.filter(consultant=consultant, working_date__gte=lastMonth, working_date__lt=nextMonth(month))
+        timesheets = timesheets.values_list("mission", "mission__nature").order_by()
+        timesheets = timesheets.annotate(done=Sum(Case(When(charge__gt=0, working_date__gte=month, working_date__lte=today, then="charge"), output_field=FloatField())))
+        timesheets = timesheets.annotate(month_charge=Sum(Case(When(charge__gt=0, working_date__gte=month, then="charge"), output_field=FloatField())))
+        timesheets = timesheets.annotate(to_today=Sum(Case(When(working_date__gte=month, working_date__lt=today, then="charge"), output_field=FloatField())))
+        timesheets = timesheets.annotate(last_month=Sum(Case(When(working_date__lt=lastMonthEnd, then="charge"), output_field=FloatField())))
+        rates = rateResolver.rates()
+        done_days = month_turnover = last_month_turnover = 0
+        days = {}  # Current month days per mission nature
+        rated_days = rated_amount = 0  # Current month days and amount of missions with financial conditions
+        for mission_id, nature, done, month_charge, to_today, last_month in timesheets:
+            done_days += done or 0
+            days[nature] = days.get(nature, 0) + (month_charge or 0)
+            daily_rate = rates.get((mission_id, consultant.id), (0, 0))[0]
+            if nature == "PROD":
+                month_turnover += (to_today or 0) * daily_rate
+                last_month_turnover += (last_month or 0) * daily_rate
+            if month_charge and (mission_id, consultant.id) in rates:
+                rated_days += month_charge
+                rated_amount += month_charge * daily_rate
+        forecasted = Staffing.objects.filter(consultant=consultant, charge__gt=0,
+                                             staffing_date__gte=month, staffing_date__lte=today).aggregate(Sum("charge")).values()[0]
+        prodDays = days.get("PROD", 0)
+        nonProdDays = days.get("NONPROD", 0)
+        return {"done_days": done_days,
+                "forecasted": forecasted or 0,
+                "month_turnover": month_turnover,
+                "last_month_turnover": last_month_turnover,
+                "daily_rate": int(rated_amount / rated_days) if rated_days else 0,
+                "daily_rate_objective": getRateObjectives([consultant], [month], rate_type="DAILY_RATE").get((consultant.id, month)),
+                "prod_rate": round(100 * prodDays / (prodDays + nonProdDays), 1) if (prodDays + nonProdDays) > 0 else 0,
+                "prod_rate_objective": getRateObjectives([consultant], [month], rate_type="PROD_RATE").get((consultant.id, month))}
+
+    version = get_version_stamp(CONSULTANT_METRICS_VERSION_CACHE_KEY % consultant.id)
+    return watermark_cached("CONSULTANT_METRICS_%s" % consultant.id, (today, version), compute, 24 * 3600)
 
 
 def staffingDates(n=12, format=None, minDate=None):
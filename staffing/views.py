@@ -8,15 +8,15 @@ Pydici staffing views. Http request are processed here.
 from datetime import date, timedelta, datetime
 import csv
 import json
+from itertools import groupby
 
 from django.shortcuts import render, redirect
-from django.http import HttpResponseRedirect, HttpResponse, Http404
+from django.http import HttpResponseRedirect, HttpResponse, Http404, StreamingHttpResponse
 from django.contrib.auth.decorators import permission_required
 from django.forms.models import inlineformset_factory
 from django.utils.translation import ugettext as _
 from django.core import urlresolvers
-from django.db.models import Sum, Count, Q, Max
-from django.db import connections
+from django.db.models import Sum, Count, Q, Max, Case, When, FloatField
 from django.utils.safestring import mark_safe
 from django.utils.html import escape
 from django.utils import formats
@@ -26,19 +26,21 @@ from django.contrib import messages
 from django.conf import settings
 from django.template.loader import get_template
 
-from staffing.models import Staffing, Mission, Holiday, Timesheet, FinancialCondition, LunchTicket
+from staffing.models import Staffing, Mission, Timesheet, FinancialCondition, LunchTicket, TimesheetRollup, rateResolver
 from people.models import Consultant, Subsidiary
 from leads.models import Lead
 from people.models import ConsultantProfile
 from staffing.forms import ConsultantStaffingInlineFormset, MissionStaffingInlineFormset, \
     TimesheetForm, MassStaffingForm, MissionContactsForm
 from core.utils import working_days, nextMonth, previousMonth, daysOfMonth, previousWeek, nextWeek, monthWeekNumber, \
-    to_int_or_round, COLORS, convertDictKeyToDate, cumulateList, user_has_feature, get_parameter, get_fiscal_years
+    to_int_or_round, COLORS, cumulateList, user_has_feature, get_parameter, get_fiscal_years, EchoBuffer, months_working_days, \
+    working_days_mask
 from core.decorator import pydici_non_public, pydici_feature, PydiciNonPublicdMixin
 from staffing.utils import gatherTimesheetData, saveTimesheetData, saveFormsetAndLog, \
-    sortMissions, holidayDays, staffingDates, time_string_for_day_percent
+    sortMissions, holidayDays, getHolidays, staffingDates, time_string_for_day_percent, pdcMatrix, consultantsProdData, \
+    consultantRatesData
 from staffing.forms import MissionForm
-from people.utils import getScopes
+from people.utils import getScopes, getRateObjectives
 
 TIMESTRING_FORMATTER = {
     'cycle': formats.number_format,
@@ -207,21 +209,12 @@ def mass_staffing(request):
             else:
                 # Use selected consultants
                 consultants = form.cleaned_data["consultants"]
-            for mission in form.cleaned_data["missions"]:
-                for consultant in consultants:
-                    for staffing_date in form.cleaned_data["staffing_dates"]:
-                        staffing_date = date(*[int(i) for i in staffing_date.split("-")])
-                        staffing, created = Staffing.objects.get_or_create(consultant=consultant,
-                                                                           mission=mission,
-                                                                           staffing_date=staffing_date,
-                                                                           defaults={"consultant": consultant,
-                                                                                     "mission": mission,
-                                                                                     "staffing_date": staffing_date})
-                        staffing.charge = form.cleaned_data["charge"]
-                        staffing.comment = form.cleaned_data["comment"]
-                        staffing.update_date = now
-                        staffing.last_user = unicode(request.user)
-                        staffing.save()
+            dates = [date(*[int(i) for i in staffing_date.split("-")]) for staffing_date in form.cleaned_data["staffing_dates"]]
+            Staffing.bulk_upsert(form.cleaned_data["missions"], consultants, dates,
+                                 charge=form.cleaned_data["charge"],
+                                 comment=form.cleaned_data["comment"],
+                                 update_date=now,
+                                 last_user=unicode(request.user))
             # Redirect to self to display a new unbound form
             messages.add_message(request, messages.INFO, _("Staffing has been updated"))
             return HttpResponseRedirect(urlresolvers.reverse("staffing.views.mass_staffing"))
@@ -304,7 +297,6 @@ def pdc_review(request, year=None, month=None):
     staffing = {}  # staffing data per month and per consultant
     total = {}  # total staffing data per month
     rates = []  # staffing rates per month
-    available_month = {}  # available working days per month
     months = []  # list of month to be displayed
 
     #TODO: simplify this !! Use nextMonth
@@ -319,55 +311,26 @@ def pdc_review(request, year=None, month=None):
     next_slice_date = start_date + timedelta(days=(31 * n_month))
 
     # Initialize total dict and available dict
-    holidays_days = Holiday.objects.all().values_list("day", flat=True)
+    available_month = months_working_days(months, getHolidays())  # available working days per month
     for month in months:
         total[month] = {"prod": 0, "unprod": 0, "holidays": 0, "available": 0, "total": 0}
-        available_month[month] = working_days(month, holidays_days)
 
     # Get consultants staffing
-    consultants = Consultant.objects.filter(productive=True).filter(active=True).filter(subcontractor=False).select_related("staffing_manager")
+    consultants = Consultant.objects.filter(productive=True).filter(active=True).filter(subcontractor=False).select_related("staffing_manager", "profil")
     if team:
         consultants = consultants.filter(staffing_manager=team)
     if subsidiary :
         consultants = consultants.filter(company=subsidiary)
+    consultants = list(consultants)
+    charges, companies = pdcMatrix(consultants, months, projection)
     for consultant in consultants:
         staffing[consultant] = []
-        missions = set()
         for month in months:
-            if projection in ("balanced", "full"):
-                # Only exclude null (0%) mission
-                current_staffings = consultant.staffing_set.filter(staffing_date=month, mission__probability__gt=0).order_by()
-            else:
-                # Only keep 100% mission
-                current_staffings = consultant.staffing_set.filter(staffing_date=month, mission__probability=100).order_by()
-
-            # Sum staffing
-            prod = []
-            unprod = []
-            holidays = []
-            for current_staffing  in current_staffings.select_related("mission__lead__client__organisation__company"):
-                nature = current_staffing.mission.nature
-                if nature == "PROD":
-                    missions.add(current_staffing.mission)  # Store prod missions for this consultant
-                    if projection == "full":
-                        prod.append(current_staffing.charge)
-                    else:
-                        prod.append(current_staffing.charge * current_staffing.mission.probability / 100)
-                elif nature == "NONPROD":
-                    if projection == "full":
-                        unprod.append(current_staffing.charge)
-                    else:
-                        unprod.append(current_staffing.charge * current_staffing.mission.probability / 100)
-                elif nature == "HOLIDAYS":
-                    if projection == "full":
-                        holidays.append(current_staffing.charge)
-                    else:
-                        holidays.append(current_staffing.charge * current_staffing.mission.probability / 100)
-
             # Staffing computation
-            prod = sum(prod)
-            unprod = sum(unprod)
-            holidays = sum(holidays)
+            natures = charges.get((consultant.id, month), {})
+            prod = natures.get("PROD", 0)
+            unprod = natures.get("NONPROD", 0)
+            holidays = natures.get("HOLIDAYS", 0)
             prod_round = to_int_or_round(prod)
             unprod_round = to_int_or_round(unprod)
             holidays_round = to_int_or_round(holidays)
@@ -380,7 +343,7 @@ def pdc_review(request, year=None, month=None):
             total[month]["available"] += available
             total[month]["total"] += available_month[month]
         # Add client synthesis to staffing dict
-        company = set([m.lead.client.organisation.company for m in list(missions) if m.lead is not None])
+        company = companies.get(consultant.id, set())
         client_list = ", ".join(["<a href='%s'>%s</a>" %
                                 (urlresolvers.reverse("crm.views.company_detail", args=[c.id]), unicode(c)) for c in company])
         client_list = "<div class='hidden-xs hidden-sm'>%s</div>" % client_list
@@ -512,11 +475,18 @@ def prod_report(request, year=None, month=None):
     if subsidiary:
         consultants = consultants.filter(company=subsidiary)
 
-    holidays_days = Holiday.objects.filter(day__gte=start_date, day__lte=end_date).values_list("day", flat=True)
+    holidays_days = [day for day in getHolidays() if start_date <= day <= end_date]
+    months_days = months_working_days(months, holidays_days, upToToday=True)
     data = []
     totalDone = {}
     totalForecasted = {}
 
+    # Gather done days, turnover and rate objectives of the whole scope
+    consultants = list(consultants)
+    days, turnovers = consultantsProdData(consultants, months)
+    daily_rate_objs = getRateObjectives(consultants, months, rate_type="DAILY_RATE")
+    prod_rate_objs = getRateObjectives(consultants, months, rate_type="PROD_RATE")
+
     for consultant in consultants:
         consultantData = []
         for month in months:
@@ -524,21 +494,16 @@ def prod_report(request, year=None, month=None):
                 totalDone[month] = 0
             if month not in totalForecasted:
                 totalForecasted[month] = 0
-            upperBound = min(date.today(), nextMonth(month))
-            month_days = working_days(month, holidays=holidays_days, upToToday=True)
-            timesheets = Timesheet.objects.filter(consultant=consultant,
-                                                  charge__gt=0,
-                                                  working_date__gte=month,
-                                                  working_date__lt=upperBound)
-            consultant_days = dict(timesheets.values_list("mission__nature").order_by("mission__nature").annotate(Sum("charge")))
-
-            try:
-                daily_rate_obj = consultant.getRateObjective(workingDate=month, rate_type="DAILY_RATE").rate
-                prod_rate_obj = float(consultant.getRateObjective(workingDate=month, rate_type="PROD_RATE").rate) / 100
-                forecast = int(daily_rate_obj * prod_rate_obj * (month_days - consultant_days.get("HOLIDAYS",0)))
-            except AttributeError:
+            month_days = months_days[month]
+            consultant_days = days.get((consultant.id, month), {})
+            turnover = int(turnovers.get((consultant.id, month), 0))
+            daily_rate_obj = daily_rate_objs.get((consultant.id, month))
+            prod_rate_obj = prod_rate_objs.get((consultant.id, month))
+            if daily_rate_obj is None or prod_rate_obj is None:
                 prod_rate_obj = daily_rate_obj = forecast = 0 # At least one rate objective is missing
-            turnover = int(consultant.getTurnover(month, upperBound))
+            else:
+                prod_rate_obj = float(prod_rate_obj) / 100
+                forecast = int(daily_rate_obj * prod_rate_obj * (month_days - consultant_days.get("HOLIDAYS",0)))
             try:
                 prod_rate = consultant_days.get("PROD", 0) / (consultant_days.get("PROD", 0) + consultant_days.get("NONPROD", 0))
             except ZeroDivisionError:
@@ -612,10 +577,14 @@ def fixed_price_missions_report(request):
     else:
         subsidiary = None
 
-    for mission in missions.select_related():
+    missions = missions.select_related()
+    objectiveMargins = Mission.objective_margins(missions)
+    currentMargins = Mission.margins(missions)
+    targetMargins = Mission.margins(missions, mode="target")
+    for mission in missions:
         #TODO: we mess up with objective margin that is computed for current but not target margin. Same issue in mission_tiemsheet page
-        current_margin = round(mission.margin() + sum(mission.objectiveMargin().values()) / 1000, 1)
-        target_margin = round(mission.margin(mode="target"), 1)
+        current_margin = round(currentMargins[mission.id] + sum(objectiveMargins[mission.id].values()) / 1000, 1)
+        target_margin = round(targetMargins[mission.id], 1)
         data.append((mission, round(mission.done_work_k()[1],1), current_margin, target_margin))
 
     # Get scopes
@@ -796,7 +765,6 @@ def consultant_csv_timesheet(request, consultant, days, month, missions):
 @pydici_non_public
 def mission_timesheet(request, mission_id):
     """Mission timesheet"""
-    dateTrunc = connections[Timesheet.objects.db].ops.date_trunc_sql  # Shortcut to SQL date trunc function
     mission = Mission.objects.get(id=mission_id)
     current_month = date.today().replace(day=1)  # Current month
     consultants = mission.consultants()
@@ -809,9 +777,10 @@ def mission_timesheet(request, mission_id):
         # This view should only be accessed by ajax request. Redirect lost users
         return redirect(mission_home, mission_id)
 
-    # Gather timesheet (Only consider timesheet up to current month)
-    timesheets = Timesheet.objects.filter(mission=mission).filter(working_date__lt=nextMonth(current_month)).order_by("working_date")
-    timesheetMonths = list(timesheets.dates("working_date", "month"))
+    # Gather timesheet monthly rollup (Only consider timesheet up to current month)
+    rollups = TimesheetRollup.objects.filter(mission=mission).filter(month__lt=nextMonth(current_month))
+    timesheetMonths = list(rollups.dates("month", "month"))
+    rollupData = dict(((consultant_id, month), charge) for consultant_id, month, charge in rollups.values_list("consultant", "month", "charge"))
 
     # Gather forecaster (till current month)
     staffings = Staffing.objects.filter(mission=mission).filter(staffing_date__gte=current_month).order_by("staffing_date")
@@ -820,13 +789,7 @@ def mission_timesheet(request, mission_id):
     missionData = []  # list of tuple (consultant, (charge month 1, charge month 2), (forecast month 1, forcast month2), estimated)
     for consultant in consultants:
         # Timesheet data
-        timesheetData = []
-        data = dict(timesheets.filter(consultant=consultant).extra(select={'month': dateTrunc("month", "working_date")}).values_list("month").annotate(Sum("charge")).order_by("month"))
-        data = convertDictKeyToDate(data)
-
-        for month in timesheetMonths:
-            n_days = data.get(month, 0)
-            timesheetData.append(n_days)
+        timesheetData = [rollupData.get((consultant.id, month), 0) for month in timesheetMonths]
 
         timesheetData.append(sum(timesheetData))  # Add total per consultant
         timesheetData.append(timesheetData[-1] * consultant_rates[consultant][0] / 1000)  # Add total in money
@@ -954,51 +917,47 @@ def mission_timesheet(request, mission_id):
 def mission_csv_timesheet(request, mission, consultants):
     """@return: csv timesheet for a given mission"""
     # This "view" is never called directly but only through consultant_timesheet view
-    response = HttpResponse(content_type="text/csv")
-    response["Content-Disposition"] = "attachment; filename=%s.csv" % mission.mission_id()
-    writer = csv.writer(response, delimiter=';')
-    timesheets = Timesheet.objects.select_related().filter(mission=mission)
-    months = timesheets.dates("working_date", "month")
-
-    for month in months:
-        days = daysOfMonth(month)
-        next_month = nextMonth(month)
-        padding = 31 - len(days)  # Padding for month with less than 31 days to align total column
-        # Header
-        writer.writerow([("%s - %s" % (mission.full_name(), formats.date_format(month, format="YEAR_MONTH_FORMAT"))).encode("ISO-8859-15", "replace"), ])
-
-        # Days
-        writer.writerow(["", ] + [d.day for d in days])
-        dayHeader = [_("Consultants").encode("ISO-8859-15", "replace")] + [_(d.strftime("%a")) for d in days]
-        if padding:
-            dayHeader.extend([""] * padding)
-        dayHeader.append(_("total"))
-        writer.writerow(dayHeader)
-
-        for consultant in consultants:
-            total = 0
-            row = [unicode(consultant).encode("ISO-8859-15", "replace"), ]
-            consultant_timesheets = {}
-            for timesheet in timesheets.filter(consultant_id=consultant.id,
-                                               working_date__gte=month,
-                                               working_date__lt=next_month):
-                consultant_timesheets[timesheet.working_date] = timesheet.charge
-            for day in days:
-                try:
-                    charge = consultant_timesheets.get(day)
+    timesheets = Timesheet.objects.filter(mission=mission).order_by("working_date", "consultant")
+    timesheets = timesheets.values_list("working_date", "consultant_id", "charge").iterator()
+
+    def rows():
+        for month, month_timesheets in groupby(timesheets, key=lambda t: t[0].replace(day=1)):
+            days = daysOfMonth(month)
+            padding = 31 - len(days)  # Padding for month with less than 31 days to align total column
+            consultant_timesheets = {}  # Key is (consultant id, day)
+            for working_date, consultant_id, charge in month_timesheets:
+                consultant_timesheets[(consultant_id, working_date)] = charge
+            # Header
+            yield [("%s - %s" % (mission.full_name(), formats.date_format(month, format="YEAR_MONTH_FORMAT"))).encode("ISO-8859-15", "replace"), ]
+
+            # Days
+            yield ["", ] + [d.day for d in days]
+            dayHeader = [_("Consultants").encode("ISO-8859-15", "replace")] + [_(d.strftime("%a")) for d in days]
+            if padding:
+                dayHeader.extend([""] * padding)
+            dayHeader.append(_("total"))
+            yield dayHeader
+
+            for consultant in consultants:
+                total = 0
+                row = [unicode(consultant).encode("ISO-8859-15", "replace"), ]
+                for day in days:
+                    charge = consultant_timesheets.get((consultant.id, day))
                     if charge:
                         row.append(formats.number_format(charge))
                         total += charge
                     else:
                         row.append("")
-                except Timesheet.DoesNotExist:
-                    row.append("")
-            if padding:
-                row.extend([""] * padding)
-            row.append(formats.number_format(total))
-            if total > 0:
-                writer.writerow(row)
-        writer.writerow([""])
+                if padding:
+                    row.extend([""] * padding)
+                row.append(formats.number_format(total))
+                if total > 0:
+                    yield row
+            yield [""]
+
+    writer = csv.writer(EchoBuffer(), delimiter=';')
+    response = StreamingHttpResponse((writer.writerow(row) for row in rows()), content_type="text/csv")
+    response["Content-Disposition"] = "attachment; filename=%s.csv" % mission.mission_id()
     return response
 
 
@@ -1020,7 +979,8 @@ def all_timesheet(request, year=None, month=None):
     consultants = list(set([i["consultant"] for i in timesheets]))
     missions = list(set([i["mission"] for i in timesheets]))
     consultants = Consultant.objects.filter(id__in=consultants).order_by("name")
-    missions = sortMissions(Mission.objects.filter(id__in=missions))
+    missions = sortMissions(Mission.objects.filter(id__in=missions).select_related("lead__client__organisation__company"))
+    missionIds = Mission.mission_ids(missions)
     charges = {}
     if "csv" in request.GET:
         # Simple consultant list
@@ -1039,10 +999,10 @@ def all_timesheet(request, year=None, month=None):
                                         escape(unicode(mission)))
         if "csv" in request.GET:
             # Simple mission name
-            consultantData = [unicode(mission), mission.mission_id()]
+            consultantData = [unicode(mission), missionIds[mission.id]]
         else:
             # Drill down link
-            consultantData = [mark_safe(missionUrl), mission.mission_id()]
+            consultantData = [mark_safe(missionUrl), missionIds[mission.id]]
         for consultant in consultants:
             consultantData.append(charges.get((mission.id, consultant.id), 0))
         data.append(consultantData)
@@ -1059,11 +1019,10 @@ def all_timesheet(request, year=None, month=None):
         charges = None
 
     # Add days without lunch ticket
-    ticketData = []
-    for consultant in consultants:
-        lunchTickets = LunchTicket.objects.filter(consultant=consultant)
-        lunchTickets = lunchTickets.filter(lunch_date__gte=month).filter(lunch_date__lt=next_date)
-        ticketData.append(lunchTickets.count())
+    lunchTickets = LunchTicket.objects.filter(consultant__in=consultants)
+    lunchTickets = lunchTickets.filter(lunch_date__gte=month).filter(lunch_date__lt=next_date)
+    lunchTickets = dict(lunchTickets.values_list("consultant").annotate(Count("id")).order_by())
+    ticketData = [lunchTickets.get(consultant.id, 0) for consultant in consultants]
 
     if charges:
         charges.append([_("Days without lunch ticket"), ""] + ticketData)
@@ -1114,10 +1073,6 @@ def all_csv_timesheet(request, charges, month):
 def detailed_csv_timesheet(request, year=None, month=None):
     """Detailed timesheet with mission, consultant, and rates
     Intended for accounting third party system or spreadsheet analysis"""
-    response = HttpResponse(content_type="text/csv")
-    response["Content-Disposition"] = "attachment; filename=%s" % _("timesheet.csv")
-    writer = csv.writer(response, delimiter=';')
-
     if year and month:
         month = date(int(year), int(month), 1)
     else:
@@ -1128,42 +1083,50 @@ def detailed_csv_timesheet(request, year=None, month=None):
     # Header
     header = [_("Lead"), _("Deal id"), _(u"Lead Price (k€)"), _("Mission"), _("Mission id"), _("Billing mode"), _(u"Mission Price (k€)"),
               _("Consultant"), _("Daily rate"), _("Bought daily rate"), _("Past done days"), _("Done days"), _("Days to be done")]
-    writer.writerow([unicode(month).encode("ISO-8859-15", "replace"), ])
-    writer.writerow([unicode(i).encode("ISO-8859-15", "replace") for i in header])
 
     missions = Mission.objects.filter(Q(timesheet__working_date__gte=month, timesheet__working_date__lt=next_month) |
                                       Q(staffing__staffing_date__gte=month, staffing__staffing_date__lt=next_month))
-    missions = missions.distinct().order_by("lead")
-
-    for mission in missions:
-        for consultant in mission.consultants():
-            row = [mission.lead if mission.lead else "", mission.lead.deal_id if mission.lead else "",
-                   mission.lead.sales if mission.lead else 0, mission,
-                   mission.mission_id(), mission.get_billing_mode_display(),
-                   formats.number_format(mission.price) if mission.price else 0, consultant]
-            # Rates
-            try:
-                financialCondition = FinancialCondition.objects.get(consultant=consultant, mission=mission)
-                row.append(formats.number_format(financialCondition.daily_rate) if financialCondition.daily_rate else 0)
-                row.append(formats.number_format(financialCondition.bought_daily_rate) if financialCondition.bought_daily_rate else 0)
-            except FinancialCondition.DoesNotExist:
-                row.extend([0, 0])
-            # Past timesheet
-            timesheet = Timesheet.objects.filter(mission=mission, consultant=consultant,
-                                                 working_date__lt=month).aggregate(Sum("charge")).values()[0]
-            row.append(formats.number_format(timesheet) if timesheet else 0)
-            # Current month timesheet
-            timesheet = Timesheet.objects.filter(mission=mission, consultant=consultant,
-                                                 working_date__gte=month,
-                                                 working_date__lt=next_month).aggregate(Sum("charge")).values()[0]
-            row.append(formats.number_format(timesheet) if timesheet else 0)
-            # Forecasted staffing
-            forecast = Staffing.objects.filter(mission=mission, consultant=consultant,
-                                               staffing_date__gte=next_month).aggregate(Sum("charge")).values()[0]
-            row.append(formats.number_format(forecast) if forecast else 0)
-
-            writer.writerow([unicode(i).encode("ISO-8859-15", "replace") for i in row])
-
+    missions = list(missions.distinct().order_by("lead").select_related("lead"))
+
+    # Past, current month and forecast days per (mission id, consultant id)
+    timesheets = Timesheet.objects.filter(mission__in=missions).values_list("mission", "consultant").order_by()
+    timesheets = timesheets.annotate(past=Sum(Case(When(working_date__lt=month, then="charge"), output_field=FloatField())))
+    timesheets = timesheets.annotate(current=Sum(Case(When(working_date__gte=month, working_date__lt=next_month, then="charge"), output_field=FloatField())))
+    staffings = Staffing.objects.filter(mission__in=missions).values_list("mission", "consultant").order_by()
+    staffings = staffings.annotate(forecast=Sum(Case(When(staffing_date__gte=next_month, then="charge"), output_field=FloatField())))
+    done = dict(((m, c), (past, current)) for m, c, past, current in timesheets)
+    forecasts = dict(((m, c), forecast) for m, c, forecast in staffings)
+    consultants = Consultant.objects.in_bulk(set(c for m, c in done.keys() + forecasts.keys()))
+    missionConsultants = {}
+    for mission_id, consultant_id in set(done.keys() + forecasts.keys()):
+        missionConsultants.setdefault(mission_id, []).append(consultants[consultant_id])
+    rates = rateResolver.get_many(done.keys() + forecasts.keys())
+
+    def rows():
+        yield [unicode(month).encode("ISO-8859-15", "replace"), ]
+        yield [unicode(i).encode("ISO-8859-15", "replace") for i in header]
+        for mission in missions:
+            for consultant in sorted(missionConsultants.get(mission.id, []), key=lambda c: c.name):
+                row = [mission.lead if mission.lead else "", mission.lead.deal_id if mission.lead else "",
+                       mission.lead.sales if mission.lead else 0, mission,
+                       mission.mission_id(), mission.get_billing_mode_display(),
+                       formats.number_format(mission.price) if mission.price else 0, consultant]
+                # Rates
+                daily_rate, bought_daily_rate = rates[(mission.id, consultant.id)]
+                row.append(formats.number_format(daily_rate) if daily_rate else 0)
+                row.append(formats.number_format(bought_daily_rate) if bought_daily_rate else 0)
+                # Past and current month timesheet
+                for timesheet in done.get((mission.id, consultant.id), (0, 0)):
+                    row.append(formats.number_format(timesheet) if timesheet else 0)
+                # Forecasted staffing
+                forecast = forecasts.get((mission.id, consultant.id))
+                row.append(formats.number_format(forecast) if forecast else 0)
+
+                yield [unicode(i).encode("ISO-8859-15", "replace") for i in row]
+
+    writer = csv.writer(EchoBuffer(), delimiter=';')
+    response = StreamingHttpResponse((writer.writerow(row) for row in rows()), content_type="text/csv")
+    response["Content-Disposition"] = "attachment; filename=%s" % _("timesheet.csv")
     return response
 
 
@@ -1177,11 +1140,9 @@ def holidays_planning(request, year=None, month=None):
     else:
         month = date.today().replace(day=1)
 
-    holidays_days = Holiday.objects.all().values_list("day", flat=True)
     days = daysOfMonth(month)
+    workingDays = working_days_mask(days, holidayDays(month))  # Week end and holidays mask
     data = []
-    # TODO: holidays (jours fériés
-    # TODO: week end)
 
     if date.today().replace(day=1) == month:
         today = datetime.today().day
@@ -1190,14 +1151,20 @@ def holidays_planning(request, year=None, month=None):
 
     next_month = nextMonth(month)
     previous_month = previousMonth(month)
-    for consultant in Consultant.objects.filter(active=True, subcontractor=False):
+    consultants = Consultant.objects.filter(active=True, subcontractor=False)
+    # Holidays days per consultant as a list of boolean for each day of month
+    holidays = {}
+    timesheets = Timesheet.objects.filter(working_date__gte=month, working_date__lt=next_month, consultant__in=consultants,
+                                          mission__nature="HOLIDAYS", charge__gt=0)
+    for consultant_id, working_date in timesheets.values_list("consultant_id", "working_date").order_by():
+        holidays.setdefault(consultant_id, [False] * len(days))[working_date.day - 1] = True
+    noHolidays = [False] * len(days)
+    for consultant in consultants:
         consultantData = [consultant, ]
-        consultantHolidays = Timesheet.objects.filter(working_date__gte=month, working_date__lt=next_month,
-                                                      consultant=consultant, mission__nature="HOLIDAYS", charge__gt=0).values_list("working_date", flat=True)
-        for day in days:
-            if day.isoweekday() in (6, 7) or day in holidays_days:
+        for workingDay, inHolidays in zip(workingDays, holidays.get(consultant.id, noHolidays)):
+            if not workingDay:
                 consultantData.append("lightgrey")
-            elif day in consultantHolidays:
+            elif inHolidays:
                 consultantData.append("#56160C")
             else:
                 consultantData.append("#F6F6F6")
@@ -1217,12 +1184,13 @@ def holidays_planning(request, year=None, month=None):
 def missions_report(request, year=None, nature="HOLIDAYS"):
     """Reports about holidays or non-prod missions"""
     data = []
-    dateTrunc = connections[Timesheet.objects.db].ops.date_trunc_sql  # Shortcut to SQL date trunc function
     month = int(get_parameter("FISCAL_YEAR_MONTH"))
+    today = date.today()
+    current_month = today.replace(day=1)
 
-    timesheets = Timesheet.objects.filter(mission__nature=nature, working_date__lte=date.today())
+    timesheets = TimesheetRollup.objects.filter(nature=nature, month__lte=today)
 
-    years = get_fiscal_years(timesheets, "working_date")
+    years = get_fiscal_years(timesheets, "month")
 
     if not years:
         return HttpResponse()
@@ -1234,18 +1202,20 @@ def missions_report(request, year=None, nature="HOLIDAYS"):
         year = int(year)
         start = date(year, month, 1)
         end = date(year+1, month, 1)
-        timesheets = timesheets.filter(working_date__gte=start, working_date__lt=end)
+        timesheets = timesheets.filter(month__gte=start, month__lt=end)
 
-    timesheets =timesheets.extra(select={'month': dateTrunc("month", "working_date")})
-    timesheets = timesheets.values("month", "mission__description", "consultant__name", "consultant__profil__name", "consultant__company__name").annotate(Sum("charge")).order_by("month")
+    # Closed months are read from rollup, current month from timesheet to exclude days after today
+    fields = ("mission__description", "consultant__name", "consultant__profil__name", "consultant__company__name")
+    timesheets = list(timesheets.filter(month__lt=current_month).values("month", *fields).annotate(Sum("charge")).order_by("month"))
+    if year == "all" or start <= current_month < end:
+        currentTimesheets = Timesheet.objects.filter(mission__nature=nature, working_date__gte=current_month, working_date__lte=today)
+        for timesheet in currentTimesheets.values(*fields).annotate(Sum("charge")).order_by():
+            timesheet["month"] = current_month
+            timesheets.append(timesheet)
 
     for timesheet in timesheets:
-        # Thank you sqlite for those sad lines of code
-        month = timesheet["month"]
-        if month and isinstance(month, (datetime, date)):
-            month = month.strftime("%Y-%m")
         data.append({
-            _(u"month") : month,
+            _(u"month") : timesheet["month"].strftime("%Y-%m"),
             _(u"type"): timesheet["mission__description"],
             _(u"consultant"): timesheet["consultant__name"],
             _(u"subsidiary"): timesheet["consultant__company__name"],
@@ -1392,6 +1362,17 @@ class MissionUpdate(PydiciNonPublicdMixin, UpdateView):
         return self.request.GET.get('return_to', False) or urlresolvers.reverse_lazy("mission_home", args=[self.object.id, ])
 
 
+def timesheet_graph_scope(subsidiary_id=None, team_id=None):
+    """@return: filter arguments of timesheet and timesheet rollup for graphs scope: internal productive consultants
+    of given team or subsidiary"""
+    scope = {"consultant__subcontractor": False, "consultant__productive": True}
+    if team_id:
+        scope["consultant__staffing_manager_id"] = team_id
+    elif subsidiary_id:
+        scope["consultant__company_id"] = subsidiary_id
+    return scope
+
+
 @pydici_non_public
 @pydici_feature("reports")
 @cache_page(60 * 10)
@@ -1400,12 +1381,10 @@ def graph_timesheet_rates_bar_jqp(request, subsidiary_id=None, team_id=None):
     @:param subsidiary_id: filter graph on the given subsidiary
     @:param team_id: filter graph on the given team
     @todo: per year, with start-end date"""
-    dateTrunc = connections[Timesheet.objects.db].ops.date_trunc_sql  # Shortcut to SQL date trunc function
     data = {}  # Graph data
     natures = [i[0] for i in Mission.MISSION_NATURE]  # Mission natures
     nature_data = {}
     nature_data_days = {}
-    holiday_days = [h.day for h in  Holiday.objects.all()]
     graph_data = []
 
     # Create dict per mission nature
@@ -1417,35 +1396,35 @@ def graph_timesheet_rates_bar_jqp(request, subsidiary_id=None, team_id=None):
     timesheetEndDate = nextMonth(date.today())  # First day of next month
 
     # Filter on scope
-    if team_id:
-        timesheets = Timesheet.objects.filter(consultant__staffing_manager_id=team_id)
-    elif subsidiary_id:
-        timesheets = Timesheet.objects.filter(consultant__company_id=subsidiary_id)
-    else:
-        timesheets = Timesheet.objects.all()
+    scope = timesheet_graph_scope(subsidiary_id, team_id)
+
+    # Start date is excluded. Its month is read from timesheet, following months from rollup
+    rollups = TimesheetRollup.objects.filter(month__gt=timesheetStartDate, month__lt=timesheetEndDate, **scope)
+    firstMonthTimesheets = Timesheet.objects.filter(working_date__gt=timesheetStartDate, working_date__lt=nextMonth(timesheetStartDate), **scope)
 
-    timesheets = timesheets.filter(consultant__subcontractor=False,
-                                   consultant__productive=True,
-                                   working_date__gt=timesheetStartDate,
-                                   working_date__lt=timesheetEndDate).select_related()
+    nConsultant = dict(rollups.values_list("month").annotate(Count("consultant", distinct=True)).order_by())
+    for month, nature, charge in rollups.values_list("month", "nature").annotate(Sum("charge")).order_by():
+        data[nature][month] = charge
 
-    timesheetMonths = timesheets.dates("working_date", "month")
+    firstMonthConsultants = firstMonthTimesheets.values("consultant").distinct().count()
+    if firstMonthConsultants:
+        nConsultant[timesheetStartDate] = firstMonthConsultants
+        for nature, charge in firstMonthTimesheets.values_list("mission__nature").annotate(Sum("charge")).order_by():
+            data[nature][timesheetStartDate] = charge
+
+    timesheetMonths = sorted(nConsultant.keys())
     isoTimesheetMonths = [d.isoformat() for d in timesheetMonths]
 
     if not timesheetMonths:
         return HttpResponse('')
 
-    nConsultant = dict(timesheets.extra(select={'month': dateTrunc("month", "working_date")}).values_list("month").annotate(Count("consultant__id", distinct=True)).order_by())
-    nConsultant = convertDictKeyToDate(nConsultant)
-
+    months_days = months_working_days(timesheetMonths, getHolidays())
     for nature in natures:
         nature_data[nature] = []
         nature_data_days[nature] = []
-        data = dict(timesheets.filter(mission__nature=nature).extra(select={'month': dateTrunc("month", "working_date")}).values_list("month").annotate(Sum("charge")).order_by("month"))
-        data = convertDictKeyToDate(data)
         for month in timesheetMonths:
-            nature_data[nature].append(100 * data.get(month, 0) / (working_days(month, holiday_days) * nConsultant.get(month, 1)))
-            nature_data_days[nature].append(data.get(month, 0))
+            nature_data[nature].append(100 * data[nature].get(month, 0) / (months_days[month] * nConsultant.get(month, 1)))
+            nature_data_days[nature].append(data[nature].get(month, 0))
         graph_data.append(zip(isoTimesheetMonths, nature_data[nature], nature_data_days[nature]))
 
     prodRate = []
@@ -1484,40 +1463,32 @@ def graph_profile_rates_jqp(request, subsidiary_id=None, team_id=None):
         avgDailyRate[profilId] = {}
         nDays[profilId] = {}
 
-    # Filter on scope
-    if team_id:
-        timesheets = Timesheet.objects.filter(consultant__staffing_manager_id=team_id)
-    elif subsidiary_id:
-        timesheets = Timesheet.objects.filter(consultant__company_id=subsidiary_id)
-    else:
-        timesheets = Timesheet.objects.all()
-
-    timesheets = timesheets.filter(consultant__subcontractor=False,
-                                   consultant__productive=True,
-                                   working_date__gt=timesheetStartDate,
-                                   working_date__lt=timesheetEndDate).select_related()
+    # Filter on scope. Start date is excluded: its month is read from timesheet, valued following months from rollup
+    scope = timesheet_graph_scope(subsidiary_id, team_id)
+    timesheets = TimesheetRollup.objects.filter(month__gt=timesheetStartDate, month__lt=timesheetEndDate, **scope)
+    firstMonthTimesheets = Timesheet.objects.filter(working_date__gt=timesheetStartDate, working_date__lt=nextMonth(timesheetStartDate), **scope)
+
+    # Sum of charge x rate and sum of charge with a defined rate per profil and month
+    timesheets = timesheets.values_list("consultant__profil", "month").annotate(Sum("amount"))
+    timesheets = timesheets.annotate(charge_with_rate=Sum(Case(When(amount__gt=0, then="charge"), output_field=FloatField()))).order_by()
+    for profil, month, amount, charge in timesheets:
+        avgDailyRate[profil][month] = amount
+        nDays[profil][month] = charge or 0
+
+    firstMonthTimesheets = firstMonthTimesheets.values_list("consultant__profil", "mission", "consultant").annotate(Sum("charge")).order_by()
+    for profil, mission_id, consultant_id, charge in firstMonthTimesheets:
+        daily_rate = rateResolver.get(mission_id, consultant_id)[0]
+        avgDailyRate[profil].setdefault(timesheetStartDate, 0)
+        nDays[profil].setdefault(timesheetStartDate, 0)
+        if daily_rate > 0:
+            avgDailyRate[profil][timesheetStartDate] += charge * daily_rate
+            nDays[profil][timesheetStartDate] += charge
 
-    timesheetMonths = timesheets.dates("working_date", "month")
+    timesheetMonths = sorted(set(month for profilDays in nDays.values() for month in profilDays))
     isoTimesheetMonths = [d.isoformat() for d in timesheetMonths]
     if not timesheetMonths:
         return HttpResponse('')
 
-    financialConditions = {}
-    for fc in FinancialCondition.objects.all():
-        financialConditions["%s-%s" % (fc.mission_id, fc.consultant_id)] = fc.daily_rate
-
-    for timesheet in timesheets:
-        month = date(timesheet.working_date.year, timesheet.working_date.month, 1)
-        if not month in avgDailyRate[timesheet.consultant.profil.id]:
-            avgDailyRate[timesheet.consultant.profil.id][month] = 0
-        if not month in nDays[timesheet.consultant.profil.id]:
-            nDays[timesheet.consultant.profil.id][month] = 0
-
-        daily_rate = financialConditions.get("%s-%s" % (timesheet.mission_id, timesheet.consultant_id), 0)
-        if daily_rate > 0:
-            avgDailyRate[timesheet.consultant.profil.id][month] += timesheet.charge * daily_rate
-            nDays[timesheet.consultant.profil.id][month] += timesheet.charge
-
     # Compute per profil
     for profil in profils.keys():
         data = []
@@ -1561,31 +1532,16 @@ def graph_consultant_rates(request, consultant_id):
     consultant = Consultant.objects.get(id=consultant_id)
     startDate = (date.today() - timedelta(24 * 30)).replace(day=1)
 
-    timesheets = Timesheet.objects.filter(consultant=consultant, charge__gt=0, working_date__gte=startDate, working_date__lt=nextMonth(date.today()))
-    kdates = list(timesheets.dates("working_date", "month"))
-
     # Avg daily rate / month and objective rate
-    for refDate in kdates:
-        next_month = nextMonth(refDate)
-        prodRate = consultant.getProductionRate(refDate, next_month)
+    for refDate, dailyRate, prodRate, dailyRateObjective, prodRateObjective in consultantRatesData(consultant, startDate, nextMonth(date.today())):
         if prodRate:
             prodRateData.append(round(100 * prodRate, 1))
             isoProdDates.append(refDate.isoformat())
-        fc = consultant.getFinancialConditions(refDate, next_month)
-        if fc:
-            dailyRateData.append(int(sum([rate * days for rate, days in fc]) / sum([days for rate, days in fc])))
+        if dailyRate is not None:
+            dailyRateData.append(dailyRate)
             isoRateDates.append(refDate.isoformat())
-        rate = consultant.getRateObjective(refDate, rate_type="DAILY_RATE")
-        if rate:
-            dailyRateObj.append(rate.rate)
-        else:
-            dailyRateObj.append(None)
-        rate = consultant.getRateObjective(refDate, rate_type="PROD_RATE")
-        if rate:
-            prodRateObj.append(rate.rate)
-        else:
-            prodRateObj.append(None)
-
+        dailyRateObj.append(dailyRateObjective)
+        prodRateObj.append(prodRateObjective)
 
     graph_data = [
         ["x_daily_rate"] + isoRateDates,